@@ -0,0 +1,109 @@
+"""Prompt-token budgeting shared by app.py and the Vercel functions in api/.
+
+The leading underscore keeps Vercel from deploying this file as a function.
+"""
+import re
+
+from _http import send_json
+
+# Output caps for diagram modes that never need the full 2048 tokens
+DIAGRAM_MAX_TOKENS = {
+    'pie': 512, 'xy': 512, 'quadrant': 512,
+    'timeline': 768,
+    'gantt': 1024, 'git': 1024,
+    'sequence': 1536, 'state': 1536, 'class': 1536, 'er': 1536,
+}
+
+_TOKEN_PIECES = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]")
+MESSAGE_TOKEN_OVERHEAD = 4      # role and separators per chat message
+NOTES_PROMPT_RESERVE = 1024        # tokens kept for the notes system prompt and instructions around a chunk
+
+
+def estimate_tokens(text):
+    """
+    Rough BPE-style token count: letters in pieces of ~4 characters, digits in
+    groups of 3, each punctuation mark one token. Non-ASCII letters (Indic
+    scripts, etc.) fall through to one token per character, which is about
+    what subword tokenizers spend on them. Errs slightly high.
+    """
+    if not text:
+        return 0
+    tokens = 0
+    for piece in _TOKEN_PIECES.findall(text):
+        if piece[0].isdigit():
+            tokens += (len(piece) + 2) // 3
+        elif piece[0].isalpha() and piece.isascii():
+            tokens += (len(piece) + 3) // 4
+        else:
+            tokens += 1
+    return tokens
+
+
+def messages_tokens(messages):
+    return sum(estimate_tokens(m.get('content', '')) + MESSAGE_TOKEN_OVERHEAD for m in messages)
+
+
+def strip_mermaid_noise(code):
+    """
+    Drop %% comment lines (keeping %%{init}%% directives), trailing whitespace
+    and blank lines. None of them change the diagram, so refine strips them
+    from oversized input before giving up on it.
+    """
+    lines = []
+    for line in code.splitlines():
+        stripped = line.strip()
+        if not stripped or (stripped.startswith('%%') and not stripped.startswith('%%{')):
+            continue
+        lines.append(line.rstrip())
+    return '\n'.join(lines)
+
+
+def drop_oldest_turns(messages, max_tokens):
+    """
+    Drop the oldest turns after the system prompt until the conversation fits
+    max_tokens, always keeping the latest message and starting the kept
+    history on a user turn. The result may still be over budget.
+    """
+    system, turns = messages[:1], messages[1:]
+    while len(turns) > 1 and messages_tokens(system + turns) > max_tokens:
+        turns = turns[1:]
+        while len(turns) > 1 and turns[0]['role'] != 'user':
+            turns = turns[1:]
+    return system + turns
+
+
+def split_to_budget(text, max_tokens):
+    """Split text on word boundaries into pieces of at most max_tokens estimated tokens each."""
+    pieces, current, current_tokens = [], [], 0
+    for word in text.split():
+        cost = estimate_tokens(word)
+        if current and current_tokens + cost > max_tokens:
+            pieces.append(' '.join(current))
+            current, current_tokens = [], 0
+        current.append(word)
+        current_tokens += cost
+    if current:
+        pieces.append(' '.join(current))
+    return pieces
+
+
+def split_chunk_to_budget(chunk, limit, max_pieces):
+    """A transcript chunk as pieces of at most limit tokens, or None if that takes more than max_pieces."""
+    if estimate_tokens(chunk) <= limit:
+        return [chunk]
+    pieces = split_to_budget(chunk, limit)
+    return pieces if len(pieces) <= max_pieces else None
+
+
+def over_budget_body(estimated, limit):
+    """The JSON body every entry point sends with a 413 for over-budget input."""
+    return {
+        'error': f'Input is too long: about {estimated} tokens, the limit is {limit}. Please shorten it.',
+        'estimated_tokens': estimated,
+        'max_input_tokens': limit,
+    }
+
+
+def send_over_budget(handler, estimated, limit):
+    """Write the 413 response from a Vercel BaseHTTPRequestHandler."""
+    send_json(handler, 413, over_budget_body(estimated, limit))
@@ -0,0 +1,21 @@
+"""JSON codec shared by the Vercel functions in api/; uses orjson when it is installed."""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """JSON-encode to bytes, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+def loads(data):
+    """Parse JSON from bytes or str; errors are json.JSONDecodeError either way."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,189 @@
+"""Recipient normalization and Resend batch sending, shared by app.py and the /api/send-emails function."""
+import concurrent.futures
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+from _codec import dumps
+
+RESEND_API_URL = os.getenv("RESEND_API_URL", "https://api.resend.com").rstrip('/')
+RESEND_FROM = "Arka Team <onboarding@resend.dev>"
+RESEND_BATCH_SIZE = 100          # Resend's per-request limit for /emails/batch
+RESEND_MAX_CONCURRENT_BATCHES = int(os.getenv("RESEND_MAX_CONCURRENT_BATCHES", "2"))
+RESEND_RATE_LIMIT = float(os.getenv("RESEND_RATE_LIMIT", "2"))   # requests per second
+
+
+# ── Recipient list normalization ────────────────────────────────────────────
+
+EMAIL_PATTERN = re.compile(
+    r"[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+    r"@(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}"
+)
+_ANGLE_ADDRESS = re.compile(r'<([^<>]*)>')
+RECIPIENT_SEPARATORS = re.compile(r'[,;\s]+')
+
+
+def canonicalize_email(raw):
+    """Return the canonical (trimmed, lowercased) address, or None if it isn't a valid address."""
+    if not isinstance(raw, str):
+        return None
+    value = raw.strip()
+    match = _ANGLE_ADDRESS.search(value)      # "Name <user@example.com>"
+    if match:
+        value = match.group(1)
+    value = value.strip().strip('"\'').lower().rstrip('.')
+    if len(value) > 254 or not EMAIL_PATTERN.fullmatch(value):
+        return None
+    return value
+
+
+def normalize_recipients(raw_emails):
+    """
+    Canonicalize, validate and dedupe recipients in one pass, preserving first-seen order.
+    Returns (emails, report).
+    """
+    if isinstance(raw_emails, str):
+        raw_emails = RECIPIENT_SEPARATORS.split(raw_emails)
+    seen = set()
+    emails = []
+    received = duplicates = 0
+    invalid = []
+    for raw in raw_emails:
+        if not isinstance(raw, str) or not raw.strip():
+            continue
+        received += 1
+        email = canonicalize_email(raw)
+        if email is None:
+            invalid.append(raw.strip())
+            continue
+        if email in seen:
+            duplicates += 1
+            continue
+        seen.add(email)
+        emails.append(email)
+    return emails, {
+        'received': received,
+        'duplicates_removed': duplicates,
+        'invalid': len(invalid),
+        'invalid_samples': invalid[:10]
+    }
+
+
+# ── Resend batch sending ────────────────────────────────────────────────────
+
+class RateLimiter:
+    """Blocking token bucket shared by the threads that send batches."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+RESEND_RATE_LIMITER = RateLimiter(RESEND_RATE_LIMIT)
+
+
+@contextmanager
+def _untracked(service, attempt=1):
+    yield lambda status_code: None
+
+
+# A 400/422 that names the `to` field, a recipient or one of the batch's addresses is about one
+# recipient; anything else (bad from/subject/html, domain or account problems) fails every message alike
+_RECIPIENT_ERROR = re.compile(r"[`'\"]to[`'\"]|\bto field\b|\brecipient", re.IGNORECASE)
+
+
+def error_names_recipient(detail, batch):
+    lowered = detail.lower()
+    return bool(_RECIPIENT_ERROR.search(detail)) or any(email.lower() in lowered for email in batch)
+
+
+def send_resend_batch(session, batch, subject, html_body, api_key, attempt=1, max_attempts=3,
+                      idempotency_key=None, tracker=None):
+    """
+    POST one batch (one message per recipient); returns (sent, errors). ``tracker``
+    is a context-manager factory ``tracker(service, attempt)`` yielding
+    ``record(status_code)`` around the request (app.py passes track_upstream).
+    """
+    tracker = tracker or _untracked
+    messages = [{'from': RESEND_FROM, 'to': [email], 'subject': subject, 'html': html_body} for email in batch]
+    headers = {'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json', 'User-Agent': 'Mozilla/5.0'}
+    if idempotency_key:
+        headers['Idempotency-Key'] = idempotency_key
+    RESEND_RATE_LIMITER.acquire()
+    try:
+        with tracker('resend', attempt) as track:
+            response = session.post(f"{RESEND_API_URL}/emails/batch", data=dumps(messages), headers=headers, timeout=30)
+            track(response.status_code)
+    except requests.exceptions.RequestException as e:
+        if attempt < max_attempts:
+            time.sleep(2 ** attempt)
+            return send_resend_batch(session, batch, subject, html_body, api_key, attempt + 1, max_attempts,
+                                     idempotency_key, tracker)
+        return 0, [f"{email}: {e}" for email in batch]
+
+    if response.status_code in (200, 201, 202):
+        return len(batch), []
+    if response.status_code in (429, 500, 502, 503, 504) and attempt < max_attempts:
+        retry_after = response.headers.get('Retry-After')
+        time.sleep(float(retry_after) if retry_after and retry_after.replace('.', '', 1).isdigit() else 2 ** attempt)
+        return send_resend_batch(session, batch, subject, html_body, api_key, attempt + 1, max_attempts,
+                                 idempotency_key, tracker)
+    if response.status_code in (400, 422) and len(batch) > 1 and error_names_recipient(response.text, batch):
+        # Resend rejects the whole batch for one bad address; bisect so the rest still go out
+        mid = len(batch) // 2
+        results = [
+            send_resend_batch(session, half, subject, html_body, api_key, 1, max_attempts,
+                              f"{idempotency_key}-{suffix}" if idempotency_key else None, tracker)
+            for half, suffix in ((batch[:mid], 'a'), (batch[mid:], 'b'))
+        ]
+        return results[0][0] + results[1][0], results[0][1] + results[1][1]
+    detail = response.text.strip()[:300]
+    return 0, [f"{email}: HTTP {response.status_code} {detail}" for email in batch]
+
+
+def send_via_resend(emails, subject, html_body, api_key, tracker=None, submit=None):
+    """
+    Send one message per recipient through Resend's batch endpoint, packing up to
+    RESEND_BATCH_SIZE messages per request with a few batches in flight behind
+    RESEND_RATE_LIMITER. ``submit(executor, fn, *args)`` schedules each batch
+    (app.py passes submit_in_context). Returns (sent, errors).
+    """
+    submit = submit or (lambda executor, fn, *args: executor.submit(fn, *args))
+    batches = [emails[i:i + RESEND_BATCH_SIZE] for i in range(0, len(emails), RESEND_BATCH_SIZE)]
+    sent = 0
+    errors = []
+    with requests.Session() as session:
+        # One pooled keep-alive connection per concurrent batch
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=RESEND_MAX_CONCURRENT_BATCHES)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        workers = max(1, min(RESEND_MAX_CONCURRENT_BATCHES, len(batches)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                submit(executor, send_resend_batch, session, batch, subject, html_body, api_key, 1, 3, None, tracker)
+                for batch in batches
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                batch_sent, batch_errors = future.result()
+                sent += batch_sent
+                errors.extend(batch_errors)
+    return sent, errors
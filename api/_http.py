@@ -0,0 +1,45 @@
+"""JSON responses for the Vercel functions in api/, compressed when the client accepts it."""
+import gzip
+import os
+
+from _codec import dumps
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+
+
+def compress(body, accept_encoding):
+    """(body, content-encoding or None): brotli or gzip when the client accepts it and the body is worth it."""
+    if len(body) < COMPRESS_MIN_SIZE:
+        return body, None
+    accepted = {}
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        params = params.strip()
+        try:
+            accepted[name.strip()] = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            accepted[name.strip()] = 0.0
+    if brotli is not None and accepted.get("br", accepted.get("*", 0)) > 0:
+        return brotli.compress(body, quality=5), "br"
+    if accepted.get("gzip", accepted.get("*", 0)) > 0:
+        return gzip.compress(body, 6, mtime=0), "gzip"
+    return body, None
+
+
+def send_json(handler, status, payload):
+    """Write a JSON response from a BaseHTTPRequestHandler, negotiating compression from Accept-Encoding."""
+    body, encoding = compress(dumps(payload), handler.headers.get("Accept-Encoding", ""))
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Access-Control-Allow-Origin", "*")
+    handler.send_header("Vary", "Accept-Encoding")
+    if encoding:
+        handler.send_header("Content-Encoding", encoding)
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
@@ -0,0 +1,410 @@
+"""YT-notes pipeline pieces shared by app.py and the /api/yt-notes Vercel function.
+
+The adaptive concurrency limiter, near-duplicate chunk detection and the
+outline map-reduce live here so both entry points run the same code.
+"""
+import hashlib
+import html
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from html.parser import HTMLParser
+
+from _codec import loads
+
+
+# ── Adaptive concurrency for upstream Sarvam calls ──────────────────────────
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limiter for parallel Sarvam calls, shared by every request in the process.
+    The limit grows by ~1 per round-trip while latency stays near the observed
+    baseline, and is cut multiplicatively on 429s or latency inflation.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=16,
+                 backoff=0.5, inflation_backoff=0.9, tolerance=2.0, wait_span=None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.inflation_backoff = inflation_backoff
+        self.tolerance = tolerance
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._baseline = None   # slowly-decaying minimum latency (seconds)
+        self._smoothed = None   # EWMA of recent latency (seconds)
+        self._samples = 0
+        self._throttled = 0
+        self._cond = threading.Condition()
+        # Context-manager factory wrapped around the wait for a slot (app.py passes its tracing span)
+        self.wait_span = wait_span or (lambda name, **attrs: nullcontext())
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self):
+        with self._cond:
+            while self._in_flight >= int(self._limit):
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self, latency, throttled=False):
+        with self._cond:
+            self._in_flight -= 1
+            self._samples += 1
+            if throttled:
+                self._throttled += 1
+                self._limit = max(self.min_limit, self._limit * self.backoff)
+            elif latency is not None:
+                if self._baseline is None or latency < self._baseline:
+                    self._baseline = latency
+                else:
+                    # Let the baseline drift up slowly so a permanently slower upstream isn't punished forever
+                    self._baseline += (latency - self._baseline) * 0.01
+                if self._smoothed is None:
+                    self._smoothed = latency
+                else:
+                    self._smoothed += (latency - self._smoothed) * 0.2
+
+                if self._smoothed > self._baseline * self.tolerance:
+                    self._limit = max(self.min_limit, self._limit * self.inflation_backoff)
+                else:
+                    self._limit = min(self.max_limit, self._limit + 1.0 / max(self._limit, 1.0))
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """Hold one concurrency slot; call ``outcome(status_code)`` once the response arrives."""
+        with self.wait_span('limiter.wait', limit=int(self._limit)):
+            self.acquire()
+        started = time.monotonic()
+        state = {'throttled': False, 'latency': None}
+
+        def outcome(status_code):
+            state['latency'] = time.monotonic() - started
+            state['throttled'] = status_code == 429
+
+        try:
+            yield outcome
+        finally:
+            # Connection errors/timeouts carry no useful latency signal; free the slot without adjusting
+            self.release(state['latency'], state['throttled'])
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'limit': int(self._limit),
+                'in_flight': self._in_flight,
+                'baseline_latency_ms': round(self._baseline * 1000) if self._baseline is not None else None,
+                'smoothed_latency_ms': round(self._smoothed * 1000) if self._smoothed is not None else None,
+                'samples': self._samples,
+                'throttled': self._throttled,
+            }
+
+
+# ── Near-duplicate chunk detection (MinHash + LSH) ───────────────────────────
+
+MINHASH_BINS = 64
+MINHASH_BANDS = 16            # 16 bands x 4 bins: pairs above ~0.5 Jaccard almost always share a band
+MINHASH_SHINGLE_WORDS = 5
+CHUNK_DUPLICATE_THRESHOLD = float(os.getenv("YT_NOTES_DUPLICATE_THRESHOLD", "0.7"))
+
+
+def minhash_signature(text):
+    """
+    One-permutation MinHash over lowercase word shingles: each shingle is hashed
+    once and kept only if it is the minimum of its bin (-1 marks an empty bin).
+    Returns None when the text is too short to compare.
+    """
+    words = re.findall(r"[a-z0-9']+", text.lower())
+    if len(words) < MINHASH_SHINGLE_WORDS:
+        return None
+    sig = [-1] * MINHASH_BINS
+    for i in range(len(words) - MINHASH_SHINGLE_WORDS + 1):
+        shingle = ' '.join(words[i:i + MINHASH_SHINGLE_WORDS]).encode()
+        h = int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), 'big')
+        b, v = h % MINHASH_BINS, h // MINHASH_BINS
+        if sig[b] == -1 or v < sig[b]:
+            sig[b] = v
+    return tuple(sig)
+
+
+def minhash_similarity(a, b):
+    """Estimated Jaccard similarity; bins empty in both signatures carry no information."""
+    matches = informative = 0
+    for x, y in zip(a, b):
+        if x == -1 and y == -1:
+            continue
+        informative += 1
+        matches += x == y
+    return matches / informative if informative else 0.0
+
+
+def dedupe_chunks(chunks, threshold=None):
+    """
+    Drop chunks that are near-duplicates of an earlier chunk in the same video
+    (intros, recaps, sponsor reads, caption loops) before they reach Sarvam.
+    Returns (unique_chunks, report).
+    """
+    threshold = CHUNK_DUPLICATE_THRESHOLD if threshold is None else threshold
+    rows = MINHASH_BINS // MINHASH_BANDS
+    buckets = {}
+    kept_signatures = []
+    unique = []
+    duplicates = []
+
+    for idx, chunk in enumerate(chunks):
+        sig = minhash_signature(chunk)
+        if sig is not None:
+            bands = [(b, sig[b * rows:(b + 1) * rows]) for b in range(MINHASH_BANDS)]
+            candidates = {k for band in bands for k in buckets.get(band, ())}
+            match = None
+            for k in sorted(candidates):
+                if minhash_similarity(sig, kept_signatures[k]) >= threshold:
+                    match = k
+                    break
+            if match is not None:
+                duplicates.append({'chunk': idx + 1, 'duplicate_of': unique[match][0] + 1})
+                continue
+            for band in bands:
+                buckets.setdefault(band, []).append(len(unique))
+        kept_signatures.append(sig)
+        unique.append((idx, chunk))
+
+    report = {
+        'total_chunks': len(chunks),
+        'unique_chunks': len(unique),
+        'upstream_calls_avoided': len(duplicates),
+        'duplicates': duplicates,
+    }
+    return [chunk for _, chunk in unique], report
+
+
+# ── Outline map-reduce ──────────────────────────────────────────────────────
+# The map stage asks Sarvam for a small JSON outline per chunk; outlines are
+# merged pairwise (same-headed sections fold together, repeated points and
+# terms drop out) and rendered to HTML once at the end. Replies that aren't
+# JSON are converted to the same structured form from their text, so outlines
+# only ever carry plain strings and the renderer escapes all of them.
+
+def get_notes_outline_prompt(chunk_idx, total_chunks):
+    return (
+        "You are an expert academic tutor extracting study notes from a transcript. "
+        f"You are processing piece {chunk_idx} of {total_chunks}; other pieces are handled separately and merged later.\n"
+        "CRITICAL INSTRUCTIONS:\n"
+        "1. Respond with ONLY a JSON object, no markdown fences and no prose, in exactly this shape:\n"
+        '{"sections": [{"heading": "Short topic heading", "points": ["Concise fact or explanation"]}], '
+        '"terms": [{"term": "Key term", "definition": "One-line definition"}]}\n'
+        "2. Use generic topic headings (e.g. 'Newton's Second Law', not 'Part 3') so matching topics from other pieces merge.\n"
+        "3. Points are short, self-contained sentences in English. Mark key words with **double asterisks**.\n"
+        "4. DO NOT mention the words 'video', 'speaker', or 'lecture'. Skip greetings, recaps and sponsor messages.\n"
+        "5. Do not repeat a point; prefer 3-6 points per section."
+    )
+
+
+def parse_notes_outline(text):
+    """Parse a map-stage reply into an outline dict, or None if it isn't usable JSON."""
+    if not text:
+        return None
+    text = re.sub(r'```(?:json|JSON)?\s*\n?', '', text).strip()
+    candidates = [text]
+    first, last = text.find('{'), text.rfind('}')
+    if first != -1 and last > first:
+        candidates.append(text[first:last + 1])
+    for candidate in candidates:
+        try:
+            parsed = loads(candidate)
+        except ValueError:
+            continue
+        # Require one of the outline keys, so stray braces in an HTML reply (CSS, say) don't parse as an empty outline
+        if (isinstance(parsed, dict) and ('sections' in parsed or 'terms' in parsed)
+                and isinstance(parsed.get('sections', []), list)):
+            return {
+                'sections': [
+                    {'heading': str(sec.get('heading', '')).strip(),
+                     'points': [str(p).strip() for p in sec.get('points', []) if str(p).strip()]}
+                    for sec in parsed.get('sections', []) if isinstance(sec, dict)
+                ],
+                'terms': [
+                    {'term': str(t.get('term', '')).strip(), 'definition': str(t.get('definition', '')).strip()}
+                    for t in parsed.get('terms', []) if isinstance(t, dict) and t.get('term')
+                ],
+            }
+    return None
+
+
+def validate_client_outline(outline):
+    """Check an outline posted back by a client and return a clean copy, or raise ValueError.
+
+    ``{'html': ...}`` sections (sent by clients that predate the structured
+    fallback) are reduced to their text with outline_from_html, never rendered as markup.
+    """
+    if not isinstance(outline, dict) or not isinstance(outline.get('sections'), list):
+        raise ValueError('each outline must be an object with a "sections" list')
+    sections = []
+    for sec in outline['sections']:
+        if isinstance(sec, dict) and 'html' in sec:
+            if not isinstance(sec['html'], str):
+                raise ValueError('"html" sections must be strings')
+            sections.extend(outline_from_html(sec['html'])['sections'])
+            continue
+        if not (isinstance(sec, dict) and isinstance(sec.get('heading'), str)
+                and isinstance(sec.get('points'), list)
+                and all(isinstance(p, str) for p in sec['points'])):
+            raise ValueError('each section needs a string "heading" and a list of string "points"')
+        sections.append({'heading': sec['heading'], 'points': list(sec['points'])})
+    terms = outline.get('terms', [])
+    if not isinstance(terms, list):
+        raise ValueError('"terms" must be a list')
+    for term in terms:
+        if not (isinstance(term, dict) and isinstance(term.get('term'), str)
+                and isinstance(term.get('definition'), str)):
+            raise ValueError('each term needs a string "term" and "definition"')
+    return {
+        'sections': sections,
+        'terms': [{'term': t['term'], 'definition': t['definition']} for t in terms],
+    }
+
+
+def _outline_key(text):
+    return ' '.join(re.findall(r'[a-z0-9]+', text.replace('**', '').lower()))
+
+
+def merge_outlines(left, right):
+    """Merge two outlines, folding same-headed sections together and dropping repeated points/terms."""
+    sections = []
+    by_heading = {}
+    seen_points = {}
+    for sec in left['sections'] + right['sections']:
+        key = _outline_key(sec['heading'])
+        target = by_heading.get(key)
+        if target is None:
+            target = {'heading': sec['heading'], 'points': []}
+            by_heading[key] = target
+            seen_points[key] = set()
+            sections.append(target)
+        for point in sec['points']:
+            pkey = _outline_key(point)
+            if pkey and pkey not in seen_points[key]:
+                seen_points[key].add(pkey)
+                target['points'].append(point)
+
+    terms = []
+    seen_terms = set()
+    for term in left['terms'] + right['terms']:
+        tkey = _outline_key(term['term'])
+        if tkey and tkey not in seen_terms:
+            seen_terms.add(tkey)
+            terms.append(term)
+    return {'sections': sections, 'terms': terms}
+
+
+def reduce_outlines(outlines):
+    """Tree-reduce outlines pairwise in order, so merge depth is log2(N) rather than N."""
+    level = [o for o in outlines if o]
+    if not level:
+        return {'sections': [], 'terms': []}
+    while len(level) > 1:
+        level = [
+            merge_outlines(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+    return level[0]
+
+
+def _outline_inline_html(text):
+    escaped = html.escape(text, quote=False)
+    return re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', escaped)
+
+
+def render_outline_html(outline):
+    parts = []
+    for sec in outline['sections']:
+        if not sec['points']:
+            continue
+        if sec['heading']:
+            parts.append(f"<h2>{_outline_inline_html(sec['heading'])}</h2>")
+        parts.append('<ul>' + ''.join(f"<li>{_outline_inline_html(p)}</li>" for p in sec['points']) + '</ul>')
+    if outline['terms']:
+        parts.append('<h2>Key Terms</h2>')
+        parts.append('<ul>' + ''.join(
+            f"<li><strong>{_outline_inline_html(t['term'])}</strong>: {_outline_inline_html(t['definition'])}</li>"
+            for t in outline['terms']
+        ) + '</ul>')
+    return '\n'.join(parts)
+
+
+class _OutlineTextParser(HTMLParser):
+    """Collect heading and block text from an HTML (or plain-text) reply, keeping <strong> as **bold**."""
+
+    HEADINGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+    BLOCKS = {'p', 'li', 'dt', 'dd', 'td', 'th', 'blockquote', 'pre', 'div', 'br', 'tr'}
+    SKIPPED = {'script', 'style', 'head', 'title'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.sections = [{'heading': '', 'points': []}]
+        self._buffer = []
+        self._skip = 0
+
+    def _text(self):
+        text = ''.join(self._buffer)
+        self._buffer = []
+        return text
+
+    def _flush_points(self):
+        for line in self._text().splitlines():
+            line = ' '.join(line.split())
+            if line and line != '****':
+                self.sections[-1]['points'].append(line)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED:
+            self._skip += 1
+        elif tag in self.HEADINGS or tag in self.BLOCKS:
+            self._flush_points()
+        elif tag in ('strong', 'b'):
+            self._buffer.append('**')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED:
+            self._skip = max(0, self._skip - 1)
+        elif tag in self.HEADINGS:
+            heading = ' '.join(self._text().replace('**', '').split())
+            if heading:
+                self.sections.append({'heading': heading, 'points': []})
+        elif tag in self.BLOCKS:
+            self._flush_points()
+        elif tag in ('strong', 'b'):
+            self._buffer.append('**')
+
+    def handle_data(self, data):
+        if not self._skip:
+            self._buffer.append(data)
+
+
+def outline_from_html(text):
+    """Structured outline from the text of an HTML or plain-text reply; markup itself is discarded."""
+    parser = _OutlineTextParser()
+    parser.feed(text.replace('```html', '').replace('```', ''))
+    parser.close()
+    parser._flush_points()
+    return {'sections': [sec for sec in parser.sections if sec['points']], 'terms': []}
+
+
+def is_chunk_error(result):
+    """True for an empty map-stage result or one of get_sarvam_notes' "[Error ...]" strings."""
+    return not result or result.startswith('[Error') or result.startswith('% [Error')
+
+
+def outline_from_chunk_result(result):
+    """Turn a map-stage reply into an outline; None for failed chunks (see is_chunk_error)."""
+    if is_chunk_error(result):
+        return None
+    parsed = parse_notes_outline(result)
+    if parsed is not None:
+        return parsed
+    return outline_from_html(result)
@@ -1,14 +1,23 @@
 """Vercel Serverless Function for /api/generate"""
 from http.server import BaseHTTPRequestHandler
-import json
 import requests
 import re
 import time
 import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _budget import DIAGRAM_MAX_TOKENS, messages_tokens, send_over_budget  # noqa: E402
+from _codec import dumps, loads  # noqa: E402
+from _http import send_json  # noqa: E402
 
 # ── Sarvam M API Configuration ──────────────────────────────────────────────
 SARVAM_API_KEY = os.getenv("SARVAM_API_KEY", "").strip('"\' ')
-SARVAM_API_URL = "https://api.sarvam.ai/v1/chat/completions"
+SARVAM_API_URL = os.getenv("SARVAM_API_URL", "https://api.sarvam.ai/v1/chat/completions")
+SARVAM_MODEL = os.getenv("SARVAM_MODEL", "sarvam-m")
+
+# ── Prompt-token budget (estimator shared with app.py via _budget.py) ───────
+MAX_INPUT_TOKENS = int(os.getenv("GENERATE_MAX_INPUT_TOKENS", "4096"))
 
 MERMAID_SYSTEM_PROMPTS = {
     'flowchart': """You are an expert Mermaid flowchart generator. You ONLY output valid, pristine Mermaid JS syntax.
@@ -493,17 +502,13 @@ class handler(BaseHTTPRequestHandler):
         try:
             content_length = int(self.headers.get('Content-Length', 0))
             body = self.rfile.read(content_length)
-            data = json.loads(body)
+            data = loads(body)
 
             user_prompt = data.get('prompt', '')
             mode = data.get('mode', 'flowchart')
 
             if not user_prompt.strip():
-                self.send_response(400)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'error': 'Please provide a description.'}).encode())
+                send_json(self, 400, {'error': 'Please provide a description.'})
                 return
 
             system_prompt = MERMAID_SYSTEM_PROMPTS.get(mode, MERMAID_SYSTEM_PROMPTS['flowchart'])
@@ -511,14 +516,21 @@ class handler(BaseHTTPRequestHandler):
                 'Content-Type': 'application/json',
                 'api-subscription-key': SARVAM_API_KEY
             }
+            messages = [
+                {'role': 'system', 'content': system_prompt},
+                {'role': 'user', 'content': f"Generate a {mode} diagram in Mermaid JS for: {user_prompt}"}
+            ]
+            estimated = messages_tokens(messages)
+
+            if estimated > MAX_INPUT_TOKENS:
+                send_over_budget(self, estimated, MAX_INPUT_TOKENS)
+                return
+
             payload = {
-                'model': 'sarvam-m',
-                'messages': [
-                    {'role': 'system', 'content': system_prompt},
-                    {'role': 'user', 'content': f"Generate a {mode} diagram in Mermaid JS for: {user_prompt}"}
-                ],
+                'model': SARVAM_MODEL,
+                'messages': messages,
                 'temperature': 0.3,
-                'max_tokens': 2048
+                'max_tokens': DIAGRAM_MAX_TOKENS.get(mode, 2048)
             }
 
             MAX_RETRIES = 3
@@ -526,19 +538,15 @@ class handler(BaseHTTPRequestHandler):
             result = None
             for attempt in range(1, MAX_RETRIES + 1):
                 try:
-                    response = requests.post(SARVAM_API_URL, headers=headers, json=payload, timeout=60)
+                    response = requests.post(SARVAM_API_URL, headers=headers, data=dumps(payload), timeout=60)
                     if response.status_code != 200:
                         if response.status_code in (429, 500, 502, 503, 504) and attempt < MAX_RETRIES:
                             time.sleep(2 ** attempt)
                             continue
-                        self.send_response(502)
-                        self.send_header('Content-Type', 'application/json')
-                        self.send_header('Access-Control-Allow-Origin', '*')
-                        self.end_headers()
-                        self.wfile.write(json.dumps({'error': f'AI service returned status {response.status_code}'}).encode())
+                        send_json(self, 502, {'error': f'AI service returned status {response.status_code}'})
                         return
 
-                    result = response.json()
+                    result = loads(response.content)
                     content = result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
                     if not content and attempt < MAX_RETRIES:
                         time.sleep(2 ** attempt)
@@ -552,29 +560,17 @@ class handler(BaseHTTPRequestHandler):
                     raise
 
             if not bridge_code:
-                self.send_response(502)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'error': 'Failed to generate diagram after multiple attempts.'}).encode())
+                send_json(self, 502, {'error': 'Failed to generate diagram after multiple attempts.'})
                 return
 
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            send_json(self, 200, {
                 'success': True,
                 'code': bridge_code,
                 'usage': result.get('usage', {}) if result else {}
-            }).encode())
+            })
 
         except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'error': f'Server error: {str(e)}'}).encode())
+            send_json(self, 500, {'error': f'Server error: {str(e)}'})
 
     def do_OPTIONS(self):
         self.send_response(200)
@@ -5,10 +5,21 @@ import requests
 import re
 import time
 import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _budget import drop_oldest_turns, messages_tokens, send_over_budget  # noqa: E402
+from _codec import dumps, loads  # noqa: E402
+from _http import send_json  # noqa: E402
 
 # ── Sarvam M API Configuration ──────────────────────────────────────────────
 SARVAM_API_KEY = os.getenv("SARVAM_API_KEY", "").strip('"\' ')
-SARVAM_API_URL = "https://api.sarvam.ai/v1/chat/completions"
+SARVAM_API_URL = os.getenv("SARVAM_API_URL", "https://api.sarvam.ai/v1/chat/completions")
+SARVAM_MODEL = os.getenv("SARVAM_MODEL", "sarvam-m")
+
+# ── Prompt-token budget (estimator shared with app.py via _budget.py) ───────
+MAX_INPUT_TOKENS = int(os.getenv("LAW_CHAT_MAX_INPUT_TOKENS", "8192"))
+
 
 LAW_SYSTEM_PROMPT = """You are an AI legal assistant specializing in Indian law. Your goal is to help users with legal issues, such as harassment, unjust fees, consumer rights, etc.
 
@@ -57,17 +68,13 @@ class handler(BaseHTTPRequestHandler):
         try:
             content_length = int(self.headers.get('Content-Length', 0))
             body = self.rfile.read(content_length)
-            data = json.loads(body)
+            data = loads(body)
 
             user_prompt = data.get('prompt', '')
             chat_history = data.get('history', [])
 
             if not user_prompt.strip():
-                self.send_response(400)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'error': 'Please provide a message.'}).encode())
+                send_json(self, 400, {'error': 'Please provide a message.'})
                 return
 
             headers = {
@@ -91,8 +98,16 @@ class handler(BaseHTTPRequestHandler):
             if last_role != 'user' or messages[-1]['content'].strip() != user_prompt.strip():
                 messages.append({'role': 'user', 'content': user_prompt})
 
+            # Drop the oldest turns (never the system prompt or the latest message) until it fits
+            messages = drop_oldest_turns(messages, MAX_INPUT_TOKENS)
+            estimated = messages_tokens(messages)
+
+            if estimated > MAX_INPUT_TOKENS:
+                send_over_budget(self, estimated, MAX_INPUT_TOKENS)
+                return
+
             payload = {
-                'model': 'sarvam-m',
+                'model': SARVAM_MODEL,
                 'messages': messages,
                 'temperature': 0.3,
                 'max_tokens': 2048
@@ -103,42 +118,30 @@ class handler(BaseHTTPRequestHandler):
 
             for attempt in range(1, MAX_RETRIES + 1):
                 try:
-                    response = requests.post(SARVAM_API_URL, headers=headers, json=payload, timeout=90)
+                    response = requests.post(SARVAM_API_URL, headers=headers, data=dumps(payload), timeout=90)
 
                     if response.status_code != 200:
                         if response.status_code in (429, 500, 502, 503, 504) and attempt < MAX_RETRIES:
                             time.sleep(2 ** attempt)
                             continue
-                        self.send_response(502)
-                        self.send_header('Content-Type', 'application/json')
-                        self.send_header('Access-Control-Allow-Origin', '*')
-                        self.end_headers()
-                        self.wfile.write(json.dumps({'error': f'AI service returned status {response.status_code}'}).encode())
+                        send_json(self, 502, {'error': f'AI service returned status {response.status_code}'})
                         return
 
-                    response_text = response.text.strip()
-                    if not response_text:
+                    response_body = response.content
+                    if not response_body.strip():
                         if attempt < MAX_RETRIES:
                             time.sleep(2 ** attempt)
                             continue
-                        self.send_response(502)
-                        self.send_header('Content-Type', 'application/json')
-                        self.send_header('Access-Control-Allow-Origin', '*')
-                        self.end_headers()
-                        self.wfile.write(json.dumps({'error': 'AI service returned empty response.'}).encode())
+                        send_json(self, 502, {'error': 'AI service returned empty response.'})
                         return
 
                     try:
-                        result = json.loads(response_text)
+                        result = loads(response_body)
                     except json.JSONDecodeError:
                         if attempt < MAX_RETRIES:
                             time.sleep(2 ** attempt)
                             continue
-                        self.send_response(502)
-                        self.send_header('Content-Type', 'application/json')
-                        self.send_header('Access-Control-Allow-Origin', '*')
-                        self.end_headers()
-                        self.wfile.write(json.dumps({'error': 'AI service returned invalid response.'}).encode())
+                        send_json(self, 502, {'error': 'AI service returned invalid response.'})
                         return
 
                     choices = result.get('choices', [])
@@ -146,11 +149,7 @@ class handler(BaseHTTPRequestHandler):
                         if attempt < MAX_RETRIES:
                             time.sleep(2 ** attempt)
                             continue
-                        self.send_response(502)
-                        self.send_header('Content-Type', 'application/json')
-                        self.send_header('Access-Control-Allow-Origin', '*')
-                        self.end_headers()
-                        self.wfile.write(json.dumps({'error': 'AI returned no content.'}).encode())
+                        send_json(self, 502, {'error': 'AI returned no content.'})
                         return
 
                     law_response = choices[0]['message']['content'].strip()
@@ -161,19 +160,11 @@ class handler(BaseHTTPRequestHandler):
                     if attempt < MAX_RETRIES:
                         time.sleep(2 ** attempt)
                         continue
-                    self.send_response(504)
-                    self.send_header('Content-Type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'error': 'AI service timed out.'}).encode())
+                    send_json(self, 504, {'error': 'AI service timed out.'})
                     return
 
             if not law_response:
-                self.send_response(502)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'error': 'Failed to get response.'}).encode())
+                send_json(self, 502, {'error': 'Failed to get response.'})
                 return
 
             # Robust JSON extraction
@@ -182,7 +173,7 @@ class handler(BaseHTTPRequestHandler):
 
             parsed = None
             try:
-                parsed = json.loads(law_response)
+                parsed = loads(law_response)
             except json.JSONDecodeError:
                 pass
 
@@ -215,7 +206,7 @@ class handler(BaseHTTPRequestHandler):
                     if end_pos != -1:
                         json_str = law_response[first_brace:end_pos + 1]
                         try:
-                            parsed = json.loads(json_str)
+                            parsed = loads(json_str)
                         except json.JSONDecodeError:
                             pass
 
@@ -227,21 +218,13 @@ class handler(BaseHTTPRequestHandler):
                     "options": []
                 }
 
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            send_json(self, 200, {
                 'success': True,
                 'response': parsed
-            }).encode())
+            })
 
         except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'error': f'Server error: {str(e)}'}).encode())
+            send_json(self, 500, {'error': f'Server error: {str(e)}'})
 
     def do_OPTIONS(self):
         self.send_response(200)
@@ -1,14 +1,23 @@
 """Vercel Serverless Function for /api/refine"""
 from http.server import BaseHTTPRequestHandler
-import json
 import requests
 import re
 import time
 import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _budget import DIAGRAM_MAX_TOKENS, messages_tokens, send_over_budget, strip_mermaid_noise  # noqa: E402
+from _codec import dumps, loads  # noqa: E402
+from _http import send_json  # noqa: E402
 
 # ── Sarvam M API Configuration ──────────────────────────────────────────────
 SARVAM_API_KEY = os.getenv("SARVAM_API_KEY", "").strip('"\' ')
-SARVAM_API_URL = "https://api.sarvam.ai/v1/chat/completions"
+SARVAM_API_URL = os.getenv("SARVAM_API_URL", "https://api.sarvam.ai/v1/chat/completions")
+SARVAM_MODEL = os.getenv("SARVAM_MODEL", "sarvam-m")
+
+# ── Prompt-token budget (estimator shared with app.py via _budget.py) ───────
+MAX_INPUT_TOKENS = int(os.getenv("REFINE_MAX_INPUT_TOKENS", "8192"))
 
 MERMAID_SYSTEM_PROMPTS = {
     'flowchart': """You are an expert Mermaid flowchart code generator. You ONLY output valid Mermaid JS code. Do NOT use markdown code fences. SUBGRAPHS MUST be closed with the exact word 'end' on a new line. NEVER use 'end subgraph'. Do NOT use parentheses inside labels.""",
@@ -240,18 +249,14 @@ class handler(BaseHTTPRequestHandler):
         try:
             content_length = int(self.headers.get('Content-Length', 0))
             body = self.rfile.read(content_length)
-            data = json.loads(body)
+            data = loads(body)
 
             current_code = data.get('current_code', '')
             instruction = data.get('instruction', '')
             mode = data.get('mode', 'flowchart')
 
             if not instruction.strip():
-                self.send_response(400)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'error': 'Please provide a refinement instruction.'}).encode())
+                send_json(self, 400, {'error': 'Please provide a refinement instruction.'})
                 return
 
             system_prompt = MERMAID_SYSTEM_PROMPTS.get(mode, MERMAID_SYSTEM_PROMPTS['flowchart'])
@@ -259,46 +264,47 @@ class handler(BaseHTTPRequestHandler):
                 'Content-Type': 'application/json',
                 'api-subscription-key': SARVAM_API_KEY
             }
-            payload = {
-                'model': 'sarvam-m',
-                'messages': [
+            def refine_messages(code):
+                return [
                     {'role': 'system', 'content': system_prompt},
-                    {'role': 'user', 'content': f"Here is my current {mode} diagram code:\n{current_code}\n\nPlease modify it with this instruction: {instruction}\n\nOutput ONLY the complete updated Mermaid JS code."}
-                ],
+                    {'role': 'user', 'content': f"Here is my current {mode} diagram code:\n{code}\n\nPlease modify it with this instruction: {instruction}\n\nOutput ONLY the complete updated Mermaid JS code."}
+                ]
+
+            messages = refine_messages(current_code)
+            estimated = messages_tokens(messages)
+            if estimated > MAX_INPUT_TOKENS:
+                messages = refine_messages(strip_mermaid_noise(current_code))
+                estimated = messages_tokens(messages)
+
+            if estimated > MAX_INPUT_TOKENS:
+                send_over_budget(self, estimated, MAX_INPUT_TOKENS)
+                return
+
+            payload = {
+                'model': SARVAM_MODEL,
+                'messages': messages,
                 'temperature': 0.3,
-                'max_tokens': 2048
+                'max_tokens': DIAGRAM_MAX_TOKENS.get(mode, 2048)
             }
 
-            response = requests.post(SARVAM_API_URL, headers=headers, json=payload, timeout=60)
+            response = requests.post(SARVAM_API_URL, headers=headers, data=dumps(payload), timeout=60)
 
             if response.status_code != 200:
-                self.send_response(502)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'error': f'AI service returned status {response.status_code}'}).encode())
+                send_json(self, 502, {'error': f'AI service returned status {response.status_code}'})
                 return
 
-            result = response.json()
+            result = loads(response.content)
             bridge_code = result['choices'][0]['message']['content'].strip()
             bridge_code = clean_mermaid_code(bridge_code, mode)
 
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            send_json(self, 200, {
                 'success': True,
                 'code': bridge_code,
                 'usage': result.get('usage', {})
-            }).encode())
+            })
 
         except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'error': f'Server error: {str(e)}'}).encode())
+            send_json(self, 500, {'error': f'Server error: {str(e)}'})
 
     def do_OPTIONS(self):
         self.send_response(200)
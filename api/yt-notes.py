@@ -1,16 +1,37 @@
 """Vercel Serverless Function for /api/yt-notes"""
 from http.server import BaseHTTPRequestHandler
 import concurrent.futures
-import json
 import os
 import re
+import sys
 import time
 
 import requests
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _budget import NOTES_PROMPT_RESERVE, estimate_tokens, over_budget_body, split_chunk_to_budget  # noqa: E402
+from _codec import dumps, loads  # noqa: E402
+from _http import send_json  # noqa: E402
+from _notes import (  # noqa: E402
+    AdaptiveConcurrencyLimiter, dedupe_chunks, get_notes_outline_prompt, is_chunk_error, outline_from_chunk_result,
+    reduce_outlines, render_outline_html, validate_client_outline,
+)
 
 SARVAM_API_KEY = os.getenv("SARVAM_API_KEY", "").strip('"\' ')
-SARVAM_API_URL = "https://api.sarvam.ai/v1/chat/completions"
+SARVAM_API_URL = os.getenv("SARVAM_API_URL", "https://api.sarvam.ai/v1/chat/completions")
+SARVAM_MODEL = os.getenv("SARVAM_MODEL", "sarvam-m")
+SUPADATA_API_URL = os.getenv("SUPADATA_API_URL", "https://api.supadata.ai").rstrip("/")
+
+# ── Prompt-token budget (estimator shared with app.py via _budget.py) ───────
+MAX_INPUT_TOKENS = int(os.getenv("YT_NOTES_MAX_INPUT_TOKENS", "4096"))
+NOTES_MAX_CHUNK_SPLIT = int(os.getenv("YT_NOTES_MAX_CHUNK_SPLIT", "4"))
+
+
+# Start modest in serverless; the limiter grows it while Sarvam latency stays flat
+SARVAM_NOTES_LIMITER = AdaptiveConcurrencyLimiter(
+    initial=int(os.getenv("YT_NOTES_INITIAL_CONCURRENCY", "3")),
+    max_limit=int(os.getenv("YT_NOTES_MAX_CONCURRENCY", "8")),
+)
 
 
 def extract_video_id(url: str):
@@ -42,14 +63,14 @@ def chunk_text(text: str, max_length: int = 1400):
 
 def fetch_transcript_from_supadata(video_id: str):
     supadata_key = "sd_14a060fc8a6b311244d92b1661d00fe5"
-    url = f"https://api.supadata.ai/v1/transcript?url=https://www.youtube.com/watch?v={video_id}&text=true"
+    url = f"{SUPADATA_API_URL}/v1/transcript?url=https://www.youtube.com/watch?v={video_id}&text=true"
     headers = {"x-api-key": supadata_key}
     
     response = requests.get(url, headers=headers, timeout=30)
     if response.status_code != 200:
         raise Exception(f"Supadata API Error {response.status_code}")
     
-    data = response.json()
+    data = loads(response.content)
     if "content" in data:
         return data["content"]
     elif "text" in data:
@@ -57,7 +78,8 @@ def fetch_transcript_from_supadata(video_id: str):
     else:
         return str(data)
 
-def get_sarvam_notes(chunk: str, chunk_idx: int, total_chunks: int, attempt: int = 1) -> str:
+
+def get_sarvam_notes(chunk: str, chunk_idx: int, total_chunks: int, attempt: int = 1, outline: bool = False) -> str:
     if not SARVAM_API_KEY:
         return "[Error: SARVAM_API_KEY is not set on the server]"
 
@@ -66,36 +88,45 @@ def get_sarvam_notes(chunk: str, chunk_idx: int, total_chunks: int, attempt: int
         "api-subscription-key": SARVAM_API_KEY,
     }
     
-    system_prompt = (
-        "You are an expert academic tutor creating highly professional educational notes from a transcript. "
-        f"You are processing piece {chunk_idx} of {total_chunks}. "
-        "CRITICAL INSTRUCTIONS:\n"
-        "1. Write the notes in English using a highly professional, academic textbook tone. It must be organized for optimal memorization and learning.\n"
-        "2. DO NOT mention the words 'video', 'speaker', or 'lecture'. It must read strictly like a standalone textbook.\n"
-        "3. Provide your output as a beautiful, fully-styled HTML component. Use inline CSS or a <style> block to make it look like a stunning, modern academic document (white background, professional fonts like Inter/Roboto, elegant headings with colored accents, beautiful tables or quote blocks if needed).\n"
-        "4. Output ONLY valid, beautifully formatted HTML and CSS. Structure logically with <h2>, <h3>, <ul>, <p>, etc.\n"
-        "5. DO NOT wrap your response in markdown code blocks like ```html. Output raw HTML text only."
-    )
+    if outline:
+        system_prompt = get_notes_outline_prompt(chunk_idx, total_chunks)
+        user_content = f"Generate a compact JSON outline of notes for this transcript segment: {chunk}"
+        max_tokens = 1024
+    else:
+        system_prompt = (
+            "You are an expert academic tutor creating highly professional educational notes from a transcript. "
+            f"You are processing piece {chunk_idx} of {total_chunks}. "
+            "CRITICAL INSTRUCTIONS:\n"
+            "1. Write the notes in English using a highly professional, academic textbook tone. It must be organized for optimal memorization and learning.\n"
+            "2. DO NOT mention the words 'video', 'speaker', or 'lecture'. It must read strictly like a standalone textbook.\n"
+            "3. Provide your output as a beautiful, fully-styled HTML component. Use inline CSS or a <style> block to make it look like a stunning, modern academic document (white background, professional fonts like Inter/Roboto, elegant headings with colored accents, beautiful tables or quote blocks if needed).\n"
+            "4. Output ONLY valid, beautifully formatted HTML and CSS. Structure logically with <h2>, <h3>, <ul>, <p>, etc.\n"
+            "5. DO NOT wrap your response in markdown code blocks like ```html. Output raw HTML text only."
+        )
+        user_content = f"Generate detailed notes for this transcript segment: {chunk}"
+        max_tokens = 2048
 
     payload = {
-        "model": "sarvam-m",
+        "model": SARVAM_MODEL,
         "messages": [
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Generate detailed notes for this transcript segment: {chunk}"},
+            {"role": "user", "content": user_content},
         ],
         "temperature": 0.3,
-        "max_tokens": 2048,
+        "max_tokens": max_tokens,
     }
 
     try:
-        response = requests.post(SARVAM_API_URL, headers=headers, json=payload, timeout=60)
+        with SARVAM_NOTES_LIMITER.slot() as outcome:
+            response = requests.post(SARVAM_API_URL, headers=headers, data=dumps(payload), timeout=60)
+            outcome(response.status_code)
         if response.status_code == 200:
-            result = response.json()
+            result = loads(response.content)
             return result.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
 
         if attempt < 3 and response.status_code in (429, 500, 502, 503, 504):
             time.sleep(2**attempt)
-            return get_sarvam_notes(chunk, chunk_idx, total_chunks, attempt + 1)
+            return get_sarvam_notes(chunk, chunk_idx, total_chunks, attempt + 1, outline)
 
         detail = ""
         try:
@@ -108,7 +139,7 @@ def get_sarvam_notes(chunk: str, chunk_idx: int, total_chunks: int, attempt: int
     except Exception as e:
         if attempt < 3:
             time.sleep(2**attempt)
-            return get_sarvam_notes(chunk, chunk_idx, total_chunks, attempt + 1)
+            return get_sarvam_notes(chunk, chunk_idx, total_chunks, attempt + 1, outline)
         return f"% [Error connecting to AI: {str(e)}]"
 
 
@@ -117,7 +148,7 @@ class handler(BaseHTTPRequestHandler):
         try:
             content_length = int(self.headers.get("Content-Length", 0))
             body = self.rfile.read(content_length)
-            data = json.loads(body) if body else {}
+            data = loads(body) if body else {}
 
             action = data.get("action", "full")
             
@@ -126,55 +157,87 @@ class handler(BaseHTTPRequestHandler):
                 chunk_idx = data.get('chunk_idx', 1)
                 total_chunks = data.get('total_chunks', 1)
                 if not SARVAM_API_KEY:
-                    self._json(500, {'error': 'Server is missing SARVAM_API_KEY. Set it in environment.'})
+                    send_json(self, 500, {'error': 'Server is missing SARVAM_API_KEY. Set it in environment.'})
                     return
                 
-                result = get_sarvam_notes(chunk, chunk_idx, total_chunks)
+                outline_mode = data.get('format') == 'outline'
+                # Client-chosen chunk sizes: split anything over the input budget instead of sending it whole
+                limit = MAX_INPUT_TOKENS - NOTES_PROMPT_RESERVE
+                pieces = split_chunk_to_budget(chunk, limit, NOTES_MAX_CHUNK_SPLIT)
+                if pieces is None:
+                    send_json(self, 413, over_budget_body(estimate_tokens(chunk), limit * NOTES_MAX_CHUNK_SPLIT))
+                    return
+                results = [get_sarvam_notes(piece, chunk_idx, total_chunks, 1, outline_mode) for piece in pieces]
+                result = '\n'.join(results)
                 if "invalid_api_key_error" in result or "SARVAM_API_KEY" in result:
-                    self._json(502, {'error': 'Sarvam authentication failed.', 'html': result})
+                    send_json(self, 502, {'error': 'Sarvam authentication failed.', 'html': result})
+                    return
+                if any(is_chunk_error(r) for r in results):
+                    send_json(self, 502, {'error': f'Could not generate notes for chunk {chunk_idx}.', 'details': results})
+                    return
+
+                if outline_mode:
+                    outline = reduce_outlines([outline_from_chunk_result(r) for r in results])
+                    send_json(self, 200, {'success': True, 'outline': outline, 'html': result})
+                    return
+                send_json(self, 200, {'success': True, 'html': result})
+                return
+
+            if action == "reduce":
+                raw_outlines = data.get("outlines", [])
+                if not isinstance(raw_outlines, list):
+                    send_json(self, 400, {"error": "\"outlines\" must be a list."})
                     return
-                    
-                self._json(200, {'success': True, 'html': result})
+                try:
+                    outlines = [validate_client_outline(o) for o in raw_outlines if o is not None]
+                except ValueError as e:
+                    send_json(self, 400, {"error": f"Invalid outline: {e}."})
+                    return
+                notes = render_outline_html(reduce_outlines(outlines))
+                if not notes.strip():
+                    send_json(self, 502, {"error": "Failed to generate notes."})
+                    return
+                send_json(self, 200, {"success": True, "notes": notes})
                 return
 
             url = (data.get("url") or "").strip()
             if not url:
-                self._json(400, {"error": "Please provide a YouTube URL."})
+                send_json(self, 400, {"error": "Please provide a YouTube URL."})
                 return
 
             video_id = extract_video_id(url)
             if not video_id:
-                self._json(400, {"error": "Invalid YouTube URL or Video ID not found."})
+                send_json(self, 400, {"error": "Invalid YouTube URL or Video ID not found."})
                 return
 
             if not SARVAM_API_KEY:
-                self._json(500, {"error": "Server is missing SARVAM_API_KEY. Set it in Vercel environment variables."})
+                send_json(self, 500, {"error": "Server is missing SARVAM_API_KEY. Set it in Vercel environment variables."})
                 return
 
             try:
                 full_transcript = fetch_transcript_from_supadata(video_id)
                 if not full_transcript or len(str(full_transcript)) < 10:
-                    self._json(400, {"error": "Transcript was retrieved but contained no text."})
+                    send_json(self, 400, {"error": "Transcript was retrieved but contained no text."})
                     return
             except Exception as e:
-                self._json(400, {"error": f"Could not extract transcript: {str(e)}"})
+                send_json(self, 400, {"error": f"Could not extract transcript: {str(e)}"})
                 return
 
-            chunks = chunk_text(full_transcript, 500)
+            chunks, dedup_report = dedupe_chunks(chunk_text(full_transcript, 500))
             if not chunks:
-                self._json(400, {"error": "No transcript text to process."})
+                send_json(self, 400, {"error": "No transcript text to process."})
                 return
-            
+
             if action == 'extract':
-                self._json(200, {'success': True, 'chunks': chunks, 'total_chunks': len(chunks)})
+                send_json(self, 200, {'success': True, 'chunks': chunks, 'total_chunks': len(chunks), 'dedup': dedup_report})
                 return
 
             total_chunks = len(chunks)
-            # Keep concurrency modest in serverless
-            max_workers = 3 if total_chunks > 1 else 1
+            # Real parallelism is governed by SARVAM_NOTES_LIMITER
+            max_workers = min(SARVAM_NOTES_LIMITER.max_limit, total_chunks)
             results = [None] * total_chunks
             with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                future_to_idx = {executor.submit(get_sarvam_notes, chunk, i+1, total_chunks): i for i, chunk in enumerate(chunks)}
+                future_to_idx = {executor.submit(get_sarvam_notes, chunk, i+1, total_chunks, 1, True): i for i, chunk in enumerate(chunks)}
                 for future in concurrent.futures.as_completed(future_to_idx):
                     i = future_to_idx[future]
                     try:
@@ -185,25 +248,28 @@ class handler(BaseHTTPRequestHandler):
                     except Exception:
                         results[i] = f"[Error processing chunk {i + 1}]"
 
-            notes = "\n\n".join([r for r in results if r])
-
-            if not notes.strip():
-                self._json(502, {"error": "Failed to generate notes."})
-                return
+            # Reduce: merge the per-chunk outlines into one deduplicated document
+            notes = render_outline_html(reduce_outlines([outline_from_chunk_result(r) for r in results]))
 
             # Convert auth failures into a clean API error for the UI
-            if all(
+            if any(results) and all(
                 isinstance(r, str) and ("invalid_api_key_error" in r or "SARVAM_API_KEY" in r)
                 for r in results
                 if r
             ):
-                self._json(502, {"error": "Sarvam authentication failed. Check SARVAM_API_KEY."})
+                send_json(self, 502, {"error": "Sarvam authentication failed. Check SARVAM_API_KEY."})
+                return
+
+            if not notes.strip():
+                send_json(self, 502, {"error": "Failed to generate notes."})
                 return
 
-            self._json(200, {"success": True, "notes": notes})
+            failed_chunks = [i + 1 for i, r in enumerate(results) if is_chunk_error(r)]
+            send_json(self, 200, {"success": True, "notes": notes, "failed_chunks": failed_chunks,
+                             "concurrency": SARVAM_NOTES_LIMITER.snapshot(), "dedup": dedup_report})
 
         except Exception as e:
-            self._json(500, {"error": f"Server error: {str(e)}"})
+            send_json(self, 500, {"error": f"Server error: {str(e)}"})
 
     def do_OPTIONS(self):
         self.send_response(200)
@@ -212,10 +278,4 @@ class handler(BaseHTTPRequestHandler):
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
         self.end_headers()
 
-    def _json(self, status: int, payload: dict):
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-        self.wfile.write(json.dumps(payload).encode())
 
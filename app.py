@@ -1,12 +1,35 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, g, has_request_context, render_template, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from jinja2 import FileSystemLoader
 import requests
 import json
 import os
 import time
 import re
+import sqlite3
 import sys
+import atexit
+import bisect
 import concurrent.futures
+import contextvars
+import csv
+import datetime
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import logging
+import logging.handlers
+import math
+import mimetypes
+import queue
+import threading
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager
 
 # ── Fix Windows console Unicode encoding ─────────────────────────────────────
 # Windows cmd/powershell uses cp1252 by default which can't handle ₹, ™, etc.
@@ -18,16 +41,6 @@ except (AttributeError, OSError):
     pass  # Fallback for older Python versions
 
 
-def safe_print(*args, **kwargs):
-    """Print that won't crash on Unicode characters on Windows."""
-    try:
-        print(*args, **kwargs)
-    except UnicodeEncodeError:
-        # Fallback: encode to ascii replacing problem chars
-        text = ' '.join(str(a) for a in args)
-        print(text.encode('ascii', errors='replace').decode('ascii'), **kwargs)
-
-
 def _load_dotenv(path=".env"):
     """
     Minimal .env loader (KEY=VALUE) to avoid extra dependencies.
@@ -52,12 +65,2555 @@ def _load_dotenv(path=".env"):
 
 _load_dotenv()
 
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Helpers shared with the Vercel functions live in api/ as _-prefixed modules
+sys.path.insert(0, os.path.join(APP_DIR, 'api'))
+from _budget import (  # noqa: E402
+    DIAGRAM_MAX_TOKENS, NOTES_PROMPT_RESERVE, drop_oldest_turns, estimate_tokens, messages_tokens,
+    over_budget_body, split_chunk_to_budget, strip_mermaid_noise,
+)
+import _email  # noqa: E402
+from _email import (  # noqa: E402
+    RECIPIENT_SEPARATORS, RESEND_BATCH_SIZE, canonicalize_email, normalize_recipients, send_resend_batch,
+)
+from _notes import (  # noqa: E402
+    AdaptiveConcurrencyLimiter, dedupe_chunks, get_notes_outline_prompt, is_chunk_error, outline_from_chunk_result,
+    parse_notes_outline, reduce_outlines, render_outline_html, validate_client_outline,
+)
+
+
+# ── JSON codec ───────────────────────────────────────────────────────────────
+# One place for JSON encoding/decoding: Flask responses (app.json), NDJSON
+# streams, log lines and upstream request/response bodies. Uses orjson when it
+# is installed (JSON_BACKEND=stdlib forces the standard library). Upstream
+# bodies are decoded straight from response.content, skipping the str
+# round-trip through response.text. tools/bench_json.py compares the backends.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = 'orjson' if orjson is not None and os.getenv("JSON_BACKEND", "orjson") == 'orjson' else 'stdlib'
+
+if JSON_BACKEND == 'orjson':
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def json_dumps_bytes(obj, default=None):
+        return orjson.dumps(obj, default=default, option=_ORJSON_OPTIONS)
+
+    def json_loads(data):
+        """Parse JSON from bytes or str; raises json.JSONDecodeError (orjson's subclasses it)."""
+        return orjson.loads(data)
+else:
+    def json_dumps_bytes(obj, default=None):
+        return json.dumps(obj, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def json_loads(data):
+        """Parse JSON from bytes or str; raises json.JSONDecodeError."""
+        return json.loads(data)
+
+
+def json_dumps(obj, default=None):
+    return json_dumps_bytes(obj, default).decode('utf-8')
+
+
+def ndjson_line(obj):
+    return json_dumps_bytes(obj) + b'\n'
+
+
+class CodecJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by the codec above; responses are built from bytes without a str copy."""
+
+    def dumps(self, obj, **kwargs):
+        return json_dumps(obj, default=self.default)
+
+    def loads(self, s, **kwargs):
+        return json_loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(json_dumps_bytes(obj, default=self.default) + b'\n', mimetype=self.mimetype)
+
+
+# ── Structured logging ───────────────────────────────────────────────────────
+# Records are handed to a bounded queue and written as JSON lines by a
+# background thread, so request threads never block on stdout. When the queue
+# backs up, low-severity records are sampled and, once full, dropped.
+
+REQUEST_ID = contextvars.ContextVar('request_id', default=None)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_EVERY = 10    # under pressure, keep 1 in N records below WARNING
+
+_STANDARD_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'request_id': record.request_id,
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        # ASCII-only output also keeps Windows consoles from choking on ₹, ™, etc.
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: samples under pressure and drops when full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._pressure_seen = 0
+        self._high_water = int(log_queue.maxsize * 0.8)
+
+    def prepare(self, record):
+        # Formatting happens on the writer thread; only capture what is request-local here
+        record.request_id = REQUEST_ID.get()
+        return record
+
+    def enqueue(self, record):
+        if record.levelno < logging.WARNING and self.queue.qsize() >= self._high_water:
+            self._pressure_seen += 1
+            if self._pressure_seen % LOG_SAMPLE_EVERY:
+                self.dropped += 1
+                return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _configure_logging():
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonLineFormatter())
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    handler = DroppingQueueHandler(log_queue)
+    root = logging.getLogger('arka')
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(handler)
+    root.propagate = False
+    listener.start()
+    atexit.register(listener.stop)   # flush what's queued on shutdown
+    return handler
+
+
+LOG_HANDLER = _configure_logging()
+log = logging.getLogger('arka')
+
 app = Flask(__name__)
+app.json = CodecJSONProvider(app)
 CORS(app)
 
+
+# ── Response compression ─────────────────────────────────────────────────────
+# Text responses (JSON, NDJSON, SSE, HTML) are compressed with the best coding
+# the client accepts: zstd or brotli when those modules are installed, else
+# gzip. Bodies under COMPRESS_MIN_SIZE are sent as-is since small JSON gains
+# nothing. Streamed responses are compressed chunk by chunk with a sync flush
+# after each chunk, so every NDJSON line / SSE event still reaches the client
+# as soon as it is produced. Registered right after the app so it runs after
+# every other after_request hook.
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "1") != "0"
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "5"))
+COMPRESS_ZSTD_LEVEL = int(os.getenv("COMPRESS_ZSTD_LEVEL", "3"))
+COMPRESSIBLE_MIMETYPES = {
+    'application/json', 'application/x-ndjson', 'text/event-stream', 'text/html', 'text/plain',
+    'text/css', 'text/javascript', 'application/javascript', 'image/svg+xml',
+}
+
+# Server preference, best first; only codings whose module is importable are offered
+AVAILABLE_ENCODINGS = [name for name, module in (('zstd', zstandard), ('br', brotli), ('gzip', zlib)) if module is not None]
+
+
+def negotiate_encoding(accept_encoding, available=None):
+    """Pick a content coding from an Accept-Encoding header, or None for identity."""
+    available = AVAILABLE_ENCODINGS if available is None else available
+    accepted = {}
+    for part in (accept_encoding or '').lower().split(','):
+        name, _, params = part.strip().partition(';')
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip()] = q
+    best = None
+    for name in available:
+        q = accepted.get(name, accepted.get('*', 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (name, q)
+    return best[0] if best else None
+
+
+class StreamCompressor:
+    """Incremental compressor for one response; compress() returns bytes flushed to a block boundary."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self._obj = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)
+        elif encoding == 'br':
+            self._obj = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        elif encoding == 'zstd':
+            self._obj = zstandard.ZstdCompressor(level=COMPRESS_ZSTD_LEVEL).compressobj()
+        else:
+            raise ValueError(f"unsupported encoding {encoding!r}")
+
+    def compress(self, chunk):
+        if self.encoding == 'gzip':
+            return self._obj.compress(chunk) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == 'br':
+            return self._obj.process(chunk) + self._obj.flush()
+        return self._obj.compress(chunk) + self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._obj.finish()
+        return self._obj.flush()
+
+
+def compress_bytes(data, encoding):
+    """One-shot compression of a whole body."""
+    if encoding == 'gzip':
+        return gzip.compress(data, COMPRESS_GZIP_LEVEL, mtime=0)
+    if encoding == 'br':
+        return brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=COMPRESS_ZSTD_LEVEL).compress(data)
+    raise ValueError(f"unsupported encoding {encoding!r}")
+
+
+def _compress_stream(chunks, encoding):
+    compressor = StreamCompressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                yield compressor.compress(chunk)
+        yield compressor.finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def _add_vary(response, header):
+    vary = {v.strip().lower() for v in response.headers.get('Vary', '').split(',') if v.strip()}
+    if header.lower() not in vary:
+        response.headers.add('Vary', header)
+
+
+@app.after_request
+def _compress_response(response):
+    if (not COMPRESS_ENABLED or request.method == 'HEAD' or response.status_code < 200
+            or response.status_code in (204, 206, 304) or 'Content-Encoding' in response.headers
+            or response.direct_passthrough or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    _add_vary(response, 'Accept-Encoding')
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        compressed = compress_bytes(data, encoding)
+        if len(compressed) >= len(data):
+            return response
+        response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    METRICS.inc('arka_http_compressed_responses_total', encoding=encoding)
+    return response
+
+
+# ── Static asset fingerprinting ──────────────────────────────────────────────
+# At startup every file under static/ is content-hashed (js/app.js ->
+# js/app.<hash>.js). url_for('static', ...) and the literal "/static/..."
+# references in templates (rewritten once when Jinja loads each template, any
+# ?v= suffix dropped) point at the hashed names, which are served with
+# "immutable, max-age=1y" and a gzip/brotli variant negotiated from
+# Accept-Encoding. Variants come from .gz/.br siblings written by
+# tools/build_assets.py when present, otherwise they are compressed in memory
+# here. Unhashed URLs keep Flask's default revalidating behaviour, so pages
+# cached before a deploy still load.
+
+STATIC_FINGERPRINT = os.getenv("STATIC_FINGERPRINT", "1") != "0"
+ASSET_HASH_LENGTH = 10
+ASSET_MAX_AGE = 365 * 24 * 3600
+_HASHED_NAME = re.compile(r'^(?P<stem>.+)\.(?P<hash>[0-9a-f]{%d})(?P<ext>\.[^./]+)$' % ASSET_HASH_LENGTH)
+_STATIC_REF = re.compile(r'''(?P<q>["'])/static/(?P<path>[^"'?#]+)(?:\?[^"'#]*)?(?P=q)''')
+_PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+
+class StaticAsset:
+    def __init__(self, path, digest, mimetype, variants):
+        self.path = path                # relative to static/, e.g. 'js/app.js'
+        self.digest = digest
+        self.mimetype = mimetype
+        self.variants = variants        # encoding -> compressed bytes
+        stem, ext = os.path.splitext(path)
+        self.hashed = f"{stem}.{digest}{ext}"
+
+
+def build_asset_manifest(root):
+    """{relative path: StaticAsset} for every file under root, skipping precompressed siblings."""
+    manifest = {}
+    if not root or not os.path.isdir(root):
+        return manifest
+    for directory, _, files in os.walk(root):
+        for name in sorted(files):
+            full = os.path.join(directory, name)
+            rel = os.path.relpath(full, root).replace(os.sep, '/')
+            if name.endswith(('.gz', '.br')) or _HASHED_NAME.match(name):
+                continue
+            with open(full, 'rb') as f:
+                data = f.read()
+            mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            variants = {}
+            if mimetype in COMPRESSIBLE_MIMETYPES and len(data) >= COMPRESS_MIN_SIZE:
+                for encoding, suffix in _PRECOMPRESSED:
+                    sibling = full + suffix
+                    if os.path.exists(sibling) and os.path.getmtime(sibling) >= os.path.getmtime(full):
+                        with open(sibling, 'rb') as f:
+                            variants[encoding] = f.read()
+                    elif encoding in AVAILABLE_ENCODINGS:
+                        variants[encoding] = compress_bytes(data, encoding)
+                variants = {e: body for e, body in variants.items() if len(body) < len(data)}
+            digest = hashlib.sha256(data).hexdigest()[:ASSET_HASH_LENGTH]
+            manifest[rel] = StaticAsset(rel, digest, mimetype, variants)
+    return manifest
+
+
+STATIC_ASSETS = build_asset_manifest(app.static_folder) if STATIC_FINGERPRINT else {}
+_ASSETS_BY_HASHED = {asset.hashed: asset for asset in STATIC_ASSETS.values()}
+
+
+def asset_url(path):
+    """Public URL of a static file, fingerprinted when it is in the manifest."""
+    asset = STATIC_ASSETS.get(path)
+    return f"/static/{asset.hashed if asset else path}"
+
+
+def rewrite_static_refs(source):
+    """Point quoted "/static/..." references at the fingerprinted names."""
+    def replace(match):
+        asset = STATIC_ASSETS.get(match.group('path'))
+        if asset is None:
+            return match.group(0)
+        return f"{match.group('q')}/static/{asset.hashed}{match.group('q')}"
+    return _STATIC_REF.sub(replace, source)
+
+
+class FingerprintingLoader(FileSystemLoader):
+    """Template loader that rewrites static references as templates are (re)loaded."""
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        return rewrite_static_refs(source), filename, uptodate
+
+
+@app.url_defaults
+def _fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and values.get('filename') in STATIC_ASSETS:
+        values['filename'] = STATIC_ASSETS[values['filename']].hashed
+
+
+def serve_static(filename):
+    asset = _ASSETS_BY_HASHED.get(filename)
+    if asset is None:
+        return app.send_static_file(filename)
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding'), available=list(asset.variants))
+    if encoding is not None:
+        response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = app.send_static_file(asset.path)
+    response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(f"{asset.digest}-{encoding or 'identity'}")
+    return response.make_conditional(request)
+
+
+if STATIC_FINGERPRINT:
+    app.jinja_loader = FingerprintingLoader(os.path.join(app.root_path, app.template_folder))
+    app.view_functions['static'] = serve_static
+
+
+@app.before_request
+def _assign_request_id():
+    # Honour an upstream proxy's ID so logs correlate end to end
+    g.request_id = (request.headers.get('X-Request-ID') or uuid.uuid4().hex)[:64]
+    REQUEST_ID.set(g.request_id)
+
+
+@app.after_request
+def _echo_request_id(response):
+    if g.get('request_id'):
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+
+@app.teardown_request
+def _clear_request_id(exc):
+    REQUEST_ID.set(None)
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """executor.submit that carries the request ID (and other context vars) into the worker thread."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+# ── Request tracing ──────────────────────────────────────────────────────────
+# Every request gets a root span; nested spans (transcript fetch, chunking, each
+# upstream attempt, limiter waits, post-processing) attach to whatever span is
+# current in the context. Finished traces are kept in a small ring buffer for
+# /api/traces, optionally appended to TRACE_EXPORT_FILE as OTLP/JSON lines by a
+# background thread, and summarised in a Server-Timing header when enabled.
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") != "0"
+TRACE_SERVER_TIMING = os.getenv("TRACE_SERVER_TIMING", "0") == "1"
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE", "")
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))
+UNTRACED_PATHS = ('/static/', '/metrics', '/api/traces')
+
+_CURRENT_SPAN = contextvars.ContextVar('current_span', default=None)
+RECENT_TRACES = deque(maxlen=TRACE_BUFFER_SIZE)
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'kind', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, trace, name, parent_id=None, kind='internal', attributes=None):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self):
+        return {
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start_unix_ms': self.start_ns / 1e6,
+            'duration_ms': round(self.duration_ms, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+    def to_otlp(self):
+        kinds = {'internal': 1, 'server': 2, 'client': 3}
+        return {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'kind': kinds.get(self.kind, 1),
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns or self.start_ns),
+            'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+
+
+class Trace:
+    def __init__(self, name, request_id=None):
+        self.trace_id = os.urandom(16).hex()
+        self.request_id = request_id
+        self.spans = []                     # finished spans; list.append is atomic across worker threads
+        self.root = Span(self, name, kind='server')
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'request_id': self.request_id,
+            'name': self.root.name,
+            'duration_ms': round(self.root.duration_ms, 3),
+            'spans': [sp.to_dict() for sp in sorted(self.spans, key=lambda sp: sp.start_ns)],
+        }
+
+    def to_otlp(self):
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'arka'}}]},
+            'scopeSpans': [{'scope': {'name': 'arka.app'}, 'spans': [sp.to_otlp() for sp in self.spans]}],
+        }]}
+
+    def server_timing(self):
+        totals = {}
+        for sp in self.spans:
+            if sp is not self.root:
+                entry = totals.setdefault(sp.name, [0.0, 0])
+                entry[0] += sp.duration_ms
+                entry[1] += 1
+        metrics = [f'{name};dur={dur:.1f};desc="{count}x"' for name, (dur, count) in totals.items()]
+        metrics.append(f'total;dur={self.root.duration_ms:.1f}')
+        return ', '.join(metrics)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+@contextmanager
+def span(name, kind='internal', **attributes):
+    """Record a child span of the current span; a no-op outside a traced request."""
+    parent = _CURRENT_SPAN.get()
+    if parent is None:
+        yield None
+        return
+    current = Span(parent.trace, name, parent.span_id, kind, attributes)
+    token = _CURRENT_SPAN.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _CURRENT_SPAN.reset(token)
+        current.trace.spans.append(current)
+
+
+_trace_export_queue = queue.Queue(maxsize=1000)
+
+
+def _trace_exporter():
+    with open(TRACE_EXPORT_FILE, 'a', encoding='utf-8') as f:
+        while True:
+            trace = _trace_export_queue.get()
+            f.write(json_dumps(trace.to_otlp()) + '\n')
+            if _trace_export_queue.empty():
+                f.flush()
+
+
+if TRACING_ENABLED and TRACE_EXPORT_FILE:
+    threading.Thread(target=_trace_exporter, name='trace-exporter', daemon=True).start()
+
+
+@app.before_request
+def _start_trace():
+    if not TRACING_ENABLED or request.path.startswith(UNTRACED_PATHS):
+        return
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    trace = Trace(f'{request.method} {rule}', g.get('request_id'))
+    trace.root.attributes.update({'http.method': request.method, 'http.route': rule})
+    g.trace = trace
+    _CURRENT_SPAN.set(trace.root)
+
+
+@app.after_request
+def _finish_trace(response):
+    trace = g.get('trace')
+    if trace is None:
+        return response
+    root = trace.root
+    root.end_ns = time.time_ns()
+    root.attributes['http.status_code'] = response.status_code
+    trace.spans.append(root)
+    RECENT_TRACES.append(trace)
+    response.headers['X-Trace-ID'] = trace.trace_id
+    if TRACE_SERVER_TIMING:
+        response.headers['Server-Timing'] = trace.server_timing()
+    if TRACE_EXPORT_FILE:
+        try:
+            _trace_export_queue.put_nowait(trace)
+        except queue.Full:
+            pass
+    return response
+
+
+@app.teardown_request
+def _clear_trace(exc):
+    _CURRENT_SPAN.set(None)
+
+
+@app.route('/api/traces')
+@app.route('/api/traces/<trace_id>')
+def traces(trace_id=None):
+    """Recent traces as JSON (?format=otlp for OTLP/JSON). Guarded by METRICS_TOKEN when set."""
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return jsonify({'error': 'Unauthorized.'}), 401
+    recent = list(RECENT_TRACES)
+    if trace_id is not None:
+        match = next((t for t in recent if t.trace_id == trace_id or t.request_id == trace_id), None)
+        if match is None:
+            return jsonify({'error': 'Trace not found (it may have been evicted).'}), 404
+        return jsonify(match.to_otlp() if request.args.get('format') == 'otlp' else match.to_dict())
+    limit = request.args.get('limit', 20, type=int)
+    return jsonify({'traces': [
+        {'trace_id': t.trace_id, 'request_id': t.request_id, 'name': t.root.name,
+         'duration_ms': round(t.root.duration_ms, 3), 'spans': len(t.spans)}
+        for t in reversed(recent[-limit:])
+    ]})
+
+
+# ── Metrics (Prometheus text format) ─────────────────────────────────────────
+# Each thread writes to its own shard of plain dicts, so recording a sample never
+# takes a lock; shards are merged (and dead threads' shards folded) at scrape time.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 90)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = []               # [(thread, (counters, histograms))]
+        self._retired = ({}, {})        # folded shards of finished threads
+        self._meta = {}                 # name -> (type, help, buckets)
+        self._collectors = []
+
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+
+    def gauge(self, name, help_text):
+        self._meta[name] = ('gauge', help_text, None)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help_text, tuple(buckets))
+
+    def add_collector(self, fn):
+        """Register ``fn() -> [(name, labels, value)]`` evaluated at scrape time (for gauges)."""
+        self._collectors.append(fn)
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = ({}, {})
+            self._local.shard = shard
+            with self._lock:
+                # Fold finished threads here too: with a thread per request, waiting for a scrape would let
+                # the list (and every dead thread object) grow without bound
+                self._retire_dead()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter, or move a gauge by ``value`` (which may be negative)."""
+        counters = self._shard()[0]
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        hists = self._shard()[1]
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._meta[name][2]
+        h = hists.get(key)
+        if h is None:
+            # Per-bucket counts, one overflow (+Inf) slot, then the running sum
+            h = hists[key] = [0] * (len(buckets) + 2)
+        h[bisect.bisect_left(buckets, value)] += 1
+        h[-1] += value
+
+    @staticmethod
+    def _fold(into, shard):
+        counters, hists = shard
+        for key, value in counters.items():
+            into[0][key] = into[0].get(key, 0) + value
+        for key, values in hists.items():
+            current = into[1].get(key)
+            into[1][key] = list(values) if current is None else [a + b for a, b in zip(current, values)]
+
+    def _retire_dead(self):
+        # Caller holds self._lock
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._fold(self._retired, shard)
+        self._shards = alive
+
+    def _merged(self):
+        with self._lock:
+            self._retire_dead()
+            alive = list(self._shards)
+            merged = (dict(self._retired[0]), {k: list(v) for k, v in self._retired[1].items()})
+        for _, (counters, hists) in alive:
+            # dict.copy() runs under the GIL, so a writer can't change the dict mid-copy
+            self._fold(merged, (counters.copy(), hists.copy()))
+        return merged
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            f'{k}="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for k, v in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        counters, hists = self._merged()
+        samples = {}
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append((labels, value))
+        for fn in self._collectors:
+            try:
+                for name, labels, value in fn():
+                    samples.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+            except Exception:
+                log.warning("Metrics collector failed", exc_info=True)
+        for (name, labels), values in hists.items():
+            samples.setdefault(name, []).append((labels, values))
+
+        lines = []
+        for name in sorted(samples):
+            kind, help_text, buckets = self._meta.get(name, ('untyped', '', None))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(samples[name], key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{self._labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for le, count in zip(buckets + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{self._labels(labels, [("le", le)])} {cumulative}')
+                lines.append(f'{name}_sum{self._labels(labels)} {value[-1]}')
+                lines.append(f'{name}_count{self._labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+METRICS.counter('arka_http_requests_total', 'HTTP requests by route, method and status.')
+METRICS.histogram('arka_http_request_duration_seconds', 'HTTP request latency by route.')
+METRICS.gauge('arka_http_requests_in_flight', 'HTTP requests currently being handled, by route.')
+METRICS.counter('arka_http_compressed_responses_total', 'Responses sent with a Content-Encoding, by encoding.')
+METRICS.histogram('arka_upstream_request_duration_seconds', 'Upstream API latency by service, status and attempt.')
+METRICS.gauge('arka_upstream_requests_in_flight', 'Upstream API calls currently open, by service.')
+METRICS.counter('arka_upstream_retries_total', 'Upstream API retry attempts, by service.')
+METRICS.counter('arka_upstream_tokens_total', 'Sarvam tokens reported in result["usage"], by route and kind.')
+METRICS.counter('arka_cache_requests_total', 'Cache lookups by cache and result (hit/miss).')
+METRICS.gauge('arka_cache_hit_ratio', 'Cache hit ratio since process start.')
+METRICS.gauge('arka_cache_entries', 'Entries currently held per cache.')
+METRICS.gauge('arka_concurrency_limit', 'Current adaptive concurrency limit per limiter.')
+METRICS.counter('arka_log_records_dropped_total', 'Log records dropped or sampled away because the log queue was backed up.')
+METRICS.add_collector(lambda: [('arka_log_records_dropped_total', {}, LOG_HANDLER.dropped)])
+
+
+@contextmanager
+def track_upstream(service, attempt=1):
+    """Time one upstream HTTP call; call ``record(status_code)`` once the response arrives."""
+    state = {'status': 'error'}
+    if attempt > 1:
+        METRICS.inc('arka_upstream_retries_total', service=service)
+    METRICS.inc('arka_upstream_requests_in_flight', service=service)
+    started = time.perf_counter()
+
+    with span(f'{service}.request', kind='client', service=service, attempt=attempt) as current:
+        def record(status_code):
+            state['status'] = str(status_code)
+            if current is not None:
+                current.attributes['http.status_code'] = status_code
+
+        try:
+            yield record
+        finally:
+            METRICS.inc('arka_upstream_requests_in_flight', -1, service=service)
+            METRICS.observe('arka_upstream_request_duration_seconds', time.perf_counter() - started,
+                            service=service, status=state['status'], attempt=str(attempt))
+
+
+def record_token_usage(route, usage):
+    for kind in ('prompt_tokens', 'completion_tokens', 'total_tokens'):
+        value = (usage or {}).get(kind)
+        if isinstance(value, (int, float)):
+            METRICS.inc('arka_upstream_tokens_total', value, route=route, kind=kind.replace('_tokens', ''))
+    usage = usage or {}
+    entry = LEDGER_CALL.get()
+    if entry is not None:
+        entry.add_usage(usage)
+    total = usage.get('total_tokens') or (usage.get('prompt_tokens') or 0) + (usage.get('completion_tokens') or 0)
+    if isinstance(total, (int, float)) and total > 0:
+        _charge_request_tokens(int(total))
+
+
+def _route_label():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+@app.before_request
+def _metrics_start():
+    g.metrics_started = time.perf_counter()
+    g.metrics_route = _route_label()
+    METRICS.inc('arka_http_requests_in_flight', route=g.metrics_route)
+
+
+@app.after_request
+def _metrics_record(response):
+    started = g.get('metrics_started')
+    if started is not None:
+        METRICS.inc('arka_http_requests_total', route=g.metrics_route, method=request.method, status=str(response.status_code))
+        METRICS.observe('arka_http_request_duration_seconds', time.perf_counter() - started, route=g.metrics_route)
+    return response
+
+
+@app.teardown_request
+def _metrics_finish(exc):
+    if g.get('metrics_started') is not None:
+        METRICS.inc('arka_http_requests_in_flight', -1, route=g.metrics_route)
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint. Set METRICS_TOKEN to require 'Authorization: Bearer <token>'."""
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return jsonify({'error': 'Unauthorized.'}), 401
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+
+# ── Per-client quotas ────────────────────────────────────────────────────────
+# Sliding-window quotas on the Sarvam-backed routes, keyed by (in order of
+# preference) a configured API key, a verified Firebase UID, or the client IP.
+# Each identity has a request budget and an upstream-token budget per
+# QUOTA_WINDOW; tokens come from result['usage'] via record_token_usage, so a
+# 40-chunk notes run costs what it actually consumed. A call costs one request,
+# except /api/generate/batch, which costs one per item. The sliding window is
+# approximated from two fixed windows (previous count weighted by overlap),
+# which keeps each identity down to a handful of integers. Counters live in
+# memory by default; set QUOTA_DB_PATH to share them through SQLite between
+# worker processes.
+
+try:
+    import firebase_admin
+    from firebase_admin import auth as firebase_auth
+except ImportError:  # optional: without it, Firebase users are quota'd by IP
+    firebase_admin = None
+
+QUOTA_ENABLED = os.getenv("QUOTA_ENABLED", "1") != "0"
+QUOTA_WINDOW = int(os.getenv("QUOTA_WINDOW", "3600"))
+QUOTA_DB_PATH = os.getenv("QUOTA_DB_PATH", "")
+FIREBASE_PROJECT_ID = os.getenv("FIREBASE_PROJECT_ID", "arka-9686d")
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+
+# API keys as "name:key" pairs; the name is what shows up in quota identities and logs
+QUOTA_API_KEYS = {
+    key: name
+    for name, _, key in (item.strip().partition(':') for item in os.getenv("QUOTA_API_KEYS", "").split(','))
+    if key
+}
+
+# (requests, tokens) per window for each identity kind
+QUOTA_LIMITS = {
+    'key': (int(os.getenv("QUOTA_KEY_REQUESTS", "5000")), int(os.getenv("QUOTA_KEY_TOKENS", "5000000"))),
+    'uid': (int(os.getenv("QUOTA_UID_REQUESTS", "300")), int(os.getenv("QUOTA_UID_TOKENS", "300000"))),
+    'ip': (int(os.getenv("QUOTA_IP_REQUESTS", "200")), int(os.getenv("QUOTA_IP_TOKENS", "200000"))),
+}
+
+QUOTA_ROUTES = {'/api/generate', '/api/generate/batch', '/api/refine', '/api/law-chat', '/api/yt-notes'}
+
+# Mutable per-request token tally; record_token_usage adds to it, including from worker threads
+# started with submit_in_context (the copied context shares the same dict)
+REQUEST_TOKENS = contextvars.ContextVar('request_tokens', default=None)
+
+METRICS.counter('arka_quota_rejected_total', 'Requests rejected for exceeding a quota, by identity kind and budget.')
+METRICS.counter('arka_quota_tokens_charged_total', 'Upstream tokens charged to quotas, by identity kind.')
+
+
+class MemoryQuotaBackend:
+    """Per-identity [window, requests, tokens, prev_requests, prev_tokens] in a bounded LRU."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._counters = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _roll(self, identity, window):
+        counter = self._counters.get(identity)
+        if counter is None:
+            counter = self._counters[identity] = [window, 0, 0, 0, 0]
+            if len(self._counters) > self.maxsize:
+                self._counters.popitem(last=False)
+        elif counter[0] != window:
+            adjacent = counter[0] == window - 1
+            counter[:] = [window, 0, 0, counter[1] if adjacent else 0, counter[2] if adjacent else 0]
+        self._counters.move_to_end(identity)
+        return counter
+
+    def read(self, identity, window):
+        with self._lock:
+            counter = self._roll(identity, window)
+            return counter[1], counter[2], counter[3], counter[4]
+
+    def add(self, identity, window, requests=0, tokens=0):
+        with self._lock:
+            counter = self._roll(identity, window)
+            counter[1] += requests
+            counter[2] += tokens
+
+
+class SQLiteQuotaBackend:
+    """Same counters in a SQLite table, so every worker process sharing the file sees one budget."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._swept_window = None
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS quota_counters ("
+                " identity TEXT NOT NULL, window INTEGER NOT NULL,"
+                " requests INTEGER NOT NULL DEFAULT 0, tokens INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (identity, window))"
+            )
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def read(self, identity, window):
+        rows = dict(
+            (w, (r, t)) for w, r, t in self._conn().execute(
+                "SELECT window, requests, tokens FROM quota_counters WHERE identity = ? AND window IN (?, ?)",
+                (identity, window, window - 1),
+            )
+        )
+        (requests, tokens), (prev_requests, prev_tokens) = rows.get(window, (0, 0)), rows.get(window - 1, (0, 0))
+        return requests, tokens, prev_requests, prev_tokens
+
+    def add(self, identity, window, requests=0, tokens=0):
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO quota_counters (identity, window, requests, tokens) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(identity, window) DO UPDATE SET requests = requests + excluded.requests, tokens = tokens + excluded.tokens",
+            (identity, window, requests, tokens),
+        )
+        # Once per window per process, drop windows that can no longer affect the sliding estimate
+        if window != self._swept_window:
+            self._swept_window = window
+            conn.execute("DELETE FROM quota_counters WHERE window < ?", (window - 1,))
+
+
+class QuotaManager:
+    def __init__(self, backend, window, limits):
+        self.backend = backend
+        self.window = window
+        self.limits = limits
+
+    def _position(self, now):
+        window, offset = divmod(now, self.window)
+        return int(window), offset / self.window
+
+    def usage(self, identity, kind, now=None):
+        """Sliding-window usage, limits and remaining budget for one identity."""
+        window, elapsed = self._position(now or time.time())
+        requests, tokens, prev_requests, prev_tokens = self.backend.read(identity, window)
+        used = {
+            'requests': prev_requests * (1 - elapsed) + requests,
+            'tokens': prev_tokens * (1 - elapsed) + tokens,
+        }
+        limits = dict(zip(('requests', 'tokens'), self.limits[kind]))
+        return {
+            'identity': identity,
+            'window_seconds': self.window,
+            'used': {k: int(v) for k, v in used.items()},
+            'limit': limits,
+            'remaining': {k: max(0, int(limits[k] - used[k])) for k in limits},
+            '_raw': (elapsed, {'requests': (requests, prev_requests), 'tokens': (tokens, prev_tokens)}),
+        }
+
+    def check(self, identity, kind, cost=1):
+        """
+        Return (None, usage, 0) if the identity may make ``cost`` more requests,
+        else (budget, usage, retry_after).
+        """
+        usage = self.usage(identity, kind)
+        elapsed, raw = usage.pop('_raw')
+        for budget in ('requests', 'tokens'):
+            limit = usage['limit'][budget]
+            needed = cost if budget == 'requests' else 0
+            if usage['used'][budget] + needed > limit:
+                return budget, usage, self._retry_after(elapsed, *raw[budget], limit - max(0, needed - 1))
+        return None, usage, 0
+
+    def _retry_after(self, elapsed, current, previous, limit):
+        # Time until prev * (1 - f) + current drops below the limit
+        if current >= limit:
+            # Only once this window becomes the "previous" one and has mostly slid out
+            needed = 1 - limit / current if current else 0
+            return max(1, int(self.window * (1 - elapsed + needed) + 0.999))
+        if previous:
+            needed = 1 - (limit - current) / previous
+            return max(1, int(self.window * (needed - elapsed) + 0.999))
+        return 1
+
+    def charge(self, identity, requests=0, tokens=0, window=None):
+        """Add to the identity's counters (in the current window unless given); returns the window charged."""
+        if window is None:
+            window, _ = self._position(time.time())
+        self.backend.add(identity, window, requests, tokens)
+        return window
+
+
+QUOTAS = QuotaManager(
+    SQLiteQuotaBackend(QUOTA_DB_PATH) if QUOTA_DB_PATH else MemoryQuotaBackend(),
+    QUOTA_WINDOW,
+    QUOTA_LIMITS,
+)
+
+_FIREBASE_APP = None
+_FIREBASE_TOKEN_CACHE = OrderedDict()    # id token -> (expires, uid)
+_FIREBASE_LOCK = threading.Lock()
+
+
+def _firebase_uid(id_token):
+    """Verify a Firebase ID token and return its UID, or None (invalid, or firebase_admin not installed)."""
+    global _FIREBASE_APP
+    if firebase_admin is None or not id_token:
+        return None
+    with _FIREBASE_LOCK:
+        cached = _FIREBASE_TOKEN_CACHE.get(id_token)
+        if cached and cached[0] > time.time():
+            return cached[1]
+        if _FIREBASE_APP is None:
+            try:
+                _FIREBASE_APP = firebase_admin.initialize_app(options={'projectId': FIREBASE_PROJECT_ID}, name='quota')
+            except ValueError:
+                _FIREBASE_APP = firebase_admin.get_app('quota')
+    try:
+        claims = firebase_auth.verify_id_token(id_token, app=_FIREBASE_APP)
+    except Exception:
+        return None
+    with _FIREBASE_LOCK:
+        _FIREBASE_TOKEN_CACHE[id_token] = (claims.get('exp', time.time() + 300), claims['uid'])
+        while len(_FIREBASE_TOKEN_CACHE) > 10000:
+            _FIREBASE_TOKEN_CACHE.popitem(last=False)
+    return claims['uid']
+
+
+def client_ip():
+    if TRUSTED_PROXY_HOPS:
+        forwarded = [p.strip() for p in request.headers.get('X-Forwarded-For', '').split(',') if p.strip()]
+        if len(forwarded) >= TRUSTED_PROXY_HOPS:
+            return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.remote_addr or 'unknown'
+
+
+def quota_identity():
+    """(identity, kind) for the current request: API key, then verified Firebase UID, then IP."""
+    api_key = request.headers.get('X-API-Key', '')
+    if api_key in QUOTA_API_KEYS:
+        return f"key:{QUOTA_API_KEYS[api_key]}", 'key'
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer '):
+        uid = _firebase_uid(auth[7:].strip())
+        if uid:
+            return f"uid:{uid}", 'uid'
+    return f"ip:{client_ip()}", 'ip'
+
+
+def _charge_request_tokens(tokens):
+    tally = REQUEST_TOKENS.get()
+    if tally is not None:
+        tally['tokens'] += tokens
+
+
+def _quota_exceeded(identity, kind, budget, usage, retry_after):
+    METRICS.inc('arka_quota_rejected_total', kind=kind, budget=budget)
+    log.warning("Quota exceeded", extra={'identity': identity, 'budget': budget, 'retry_after': retry_after})
+    response = jsonify({'error': f'Usage quota exceeded ({budget}). Please try again later.', 'quota': usage})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+
+@app.before_request
+def _enforce_quota():
+    if not QUOTA_ENABLED or request.method != 'POST' or _route_label() not in QUOTA_ROUTES:
+        return None
+    identity, kind = quota_identity()
+    budget, usage, retry_after = QUOTAS.check(identity, kind)
+    if budget is not None:
+        return _quota_exceeded(identity, kind, budget, usage, retry_after)
+    g.quota_window = QUOTAS.charge(identity, requests=1)
+    g.quota_requests = 1
+    g.quota = (identity, kind, usage)
+    REQUEST_TOKENS.set({'tokens': 0})
+    return None
+
+
+def charge_quota_requests(count):
+    """
+    Charge ``count`` more requests to the current identity, for routes that do
+    several requests' worth of work per call (the batch endpoint charges one
+    per item). Returns a 429 response, after refunding the request already
+    charged, if the identity cannot afford them; otherwise None.
+    """
+    quota = g.get('quota')
+    if quota is None or count <= 0:
+        return None
+    identity, kind, _ = quota
+    # The request charged in _enforce_quota is already in the usage, so only the extra ones are checked
+    budget, usage, retry_after = QUOTAS.check(identity, kind, cost=count)
+    if budget is not None:
+        refund_quota_request()
+        return _quota_exceeded(identity, kind, budget, usage, retry_after)
+    QUOTAS.charge(identity, requests=count, window=g.quota_window)
+    g.quota_requests += count
+    return None
+
+
+def refund_quota_request():
+    """Give back the requests charged to the identity when the request is turned away before doing any work."""
+    quota = g.pop('quota', None)
+    if quota is not None:
+        # Same window as the charge, so a refund straddling a window boundary can't go negative
+        QUOTAS.charge(quota[0], requests=-g.pop('quota_requests', 1), window=g.pop('quota_window'))
+
+
+@app.after_request
+def _quota_headers(response):
+    quota = g.get('quota')
+    if quota is not None:
+        _, _, usage = quota
+        response.headers['X-RateLimit-Limit-Tokens'] = str(usage['limit']['tokens'])
+        response.headers['X-RateLimit-Remaining-Tokens'] = str(usage['remaining']['tokens'])
+        response.headers['X-RateLimit-Remaining-Requests'] = str(max(0, usage['remaining']['requests'] - g.get('quota_requests', 1)))
+    return response
+
+
+@app.teardown_request
+def _settle_quota(exc):
+    # Runs after streamed bodies finish too, so batch generations are charged in full
+    quota = g.pop('quota', None)
+    tally = REQUEST_TOKENS.get()
+    if quota is not None and tally is not None and tally['tokens']:
+        identity, kind, _ = quota
+        QUOTAS.charge(identity, tokens=tally['tokens'])
+        METRICS.inc('arka_quota_tokens_charged_total', tally['tokens'], kind=kind)
+    REQUEST_TOKENS.set(None)
+
+
+@app.route('/api/quota', methods=['GET'])
+def quota_status():
+    """The caller's current sliding-window usage and remaining budget."""
+    identity, kind = quota_identity()
+    usage = QUOTAS.usage(identity, kind)
+    usage.pop('_raw')
+    return jsonify(usage)
+
+
+# ── Admission control ────────────────────────────────────────────────────────
+# The threaded server accepts every connection, and each one blocks on an
+# upstream call. Admission control bounds work per route class instead:
+# ADMISSION_LIMIT_<CLASS> requests run at once, up to ADMISSION_QUEUE_<CLASS>
+# more wait FIFO for at most ADMISSION_QUEUE_TIMEOUT seconds, and the rest are
+# shed straight away with 503 + Retry-After. A client may send
+# X-Request-Timeout (seconds) or X-Request-Deadline (unix time); if that passes
+# before the request is admitted it gets a 504 and never reaches the upstream.
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") != "0"
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))
+ADMISSION_DEFAULTS = {'generate': 16, 'chat': 8, 'notes': 4, 'email': 2}
+
+# POST routes by class; everything else (pages, static, metrics, GET progress) is never queued
+ADMISSION_ROUTE_CLASSES = {
+    '/api/generate': 'generate',
+    '/api/generate/batch': 'generate',
+    '/api/refine': 'generate',
+    '/api/law-chat': 'chat',
+    '/api/yt-notes': 'notes',
+    '/api/send-emails': 'email',
+    '/api/send-emails/jobs': 'email',
+}
+
+METRICS.counter('arka_admission_rejected_total', 'Requests shed by admission control, by route class and reason.')
+METRICS.gauge('arka_admission_in_flight', 'Admitted requests currently running, by route class.')
+METRICS.gauge('arka_admission_queue_depth', 'Requests waiting for admission, by route class.')
+
+
+class AdmissionController:
+    """Bounded concurrency with a short FIFO wait queue for one route class."""
+
+    def __init__(self, name, limit, queue_size, queue_timeout):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters = deque()
+        self._service_time = 1.0        # EWMA of admitted request duration, for Retry-After
+
+    def acquire(self, deadline=None):
+        """Return None once admitted, else the rejection reason: 'queue_full', 'queue_timeout' or 'deadline'."""
+        with self._lock:
+            if self._in_flight < self.limit and not self._waiters:
+                self._in_flight += 1
+                return None
+            if len(self._waiters) >= self.queue_size:
+                return 'queue_full'
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+
+        timeout = self.queue_timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.time())
+        if waiter.wait(max(0.0, timeout)):
+            return None
+        with self._lock:
+            if waiter.is_set():         # release() handed us the slot while we were timing out
+                return None
+            self._waiters.remove(waiter)
+        return 'deadline' if deadline is not None and time.time() >= deadline else 'queue_timeout'
+
+    def release(self, service_time):
+        with self._lock:
+            self._service_time = 0.8 * self._service_time + 0.2 * service_time
+            if self._waiters:
+                # Hand the slot straight to the oldest waiter; in-flight count stays the same
+                self._waiters.popleft().set()
+            else:
+                self._in_flight -= 1
+
+    def retry_after(self):
+        """Seconds until a retry is likely to be admitted, from the backlog and recent service time."""
+        with self._lock:
+            backlog = len(self._waiters) + 1
+            return max(1, int(self._service_time * backlog / self.limit + 0.999))
+
+    def snapshot(self):
+        with self._lock:
+            return {'limit': self.limit, 'in_flight': self._in_flight, 'queued': len(self._waiters)}
+
+
+ADMISSION = {
+    name: AdmissionController(
+        name,
+        limit=int(os.getenv(f"ADMISSION_LIMIT_{name.upper()}", str(default))),
+        queue_size=int(os.getenv(f"ADMISSION_QUEUE_{name.upper()}", str(default))),
+        queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+    )
+    for name, default in ADMISSION_DEFAULTS.items()
+}
+
+
+def _admission_metrics():
+    samples = []
+    for name, controller in ADMISSION.items():
+        state = controller.snapshot()
+        samples.append(('arka_admission_in_flight', {'route_class': name}, state['in_flight']))
+        samples.append(('arka_admission_queue_depth', {'route_class': name}, state['queued']))
+    return samples
+
+
+METRICS.add_collector(_admission_metrics)
+
+
+def request_deadline():
+    """Absolute client deadline (unix time) from X-Request-Deadline / X-Request-Timeout, or None."""
+    try:
+        if request.headers.get('X-Request-Deadline'):
+            return float(request.headers['X-Request-Deadline'])
+        if request.headers.get('X-Request-Timeout'):
+            return time.time() + float(request.headers['X-Request-Timeout'])
+    except ValueError:
+        pass
+    return None
+
+
+@app.before_request
+def _admit_request():
+    if not ADMISSION_ENABLED or request.method != 'POST':
+        return None
+    route_class = ADMISSION_ROUTE_CLASSES.get(_route_label())
+    if route_class is None:
+        return None
+    controller = ADMISSION[route_class]
+
+    deadline = request_deadline()
+    if deadline is not None and deadline <= time.time():
+        reason = 'deadline'
+    else:
+        with span('admission.wait', route_class=route_class):
+            reason = controller.acquire(deadline)
+    if reason is None:
+        g.admission = (controller, time.perf_counter())
+        return None
+
+    METRICS.inc('arka_admission_rejected_total', route_class=route_class, reason=reason)
+    log.warning("Request shed by admission control", extra={'route_class': route_class, 'reason': reason})
+    # The quota hook runs first so over-quota clients never queue, but shed work must not cost the client anything
+    refund_quota_request()
+    if reason == 'deadline':
+        return jsonify({'error': 'Request deadline exceeded before it could be processed.'}), 504
+    response = jsonify({'error': 'Server is busy. Please retry shortly.'})
+    response.headers['Retry-After'] = str(controller.retry_after())
+    return response, 503
+
+
+@app.teardown_request
+def _release_admission(exc):
+    admission = g.pop('admission', None)
+    if admission is not None:
+        controller, started = admission
+        controller.release(time.perf_counter() - started)
+
+
 # ── Sarvam M API Configuration ──────────────────────────────────────────────
 SARVAM_API_KEY = os.getenv("SARVAM_API_KEY") or os.getenv("api-subscription-key") or ""
-SARVAM_API_URL = "https://api.sarvam.ai/v1/chat/completions"
+SARVAM_API_URL = os.getenv("SARVAM_API_URL", "https://api.sarvam.ai/v1/chat/completions")
+SUPADATA_API_URL = os.getenv("SUPADATA_API_URL", "https://api.supadata.ai").rstrip("/")
+
+# ── Sarvam API key pool ─────────────────────────────────────────────────────
+# Per-key rate limits cap throughput, so calls are spread over a pool of keys
+# from SARVAM_API_KEYS ("key1,key2:3" — optional :weight) or
+# SARVAM_API_KEYS_FILE (one "key [weight]" per line), falling back to the
+# single SARVAM_API_KEY. Each call leases a key: least-loaded by default
+# (in-flight / weight), or smooth weighted round-robin with
+# SARVAM_KEY_STRATEGY=round_robin. A key answering 429 is quarantined for its
+# Retry-After (or an exponential cool-down); 401/403 quarantines it for
+# SARVAM_KEY_AUTH_COOLDOWN. Quarantined keys are readmitted automatically.
+
+SARVAM_KEY_STRATEGY = os.getenv("SARVAM_KEY_STRATEGY", "least_loaded")
+SARVAM_KEY_COOLDOWN = float(os.getenv("SARVAM_KEY_COOLDOWN", "15"))
+SARVAM_KEY_AUTH_COOLDOWN = float(os.getenv("SARVAM_KEY_AUTH_COOLDOWN", "600"))
+
+METRICS.gauge('arka_sarvam_key_in_flight', 'Sarvam calls in flight per pooled API key.')
+METRICS.gauge('arka_sarvam_key_available', '1 if the pooled API key is in rotation, 0 while quarantined.')
+METRICS.counter('arka_sarvam_key_quarantines_total', 'Times a pooled API key was quarantined, by reason.')
+
+
+def _parse_key_spec(spec):
+    key, sep, weight = spec.strip().rpartition(':')
+    if sep and weight.isdigit() and key:
+        return key, int(weight)
+    return spec.strip(), 1
+
+
+def load_sarvam_keys():
+    """[(key, weight), ...] from SARVAM_API_KEYS_FILE, SARVAM_API_KEYS or SARVAM_API_KEY, deduplicated."""
+    specs = []
+    path = os.getenv("SARVAM_API_KEYS_FILE")
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    parts = line.split()
+                    specs.append(f"{parts[0]}:{parts[1]}" if len(parts) > 1 else parts[0])
+    specs += [s for s in os.getenv("SARVAM_API_KEYS", "").split(',') if s.strip()]
+    if not specs and SARVAM_API_KEY:
+        specs = [SARVAM_API_KEY]
+    keys = OrderedDict()
+    for spec in specs:
+        key, weight = _parse_key_spec(spec)
+        keys.setdefault(key, max(1, weight))
+    return list(keys.items())
+
+
+class PooledKey:
+    def __init__(self, index, key, weight):
+        self.key = key
+        self.weight = weight
+        self.label = f"k{index}-{key[-4:]}"     # never expose the full key in metrics or logs
+        self.in_flight = 0
+        self.quarantined_until = 0.0
+        self.strikes = 0                        # consecutive 429s, for exponential cool-down
+        self.current_weight = 0                 # smooth weighted round-robin state
+
+
+class SarvamKeyPool:
+    def __init__(self, keys, strategy='least_loaded', cooldown=15.0, auth_cooldown=600.0):
+        self.keys = [PooledKey(i, key, weight) for i, (key, weight) in enumerate(keys)]
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self.auth_cooldown = auth_cooldown
+        self._lock = threading.Lock()
+        self._rr = itertools.count()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _available(self, now):
+        return [k for k in self.keys if k.quarantined_until <= now]
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            candidates = self._available(now)
+            if not candidates:
+                # Everything is quarantined: use the key that comes back soonest rather than failing outright
+                candidates = [min(self.keys, key=lambda k: k.quarantined_until)]
+            if self.strategy == 'round_robin':
+                total = sum(k.weight for k in candidates)
+                for k in candidates:
+                    k.current_weight += k.weight
+                chosen = max(candidates, key=lambda k: k.current_weight)
+                chosen.current_weight -= total
+            else:
+                # Least in-flight per unit of weight; rotate the starting point so ties spread evenly
+                offset = next(self._rr)
+                ordered = candidates[offset % len(candidates):] + candidates[:offset % len(candidates)]
+                chosen = min(ordered, key=lambda k: k.in_flight / k.weight)
+            chosen.in_flight += 1
+            return chosen
+
+    def release(self, pooled, status_code=None, retry_after=None):
+        with self._lock:
+            pooled.in_flight -= 1
+            if status_code == 429:
+                pooled.strikes += 1
+                wait = retry_after if retry_after else self.cooldown * 2 ** min(pooled.strikes - 1, 5)
+                self._quarantine(pooled, wait, 'rate_limited')
+            elif status_code in (401, 403):
+                self._quarantine(pooled, self.auth_cooldown, 'auth')
+            elif status_code is not None and status_code < 400:
+                pooled.strikes = 0
+
+    def _quarantine(self, pooled, seconds, reason):
+        pooled.quarantined_until = max(pooled.quarantined_until, time.monotonic() + seconds)
+        METRICS.inc('arka_sarvam_key_quarantines_total', key=pooled.label, reason=reason)
+        log.warning("Sarvam key quarantined", extra={'key': pooled.label, 'reason': reason, 'seconds': round(seconds, 1)})
+
+    def label_for(self, key):
+        """The label of a pooled key; 'pinned' for a key from outside the pool."""
+        return next((k.label for k in self.keys if k.key == key), 'pinned')
+
+    def can_failover(self):
+        """True if another key is currently in rotation, so a 401/429 is worth retrying right away."""
+        with self._lock:
+            return len(self._available(time.monotonic())) > 0
+
+    @contextmanager
+    def lease(self):
+        """Yield (api_key, outcome); call outcome(response) (or outcome(None) on error) before leaving."""
+        pooled = self.acquire()
+        state = {'status': None, 'retry_after': None}
+
+        def outcome(response):
+            if response is not None:
+                state['status'] = response.status_code
+                header = response.headers.get('Retry-After', '')
+                state['retry_after'] = float(header) if header.replace('.', '', 1).isdigit() else None
+
+        try:
+            yield pooled.key, outcome
+        finally:
+            self.release(pooled, state['status'], state['retry_after'])
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return [{'key': k.label, 'weight': k.weight, 'in_flight': k.in_flight,
+                     'quarantined_for': round(max(0.0, k.quarantined_until - now), 1)} for k in self.keys]
+
+
+SARVAM_KEYS = SarvamKeyPool(load_sarvam_keys(), SARVAM_KEY_STRATEGY, SARVAM_KEY_COOLDOWN, SARVAM_KEY_AUTH_COOLDOWN)
+METRICS.add_collector(lambda: [
+    sample
+    for state in SARVAM_KEYS.snapshot()
+    for sample in (('arka_sarvam_key_in_flight', {'key': state['key']}, state['in_flight']),
+                   ('arka_sarvam_key_available', {'key': state['key']}, 0 if state['quarantined_for'] else 1))
+])
+
+
+# ── Model routing ───────────────────────────────────────────────────────────
+# Model, max_tokens and timeout per route (and per diagram mode / notes
+# format) come from MODEL_ROUTES, overridable with a JSON file at
+# MODEL_ROUTES_FILE ({"generate": {"pie": {"max_tokens": 384}}, ...}).
+# Small diagrams get tight output caps, which bounds their worst-case latency.
+# Each (endpoint, model) target has a health tracker; when the primary is
+# degraded (repeated 5xx/timeouts) calls go to the fallback tier
+# (SARVAM_FALLBACK_MODEL and/or SARVAM_FALLBACK_URL, with SARVAM_FALLBACK_KEY
+# if that endpoint needs its own credentials) until the primary cools down.
+
+SARVAM_MODEL = os.getenv("SARVAM_MODEL", "sarvam-m")
+SARVAM_FALLBACK_MODEL = os.getenv("SARVAM_FALLBACK_MODEL", "")
+SARVAM_FALLBACK_URL = os.getenv("SARVAM_FALLBACK_URL", "")
+SARVAM_FALLBACK_KEY = os.getenv("SARVAM_FALLBACK_KEY", "")
+TARGET_DEGRADED_COOLDOWN = float(os.getenv("TARGET_DEGRADED_COOLDOWN", "30"))
+
+MODEL_ROUTES = {
+    'generate': {'default': {'max_tokens': 2048, 'timeout': 60, 'max_input_tokens': 4096},
+                 **{mode: {'max_tokens': cap} for mode, cap in DIAGRAM_MAX_TOKENS.items()}},
+    'refine': {'default': {'max_tokens': 2048, 'timeout': 60, 'max_input_tokens': 8192},
+               **{mode: {'max_tokens': cap} for mode, cap in DIAGRAM_MAX_TOKENS.items()}},
+    'law_chat': {'default': {'max_tokens': 2048, 'timeout': 90, 'max_input_tokens': 8192}},
+    'yt_notes': {'default': {'max_tokens': 2048, 'timeout': 60, 'max_input_tokens': 4096},
+                 'outline': {'max_tokens': 1024, 'timeout': 45}},
+}
+
+
+def _load_model_routes():
+    path = os.getenv("MODEL_ROUTES_FILE")
+    if not path:
+        return
+    try:
+        with open(path, encoding='utf-8') as f:
+            overrides = json.load(f)
+    except (OSError, ValueError):
+        log.error("Could not load MODEL_ROUTES_FILE", exc_info=True, extra={'path': path})
+        return
+    for route, modes in overrides.items():
+        for mode, settings in modes.items():
+            MODEL_ROUTES.setdefault(route, {}).setdefault(mode, {}).update(settings)
+
+
+_load_model_routes()
+
+
+def model_route(route, mode=None):
+    """Resolved {'route', 'model', 'fallback_model', 'max_tokens', 'timeout', 'max_input_tokens'} for a route and optional mode."""
+    table = MODEL_ROUTES.get(route, {})
+    config = {'route': route, 'model': SARVAM_MODEL, 'fallback_model': SARVAM_FALLBACK_MODEL,
+              'max_tokens': 2048, 'timeout': 60, 'max_input_tokens': 8192}
+    config.update(table.get('default', {}))
+    if mode is not None:
+        config.update(table.get(mode, {}))
+    return config
+
+
+def sarvam_payload(config, messages, temperature=0.3):
+    return {'model': config['model'], 'messages': messages, 'temperature': temperature,
+            'max_tokens': config['max_tokens']}
+
+
+METRICS.counter('arka_model_requests_total', 'Sarvam chat calls by route, model and tier (primary/fallback).')
+METRICS.gauge('arka_model_target_degraded', '1 while an upstream (endpoint, model) target is marked degraded.')
+
+
+class TargetHealth:
+    """Marks an upstream target degraded after repeated 5xx/timeouts, for a cool-down period."""
+
+    def __init__(self, name, window=20, min_samples=5, failure_ratio=0.5, consecutive=2, cooldown=30.0):
+        self.name = name
+        self.window = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.failure_ratio = failure_ratio
+        self.consecutive = consecutive
+        self.cooldown = cooldown
+        self.failures_in_a_row = 0
+        self.degraded_until = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, ok):
+        with self._lock:
+            self.window.append(ok)
+            self.failures_in_a_row = 0 if ok else self.failures_in_a_row + 1
+            failures = self.window.count(False)
+            if not ok and (self.failures_in_a_row >= self.consecutive or
+                           (len(self.window) >= self.min_samples and failures / len(self.window) >= self.failure_ratio)):
+                if self.degraded_until < time.monotonic():
+                    log.warning("Upstream target degraded", extra={'target': self.name, 'recent_failures': failures})
+                self.degraded_until = time.monotonic() + self.cooldown
+                self.window.clear()
+
+    @property
+    def degraded(self):
+        return self.degraded_until > time.monotonic()
+
+
+_TARGET_HEALTH = {}
+_TARGET_HEALTH_LOCK = threading.Lock()
+
+
+def target_health(url, model):
+    with _TARGET_HEALTH_LOCK:
+        health = _TARGET_HEALTH.get((url, model))
+        if health is None:
+            health = _TARGET_HEALTH[(url, model)] = TargetHealth(f"{model}@{url}", cooldown=TARGET_DEGRADED_COOLDOWN)
+        return health
+
+
+METRICS.add_collector(lambda: [('arka_model_target_degraded', {'target': h.name}, 1 if h.degraded else 0)
+                               for h in list(_TARGET_HEALTH.values())])
+
+
+def _pick_target(config):
+    """(tier, url, model, fixed_key): the primary unless it is degraded and a fallback is configured."""
+    primary = ('primary', SARVAM_API_URL, config['model'], None)
+    if not (config.get('fallback_model') or SARVAM_FALLBACK_URL):
+        return primary
+    fallback = ('fallback', SARVAM_FALLBACK_URL or SARVAM_API_URL, config.get('fallback_model') or config['model'],
+                SARVAM_FALLBACK_KEY or None)
+    if target_health(primary[1], primary[2]).degraded and not target_health(fallback[1], fallback[2]).degraded:
+        return fallback
+    return primary
+
+
+def _post_chat(url, payload, timeout, api_key):
+    if api_key or not SARVAM_KEYS:
+        # An empty pool still makes the call, so the caller sees Sarvam's own auth error
+        headers = {'Content-Type': 'application/json', 'api-subscription-key': api_key or ''}
+        ledger_note(key=SARVAM_KEYS.label_for(api_key) if api_key else '')
+        return requests.post(url, headers=headers, data=json_dumps_bytes(payload), timeout=timeout)
+    with SARVAM_KEYS.lease() as (key, outcome):
+        headers = {'Content-Type': 'application/json', 'api-subscription-key': key}
+        ledger_note(key=SARVAM_KEYS.label_for(key))
+        response = requests.post(url, headers=headers, data=json_dumps_bytes(payload), timeout=timeout)
+        outcome(response)
+        return response
+
+
+def sarvam_post(payload, config, api_key=None):
+    """
+    POST a chat completion for a model_route() config: picks the primary or
+    fallback target, uses the route's timeout, and leases a key from
+    SARVAM_KEYS unless api_key pins one.
+    """
+    tier, url, model, fixed_key = _pick_target(config)
+    if model != payload.get('model'):
+        payload = dict(payload, model=model)
+    health = target_health(url, model)
+    METRICS.inc('arka_model_requests_total', route=config['route'], model=model, tier=tier)
+    entry = LEDGER_CALL.get()
+    started = time.perf_counter()
+    try:
+        response = _post_chat(url, payload, config['timeout'], fixed_key or api_key)
+    except requests.exceptions.RequestException:
+        health.record(False)
+        if entry is not None:
+            entry.add_attempt(model, 0, time.perf_counter() - started)
+        raise
+    health.record(response.status_code < 500)
+    if entry is not None:
+        entry.add_attempt(model, response.status_code, time.perf_counter() - started)
+    return response
+
+
+def sarvam_should_retry(status_code, attempt, max_attempts):
+    """Retry transient errors, and 401/429 too while another pooled key can take the call."""
+    if attempt >= max_attempts:
+        return False
+    if status_code in (429, 500, 502, 503, 504):
+        return True
+    return status_code in (401, 403) and len(SARVAM_KEYS) > 1 and SARVAM_KEYS.can_failover()
+
+
+def sarvam_retry_delay(status_code, attempt):
+    # A rate-limited or rejected key has just been quarantined; if another key is free, go again immediately
+    if status_code in (401, 403, 429) and len(SARVAM_KEYS) > 1 and SARVAM_KEYS.can_failover():
+        return 0
+    return 2 ** attempt
+
+
+# ── Usage ledger ─────────────────────────────────────────────────────────────
+# One row per logical Sarvam call (however many attempts it took) or cache
+# hit: route, mode, caller identity (as for quotas), pooled key, model, cache
+# status, attempts, prompt/completion tokens, latency and an estimated cost
+# from USAGE_PRICES ("model:prompt_per_1M:completion_per_1M,..."). The ledger
+# is off unless USAGE_DB_PATH is set. Rows are buffered in memory and appended
+# to that SQLite file by a background thread (if it can't be opened, the
+# ledger logs a warning and switches itself off). Every USAGE_ROLLUP_INTERVAL
+# the complete hours are folded into usage_rollups, and raw rows older than
+# USAGE_RETENTION_DAYS are pruned once rolled up. /api/usage and
+# tools/usage_report.py read rollups for old hours and raw rows for recent ones.
+
+usage_log = log.getChild('usage')
+
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", "")
+USAGE_LEDGER_ENABLED = bool(USAGE_DB_PATH)
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
+USAGE_ROLLUP_INTERVAL = float(os.getenv("USAGE_ROLLUP_INTERVAL", "300"))
+USAGE_RETENTION_DAYS = float(os.getenv("USAGE_RETENTION_DAYS", "14"))
+USAGE_BUFFER_MAX = int(os.getenv("USAGE_BUFFER_MAX", "50000"))
+USAGE_BUCKET_SECONDS = 3600
+USAGE_ROLLUP_LAG = 120      # seconds; rows still buffered in any worker land before their hour is folded
+
+# model -> (cost per 1M prompt tokens, cost per 1M completion tokens)
+USAGE_PRICES = {}
+for _spec in os.getenv("USAGE_PRICES", "").split(','):
+    _model, _, _completion = _spec.strip().rpartition(':')
+    _model, _, _prompt = _model.rpartition(':')
+    try:
+        if _model:
+            USAGE_PRICES[_model] = (float(_prompt), float(_completion))
+    except ValueError:
+        pass
+
+USAGE_DIMENSIONS = ('route', 'mode', 'identity', 'key', 'model', 'cache', 'status')
+USAGE_TIME_GROUPS = {'hour': 3600, 'day': 86400}
+
+# The ledger entry for the upstream call in progress; sarvam_post and record_token_usage fill it in
+LEDGER_CALL = contextvars.ContextVar('ledger_call', default=None)
+
+METRICS.counter('arka_usage_ledger_dropped_total', 'Usage ledger rows dropped because the write buffer was full.')
+
+
+class UsageEntry:
+    def __init__(self, route, identity):
+        self.ts = time.time()
+        self.route = route
+        self.mode = ''
+        self.identity = identity
+        self.key = ''
+        self.model = ''
+        self.cache = 'miss'
+        self.status = None          # last upstream HTTP status, 0 for a transport error
+        self.attempts = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.upstream_ms = 0.0
+        self.latency_ms = 0.0
+
+    def add_attempt(self, model, status, seconds):
+        self.attempts += 1
+        self.model = model
+        self.status = status
+        self.upstream_ms += seconds * 1000
+
+    def add_usage(self, usage):
+        usage = usage or {}
+        self.prompt_tokens += int(usage.get('prompt_tokens') or 0)
+        self.completion_tokens += int(usage.get('completion_tokens') or 0)
+
+    @property
+    def cost(self):
+        prompt_price, completion_price = USAGE_PRICES.get(self.model, (0.0, 0.0))
+        return (self.prompt_tokens * prompt_price + self.completion_tokens * completion_price) / 1e6
+
+    def row(self):
+        ok = self.cache != 'miss' or self.status == 200
+        return (self.ts, self.route, self.mode, self.identity, self.key, self.model, self.cache,
+                'ok' if ok else 'error', self.attempts, self.prompt_tokens, self.completion_tokens,
+                round(self.cost, 8), round(self.latency_ms, 3), round(self.upstream_ms, 3))
+
+
+class UsageLedger:
+    """Append-only SQLite ledger of UsageEntry rows with hourly rollups."""
+
+    def __init__(self, path, flush_interval=5.0, rollup_interval=300.0, retention_days=14.0, buffer_max=50000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.rollup_interval = rollup_interval
+        self.retention = retention_days * 86400
+        self._buffer = deque()
+        self.buffer_max = buffer_max
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread = None
+        self._last_rollup = 0.0
+        self.disabled = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS usage_events (
+                ts REAL NOT NULL,
+                route TEXT NOT NULL, mode TEXT NOT NULL, identity TEXT NOT NULL, key TEXT NOT NULL,
+                model TEXT NOT NULL, cache TEXT NOT NULL, status TEXT NOT NULL,
+                attempts INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL,
+                cost REAL NOT NULL, latency_ms REAL NOT NULL, upstream_ms REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS usage_events_ts ON usage_events (ts);
+            CREATE TABLE IF NOT EXISTS usage_rollups (
+                bucket INTEGER NOT NULL,
+                route TEXT NOT NULL, mode TEXT NOT NULL, identity TEXT NOT NULL, key TEXT NOT NULL,
+                model TEXT NOT NULL, cache TEXT NOT NULL, status TEXT NOT NULL,
+                calls INTEGER NOT NULL, retries INTEGER NOT NULL,
+                prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, cost REAL NOT NULL,
+                latency_ms_sum REAL NOT NULL, latency_ms_max REAL NOT NULL, upstream_ms_sum REAL NOT NULL,
+                PRIMARY KEY (bucket, route, mode, identity, key, model, cache, status)
+            );
+            CREATE TABLE IF NOT EXISTS usage_meta (name TEXT PRIMARY KEY, value REAL NOT NULL);
+        """)
+        return conn
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def record(self, entry):
+        if self.disabled:
+            return
+        with self._lock:
+            if len(self._buffer) >= self.buffer_max:
+                self._buffer.popleft()
+                METRICS.inc('arka_usage_ledger_dropped_total')
+            self._buffer.append(entry.row())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='usage-ledger', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        """Write buffered rows; returns how many were written."""
+        with self._lock:
+            rows, self._buffer = list(self._buffer), deque()
+        if rows:
+            conn = self._conn()
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany("INSERT INTO usage_events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def rollup(self, now=None):
+        """Fold raw rows from complete hours into usage_rollups and prune expired raw rows; returns the new watermark."""
+        now = now or time.time()
+        upto = int((now - USAGE_ROLLUP_LAG) // USAGE_BUCKET_SECONDS) * USAGE_BUCKET_SECONDS
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT value FROM usage_meta WHERE name = 'rolled_up_to'").fetchone()
+            start = row[0] if row else 0
+            if upto > start:
+                conn.execute(
+                    "INSERT INTO usage_rollups "
+                    "SELECT CAST(ts / ? AS INTEGER) * ?, route, mode, identity, key, model, cache, status,"
+                    " COUNT(*), SUM(MAX(attempts - 1, 0)), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost),"
+                    " SUM(latency_ms), MAX(latency_ms), SUM(upstream_ms) "
+                    "FROM usage_events WHERE ts >= ? AND ts < ? "
+                    "GROUP BY 1, route, mode, identity, key, model, cache, status "
+                    "ON CONFLICT DO UPDATE SET calls = calls + excluded.calls, retries = retries + excluded.retries,"
+                    " prompt_tokens = prompt_tokens + excluded.prompt_tokens,"
+                    " completion_tokens = completion_tokens + excluded.completion_tokens, cost = cost + excluded.cost,"
+                    " latency_ms_sum = latency_ms_sum + excluded.latency_ms_sum,"
+                    " latency_ms_max = MAX(latency_ms_max, excluded.latency_ms_max),"
+                    " upstream_ms_sum = upstream_ms_sum + excluded.upstream_ms_sum",
+                    (USAGE_BUCKET_SECONDS, USAGE_BUCKET_SECONDS, start, upto),
+                )
+                conn.execute("INSERT INTO usage_meta VALUES ('rolled_up_to', ?) "
+                             "ON CONFLICT(name) DO UPDATE SET value = excluded.value", (upto,))
+                start = upto
+            # Raw rows are kept a while for ad-hoc queries, but only ever pruned once folded
+            conn.execute("DELETE FROM usage_events WHERE ts < ?", (min(start, now - self.retention),))
+        self._last_rollup = time.monotonic()
+        return start
+
+    def _run(self):
+        try:
+            self._conn()
+        except (sqlite3.Error, OSError) as e:
+            # Read-only or serverless filesystem: carry on without a ledger rather than failing requests
+            usage_log.warning("Usage ledger disabled: cannot open database", extra={'path': self.path, 'error': str(e)})
+            self.disabled = True
+            with self._lock:
+                self._buffer.clear()
+            return
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.monotonic() - self._last_rollup >= self.rollup_interval:
+                    self.rollup()
+            except sqlite3.Error as e:
+                usage_log.warning("Usage ledger write failed", extra={'error': str(e)})
+
+    def query(self, since, until=None, group_by=('route', 'mode'), filters=None, limit=100):
+        """
+        Aggregated usage between two epoch timestamps, grouped by any of
+        USAGE_DIMENSIONS plus 'hour'/'day'. Hours already rolled up are
+        counted whole, so since/until are effectively rounded to the hour
+        for them.
+        """
+        until = until or time.time()
+        filters = {k: v for k, v in (filters or {}).items() if k in USAGE_DIMENSIONS and v is not None}
+        columns = []
+        for name in group_by:
+            if name in USAGE_TIME_GROUPS:
+                columns.append((name, f"CAST(ts / {USAGE_TIME_GROUPS[name]} AS INTEGER) * {USAGE_TIME_GROUPS[name]}"))
+            elif name in USAGE_DIMENSIONS:
+                columns.append((name, name))
+            else:
+                raise ValueError(f"Unknown group_by field: {name}")
+        select = ''.join(f"{expr} AS {name}, " for name, expr in columns)
+        where = ' AND '.join(f"{name} = ?" for name in filters) or '1'
+        group = f"GROUP BY {', '.join(str(i + 1) for i in range(len(columns)))} " if columns else ''
+        conn = self._conn()
+        row = conn.execute("SELECT value FROM usage_meta WHERE name = 'rolled_up_to'").fetchone()
+        watermark = row[0] if row else 0
+        sql = (
+            f"SELECT {select}SUM(calls), SUM(retries), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost),"
+            " SUM(CASE WHEN cache != 'miss' THEN calls ELSE 0 END), SUM(CASE WHEN status = 'error' THEN calls ELSE 0 END),"
+            " SUM(latency_ms_sum), MAX(latency_ms_max), SUM(upstream_ms_sum) FROM ("
+            " SELECT bucket AS ts, route, mode, identity, key, model, cache, status, calls, retries, prompt_tokens,"
+            "  completion_tokens, cost, latency_ms_sum, latency_ms_max, upstream_ms_sum"
+            " FROM usage_rollups WHERE bucket >= ? AND bucket < ?"
+            " UNION ALL"
+            " SELECT ts, route, mode, identity, key, model, cache, status, 1, MAX(attempts - 1, 0), prompt_tokens,"
+            "  completion_tokens, cost, latency_ms, latency_ms, upstream_ms"
+            " FROM usage_events WHERE ts >= ? AND ts < ?"
+            f") WHERE {where} {group}ORDER BY SUM(prompt_tokens) + SUM(completion_tokens) DESC, SUM(calls) DESC LIMIT ?"
+        )
+        first_bucket = int(since // USAGE_BUCKET_SECONDS) * USAGE_BUCKET_SECONDS
+        params = [first_bucket, min(until, watermark), max(since, watermark), until, *filters.values(), limit]
+        results = []
+        for values in conn.execute(sql, params):
+            group_values, totals = values[:len(columns)], values[len(columns):]
+            calls, retries, prompt, completion, cost, cache_hits, errors, latency_sum, latency_max, upstream_sum = totals
+            if not calls:
+                continue
+            results.append({
+                **dict(zip((name for name, _ in columns), group_values)),
+                'calls': calls, 'retries': retries, 'cache_hits': cache_hits, 'errors': errors,
+                'prompt_tokens': prompt, 'completion_tokens': completion, 'total_tokens': prompt + completion,
+                'cost': round(cost, 6),
+                'avg_latency_ms': round(latency_sum / calls, 1), 'max_latency_ms': round(latency_max, 1),
+                'avg_upstream_ms': round(upstream_sum / calls, 1),
+            })
+        return results
+
+
+USAGE_LEDGER = UsageLedger(USAGE_DB_PATH, USAGE_FLUSH_INTERVAL, USAGE_ROLLUP_INTERVAL,
+                           USAGE_RETENTION_DAYS, USAGE_BUFFER_MAX)
+
+
+def _ledger_identity():
+    if not has_request_context():
+        return 'internal'
+    quota = g.get('quota')
+    return quota[0] if quota is not None else quota_identity()[0]
+
+
+@contextmanager
+def ledger_call(route):
+    """
+    Account everything inside (every attempt, its tokens, a cache hit) as one
+    ledger row for route. Nested uses share the outer row. Also usable as a
+    decorator; calls that never reached upstream or a cache are not recorded.
+    """
+    if not USAGE_LEDGER_ENABLED or LEDGER_CALL.get() is not None:
+        yield LEDGER_CALL.get()
+        return
+    entry = UsageEntry(route, _ledger_identity())
+    token = LEDGER_CALL.set(entry)
+    started = time.perf_counter()
+    try:
+        yield entry
+    finally:
+        LEDGER_CALL.reset(token)
+        entry.latency_ms = (time.perf_counter() - started) * 1000
+        if entry.attempts or entry.cache != 'miss':
+            USAGE_LEDGER.record(entry)
+
+
+def ledger_note(**fields):
+    """Set fields (mode, cache, key) on the ledger row of the call in progress, if any."""
+    entry = LEDGER_CALL.get()
+    if entry is not None:
+        for name, value in fields.items():
+            setattr(entry, name, value)
+
+
+def parse_usage_time(value, now=None):
+    """Epoch seconds from '90m'/'24h'/'7d' (ago), a number, or an ISO date/datetime (UTC unless it says otherwise)."""
+    now = now or time.time()
+    value = str(value).strip()
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([mhd])', value)
+    if match:
+        return now - float(match.group(1)) * {'m': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+@app.route('/api/usage', methods=['GET'])
+def usage_report():
+    """
+    Aggregated upstream usage: ?since=7d&until=...&group_by=route,mode&route=generate&limit=50.
+    Guarded by METRICS_TOKEN when set.
+    """
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return jsonify({'error': 'Unauthorized.'}), 401
+    if not USAGE_LEDGER_ENABLED or USAGE_LEDGER.disabled:
+        return jsonify({'error': 'The usage ledger is disabled (set USAGE_DB_PATH to a writable path to enable it).'}), 404
+    try:
+        now = time.time()
+        since = parse_usage_time(request.args.get('since', '24h'), now)
+        until = parse_usage_time(request.args['until'], now) if request.args.get('until') else now
+        group_by = [f for f in request.args.get('group_by', 'route,mode').split(',') if f]
+        filters = {name: request.args.get(name) for name in USAGE_DIMENSIONS}
+        USAGE_LEDGER.flush()
+        rows = USAGE_LEDGER.query(since, until, group_by, filters, request.args.get('limit', 100, type=int))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except sqlite3.Error as e:
+        usage_log.warning("Usage query failed", extra={'error': str(e)})
+        return jsonify({'error': 'The usage ledger is unavailable.'}), 503
+    return jsonify({'since': since, 'until': until, 'group_by': group_by, 'rows': rows})
+
+
+# ── Prompt-token budgeting ───────────────────────────────────────────────────
+# Every Sarvam call is checked against its route's max_input_tokens (from
+# MODEL_ROUTES, overridable per route/mode in MODEL_ROUTES_FILE) using a cheap
+# estimate, before any upstream time is spent. Inputs over budget are shrunk
+# deterministically where the route allows it: Mermaid code loses comments and
+# blank lines (refine), the oldest chat turns are dropped (law_chat), and
+# oversized transcript chunks are split (yt_notes). Whatever still doesn't fit
+# is rejected with 413 instead of failing slowly upstream. The estimator and
+# trimming helpers live in api/_budget.py so the Vercel functions share them.
+
+METRICS.counter('arka_prompt_trimmed_total', 'Prompts shrunk to fit the input budget, by route and strategy.')
+METRICS.counter('arka_prompt_rejected_total', 'Prompts rejected before the upstream call for exceeding the input budget, by route.')
+
+
+class PromptBudgetError(Exception):
+    """Input that cannot be trimmed to fit the route's token budget."""
+
+    def __init__(self, route, estimated, limit):
+        super().__init__(over_budget_body(estimated, limit)['error'])
+        self.status = 413
+        self.estimated = estimated
+        self.limit = limit
+        METRICS.inc('arka_prompt_rejected_total', route=route)
+
+    def to_dict(self):
+        return over_budget_body(self.estimated, self.limit)
+
+
+def check_prompt_budget(config, messages):
+    """Raise PromptBudgetError when messages exceed the route's max_input_tokens; returns the estimate."""
+    estimated = messages_tokens(messages)
+    if estimated > config['max_input_tokens']:
+        raise PromptBudgetError(config['route'], estimated, config['max_input_tokens'])
+    return estimated
+
+
+def fit_chat_history(config, messages):
+    """Trim the conversation with drop_oldest_turns; raises PromptBudgetError if even that is too long."""
+    if messages_tokens(messages) <= config['max_input_tokens']:
+        return messages
+    messages = drop_oldest_turns(messages, config['max_input_tokens'])
+    METRICS.inc('arka_prompt_trimmed_total', route=config['route'], strategy='drop_oldest_turns')
+    check_prompt_budget(config, messages)
+    return messages
+
+
+# ── Adaptive concurrency for upstream Sarvam calls ──────────────────────────
+# AdaptiveConcurrencyLimiter lives in api/_notes.py, shared with the Vercel
+# yt-notes function; here it also traces the wait for a slot.
+
+# Shared by every video's chunk fan-out in the process
+SARVAM_NOTES_LIMITER = AdaptiveConcurrencyLimiter(
+    initial=int(os.getenv("YT_NOTES_INITIAL_CONCURRENCY", "4")),
+    max_limit=int(os.getenv("YT_NOTES_MAX_CONCURRENCY", "16")),
+    wait_span=span,
+)
+
+# Shared by single and batch diagram generation
+SARVAM_GENERATE_LIMITER = AdaptiveConcurrencyLimiter(
+    initial=int(os.getenv("GENERATE_INITIAL_CONCURRENCY", "4")),
+    max_limit=int(os.getenv("GENERATE_MAX_CONCURRENCY", "16")),
+    wait_span=span,
+)
+
+
+# ── Generate cache ───────────────────────────────────────────────────────────
+
+class TTLCache:
+    """Small thread-safe LRU cache with per-entry expiry."""
+
+    def __init__(self, name, maxsize=512, ttl=3600):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                METRICS.inc('arka_cache_requests_total', cache=self.name, result='miss')
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            METRICS.inc('arka_cache_requests_total', cache=self.name, result='hit')
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Keyed by (mode, normalized prompt); shared by /api/generate and /api/generate/batch
+GENERATE_CACHE = TTLCache(
+    'generate',
+    maxsize=int(os.getenv("GENERATE_CACHE_SIZE", "512")),
+    ttl=int(os.getenv("GENERATE_CACHE_TTL", "3600")),
+)
+
+
+def _cache_and_limiter_metrics():
+    samples = []
+    for cache in (GENERATE_CACHE, SEMANTIC_CACHE):
+        lookups = cache.hits + cache.misses
+        samples.append(('arka_cache_hit_ratio', {'cache': cache.name}, cache.hits / lookups if lookups else 0.0))
+        samples.append(('arka_cache_entries', {'cache': cache.name}, len(cache)))
+    for name, limiter in (('yt_notes', SARVAM_NOTES_LIMITER), ('generate', SARVAM_GENERATE_LIMITER)):
+        samples.append(('arka_concurrency_limit', {'limiter': name}, limiter.limit))
+    return samples
+
+
+METRICS.add_collector(_cache_and_limiter_metrics)
+
+
+def generate_cache_key(mode, prompt):
+    return (mode, ' '.join(prompt.split()).lower())
+
+
+# ── Semantic cache ───────────────────────────────────────────────────────────
+# Second cache tier behind GENERATE_CACHE for prompts that mean the same thing
+# but are worded differently ("flowchart for user login" / "login flow for a
+# user"). Prompts are vectorised as hashed character n-grams (3-5, within
+# words, so word order doesn't matter) weighted by TF-IDF learned from the
+# cached prompts of that mode, and matched by cosine similarity through an
+# inverted index. Matches above SEMANTIC_DRAFT_THRESHOLD can be streamed to
+# the client as an instant draft while the real generation runs. Character
+# n-grams barely register a changed number or name ("3 month project" /
+# "6 month project" scores ~0.97), so a match is only ever served as a cache
+# hit with SEMANTIC_SERVE=1, at or above SEMANTIC_SERVE_THRESHOLD, and when
+# its numbers, acronyms, capitalised names and quoted strings are exactly the
+# same. Thresholds were picked with tools/eval_semantic_cache.py.
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "1") != "0"
+SEMANTIC_SERVE = os.getenv("SEMANTIC_SERVE", "0") == "1"     # off: near matches are drafts only
+SEMANTIC_SERVE_THRESHOLD = float(os.getenv("SEMANTIC_SERVE_THRESHOLD", "0.8"))
+SEMANTIC_DRAFT_THRESHOLD = float(os.getenv("SEMANTIC_DRAFT_THRESHOLD", "0.55"))
+SEMANTIC_FEATURE_BITS = 20
+
+# Words that carry no meaning inside a per-mode index (the mode already says what kind of diagram it is)
+SEMANTIC_STOPWORDS = frozenset("""
+a an and the of for to in on with by from about into as at is are be this that it its my our your
+diagram diagrams chart charts graph flowchart flow mermaid create generate make draw show please me
+""".split())
+
+
+SEMANTIC_NUMBER_WORDS = frozenset("""
+zero one two three four five six seven eight nine ten eleven twelve twenty thirty fifty hundred thousand
+million billion first second third fourth fifth half quarter
+""".split())
+
+
+def semantic_key_tokens(text):
+    """Tokens a near match must share exactly to be served: numbers, acronyms, capitalised names, quoted strings."""
+    keys = set(re.findall(r'\d+(?:[.,:/-]\d+)*', text))
+    keys.update(q.strip().lower() for q in re.findall(r'"([^"]+)"', text))
+    for i, word in enumerate(re.findall(r"[A-Za-z][A-Za-z'-]*", text)):
+        lower = word.lower()
+        if lower in SEMANTIC_NUMBER_WORDS:
+            keys.add(lower)
+        elif any(c.isupper() for c in word[1:]) or (word[0].isupper() and i > 0):
+            # Acronyms and mixed case anywhere; Title Case only past the first word, where it marks a name
+            keys.add(lower)
+    return keys
+
+
+def semantic_features(text):
+    """Sparse {hashed n-gram: sublinear tf} for a prompt."""
+    mask = (1 << SEMANTIC_FEATURE_BITS) - 1
+    counts = {}
+    for word in re.findall(r'[a-z0-9]+', text.lower()):
+        if word in SEMANTIC_STOPWORDS:
+            continue
+        padded = f" {word} "
+        for n in (3, 4, 5):
+            for i in range(len(padded) - n + 1):
+                h = zlib.crc32(padded[i:i + n].encode()) & mask
+                counts[h] = counts.get(h, 0) + 1
+    return {h: 1.0 + math.log(c) for h, c in counts.items()}
+
+
+class _SemanticModeIndex:
+    # Stored vectors are weighted with the idf of when they were added; once this many
+    # adds and removes (at least a quarter of the index) have shifted df, all are reweighted
+    REWEIGH_MIN_CHANGES = 16
+
+    def __init__(self):
+        self.entries = OrderedDict()    # id -> (expires, prompt, value, features, vector)
+        self.postings = {}              # feature -> {id: weight}
+        self.df = {}                    # feature -> number of entries containing it
+        self.changes = 0                # adds and removes since the last reweigh
+
+    def idf(self, feature):
+        return math.log((len(self.entries) + 1) / (self.df.get(feature, 0) + 1)) + 1.0
+
+    def weigh(self, features):
+        vector = {h: tf * self.idf(h) for h, tf in features.items()}
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+        return {h: w / norm for h, w in vector.items()}
+
+    def add(self, entry_id, expires, prompt, value, features):
+        for h in features:
+            self.df[h] = self.df.get(h, 0) + 1
+        vector = self.weigh(features)
+        for h, w in vector.items():
+            self.postings.setdefault(h, {})[entry_id] = w
+        self.entries[entry_id] = (expires, prompt, value, features, vector)
+        self._changed()
+
+    def remove(self, entry_id):
+        vector = self.entries.pop(entry_id)[4]
+        for h in vector:
+            posting = self.postings[h]
+            del posting[entry_id]
+            if not posting:
+                del self.postings[h]
+            self.df[h] -= 1
+            if not self.df[h]:
+                del self.df[h]
+        self._changed()
+
+    def _changed(self):
+        self.changes += 1
+        if self.changes >= max(self.REWEIGH_MIN_CHANGES, len(self.entries) // 4):
+            self.reweigh()
+
+    def reweigh(self):
+        """Recompute every stored vector and posting with the current idf."""
+        self.postings = {}
+        for entry_id, (expires, prompt, value, features, _) in self.entries.items():
+            vector = self.weigh(features)
+            for h, w in vector.items():
+                self.postings.setdefault(h, {})[entry_id] = w
+            self.entries[entry_id] = (expires, prompt, value, features, vector)
+        self.changes = 0
+
+    def ranked_matches(self, features):
+        """[(entry_id, similarity)] for every entry sharing a feature with the query, best first."""
+        query = self.weigh(features)
+        scores = {}
+        for h, qw in query.items():
+            for entry_id, dw in self.postings.get(h, {}).items():
+                scores[entry_id] = scores.get(entry_id, 0.0) + qw * dw
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class SemanticCache:
+    """Per-mode cosine-similarity index over cached prompts, LRU-bounded per mode with TTL."""
+
+    def __init__(self, name, maxsize_per_mode=256, ttl=3600):
+        self.name = name
+        self.maxsize_per_mode = maxsize_per_mode
+        self.ttl = ttl
+        self._modes = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, mode, prompt, threshold, same_keys=False):
+        """
+        Best (similarity, matched_prompt, value) at or above threshold, or None.
+        With same_keys the match must also have the same semantic_key_tokens.
+        """
+        features = semantic_features(prompt)
+        if not features:
+            return None
+        with self._lock:
+            index = self._modes.get(mode)
+            if index is None or not index.entries:
+                return None
+            now = time.monotonic()
+            # Walk the candidates above the threshold best first, dropping expired ones on the way
+            for entry_id, similarity in index.ranked_matches(features):
+                if similarity < threshold:
+                    break
+                expires, matched, value = index.entries[entry_id][:3]
+                if expires < now:
+                    index.remove(entry_id)
+                    continue
+                if same_keys and semantic_key_tokens(matched) != semantic_key_tokens(prompt):
+                    continue
+                index.entries.move_to_end(entry_id)
+                return similarity, matched, value
+            return None
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        METRICS.inc('arka_cache_requests_total', cache=self.name, result='hit' if hit else 'miss')
+
+    def add(self, mode, prompt, value):
+        features = semantic_features(prompt)
+        if not features:
+            return
+        with self._lock:
+            index = self._modes.setdefault(mode, _SemanticModeIndex())
+            index.add(next(self._ids), time.monotonic() + self.ttl, prompt, value, features)
+            while len(index.entries) > self.maxsize_per_mode:
+                index.remove(next(iter(index.entries)))
+
+    def __len__(self):
+        return sum(len(index.entries) for index in self._modes.values())
+
+
+SEMANTIC_CACHE = SemanticCache(
+    'semantic',
+    maxsize_per_mode=int(os.getenv("SEMANTIC_CACHE_SIZE_PER_MODE", "256")),
+    ttl=int(os.getenv("GENERATE_CACHE_TTL", "3600")),
+)
+
+
+# ── Idempotency keys ─────────────────────────────────────────────────────────
+# Clients retry on their own (law_bot.js fetchWithRetry, double-clicked
+# buttons). A request carrying an Idempotency-Key replays the stored response
+# of an earlier request with the same key for IDEMPOTENCY_TTL seconds instead
+# of calling the upstream again. A duplicate that arrives while the earlier
+# request is still running attaches to it: it waits up to IDEMPOTENCY_WAIT
+# seconds for that response and replays it, and only if the original is still
+# running after that gets 409 with Retry-After (the wait is bounded because it
+# holds an admission slot). If the original fails without a replayable
+# response, the waiting duplicate runs the view itself. Streamed (NDJSON)
+# responses are recorded as they are sent and stored once complete, up to
+# IDEMPOTENCY_MAX_STREAM_BYTES; a stream cut short by a disconnect is not
+# stored. Replays and 409s give back their quota charge. Keys are scoped per
+# route; reusing a key with a different body is rejected with 422. 5xx
+# responses are not stored, so a later retry runs fresh.
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "600"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "2048"))
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT", "10"))
+IDEMPOTENCY_RETRY_AFTER = int(os.getenv("IDEMPOTENCY_RETRY_AFTER", "2"))
+IDEMPOTENCY_MAX_STREAM_BYTES = int(os.getenv("IDEMPOTENCY_MAX_STREAM_BYTES", str(1024 * 1024)))
+IDEMPOTENCY_HASH_CHUNK = 64 * 1024
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+METRICS.counter('arka_idempotency_requests_total', 'Requests carrying an Idempotency-Key, by route and outcome.')
+
+
+class IdempotencyEntry:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.response = None            # (status, headers, body) once finished
+        self.expires = None             # None while in flight
+
+
+class IdempotencyStore:
+    """In-process map of (route, key) -> IdempotencyEntry with TTL and a size bound."""
+
+    def __init__(self, maxsize=2048, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def begin(self, scope, fingerprint):
+        """Return (entry, is_owner). The owner computes the response; everyone else replays it once entry.done is set."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(scope)
+            if entry is not None and entry.expires is not None and entry.expires < now:
+                del self._entries[scope]
+                entry = None
+            if entry is not None:
+                return entry, False
+            entry = self._entries[scope] = IdempotencyEntry(fingerprint)
+            self._evict(now)
+            return entry, True
+
+    def finish(self, scope, entry, status, headers, body):
+        entry.response = (status, headers, body)
+        with self._lock:
+            if status >= 500:
+                if self._entries.get(scope) is entry:
+                    del self._entries[scope]
+            else:
+                entry.expires = time.monotonic() + self.ttl
+        entry.done.set()
+
+    def abandon(self, scope, entry):
+        """Owner could not produce a replayable response (exception or streamed body)."""
+        with self._lock:
+            if self._entries.get(scope) is entry:
+                del self._entries[scope]
+        entry.done.set()
+
+    def _evict(self, now):
+        # Drop expired entries first, then the oldest finished ones; in-flight entries are never evicted
+        for scope in [s for s, e in self._entries.items() if e.expires is not None and e.expires < now]:
+            del self._entries[scope]
+        if len(self._entries) > self.maxsize:
+            for scope in [s for s, e in self._entries.items() if e.expires is not None][:len(self._entries) - self.maxsize]:
+                del self._entries[scope]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+IDEMPOTENCY_STORE = IdempotencyStore(IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_TTL)
+
+
+def _replay(entry, outcome):
+    status, headers, body = entry.response
+    response = Response(body, status=status, headers=headers)
+    response.headers['Idempotent-Replayed'] = 'true'
+    METRICS.inc('arka_idempotency_requests_total', route=_route_label(), outcome=outcome)
+    return response
+
+
+def _request_fingerprint():
+    digest = hashlib.sha256()
+    if request.mimetype == 'multipart/form-data':
+        # The multipart boundary changes on every browser retry; hash the parsed fields and files instead
+        for name, value in sorted(request.form.items(multi=True)):
+            digest.update(f"{name}={value}\0".encode())
+        for name, storage in sorted(request.files.items(multi=True), key=lambda kv: kv[0]):
+            digest.update(f"{name}:{storage.filename}\0".encode())
+            for chunk in iter(lambda: storage.stream.read(IDEMPOTENCY_HASH_CHUNK), b''):
+                digest.update(chunk)
+            storage.stream.seek(0)
+    else:
+        digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _record_stream(scope, entry, response, headers):
+    """Pass a streamed body through, storing it for replay once it has been sent in full."""
+    def body(chunks):
+        recorded, size, complete = [], 0, False
+        try:
+            for chunk in chunks:
+                if recorded is not None:
+                    data = chunk if isinstance(chunk, bytes) else chunk.encode()
+                    size += len(data)
+                    if size <= IDEMPOTENCY_MAX_STREAM_BYTES:
+                        recorded.append(data)
+                    else:
+                        recorded = None
+                yield chunk
+            complete = True
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            if not complete or recorded is None:
+                IDEMPOTENCY_STORE.abandon(scope, entry)
+            else:
+                IDEMPOTENCY_STORE.finish(scope, entry, response.status_code, headers, b''.join(recorded))
+    response.response = body(response.response)
+    return response
+
+
+def idempotent(view):
+    """
+    Route decorator honouring the Idempotency-Key request header. A duplicate of
+    a request still in flight waits up to IDEMPOTENCY_WAIT seconds and replays
+    its response, then falls back to 409 with Retry-After.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key', '').strip()
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return jsonify({'error': f'Idempotency-Key must be at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters.'}), 400
+
+        route = _route_label()
+        scope = (route, key)
+        fingerprint = _request_fingerprint()
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT
+        while True:
+            entry, owner = IDEMPOTENCY_STORE.begin(scope, fingerprint)
+            if entry.fingerprint != fingerprint:
+                METRICS.inc('arka_idempotency_requests_total', route=route, outcome='conflict')
+                return jsonify({'error': 'Idempotency-Key was already used with a different request body.'}), 422
+            if owner:
+                break
+            if entry.done.is_set() and entry.response is not None:
+                refund_quota_request()
+                return _replay(entry, 'replayed')
+            with span('idempotency.wait'):
+                finished = entry.done.wait(max(0.0, deadline - time.monotonic()))
+            if finished and entry.response is not None:
+                refund_quota_request()
+                return _replay(entry, 'attached')
+            if not finished:
+                refund_quota_request()
+                METRICS.inc('arka_idempotency_requests_total', route=route, outcome='in_progress')
+                response = jsonify({'error': 'A request with this Idempotency-Key is still being processed.'})
+                response.headers['Retry-After'] = str(IDEMPOTENCY_RETRY_AFTER)
+                return response, 409
+            # The original was abandoned (it raised, or its stream was cut short); run the view ourselves
+
+        METRICS.inc('arka_idempotency_requests_total', route=route, outcome='executed')
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            IDEMPOTENCY_STORE.abandon(scope, entry)
+            raise
+        headers = [(k, v) for k, v in response.headers.items() if k.lower() not in ('content-length', 'x-request-id', 'x-trace-id', 'server-timing')]
+        if response.is_streamed:
+            return _record_stream(scope, entry, response, headers)
+        IDEMPOTENCY_STORE.finish(scope, entry, response.status_code, headers, response.get_data())
+        return response
+    return wrapper
+
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # Mermaid System Prompts definition
@@ -689,22 +3245,219 @@ def _fix_xychart(code):
     return '\n'.join(fixed)
 
 
+# ── Pre-rendered pages ───────────────────────────────────────────────────────
+# The page templates don't depend on the request, so each is rendered once per
+# template mtime and kept in memory with a strong ETag and gzip/brotli
+# variants. A hit is a dict lookup plus an os.stat: If-None-Match answers 304,
+# otherwise the precompressed bytes for the negotiated encoding are sent.
+# Editing a template (new mtime) re-renders it on the next request.
+
+PAGE_CACHE_ENABLED = os.getenv("PAGE_CACHE_ENABLED", "1") != "0"
+
+
+class RenderedPage:
+    def __init__(self, mtime, html):
+        self.mtime = mtime
+        self.etag = hashlib.sha256(html).hexdigest()[:20]
+        self.variants = {None: html}
+        if len(html) >= COMPRESS_MIN_SIZE:
+            for encoding in AVAILABLE_ENCODINGS:
+                compressed = compress_bytes(html, encoding)
+                if len(compressed) < len(html):
+                    self.variants[encoding] = compressed
+
+
+_PAGE_CACHE = {}
+_page_cache_lock = threading.Lock()
+
+
+def _rendered_page(template):
+    mtime = os.stat(os.path.join(app.root_path, app.template_folder, template)).st_mtime_ns
+    page = _PAGE_CACHE.get(template)
+    if page is not None and page.mtime == mtime:
+        return page
+    with _page_cache_lock:
+        page = _PAGE_CACHE.get(template)
+        if page is None or page.mtime != mtime:
+            page = RenderedPage(mtime, render_template(template).encode('utf-8'))
+            _PAGE_CACHE[template] = page
+    return page
+
+
+def render_page(template):
+    """Serve a request-independent template from the pre-rendered cache, honouring If-None-Match."""
+    if not PAGE_CACHE_ENABLED:
+        return render_template(template)
+    page = _rendered_page(template)
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding'),
+                                  available=[e for e in page.variants if e is not None])
+    response = Response(page.variants[encoding], mimetype='text/html')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    # Each encoding is a different byte sequence, so each gets its own strong ETag
+    response.set_etag(f"{page.etag}-{encoding or 'identity'}")
+    return response.make_conditional(request)
+
+
 @app.route('/')
 @app.route('/index')
 @app.route('/index.html')
 def index():
     """Serve the main frontend page."""
-    return render_template('index.html')
+    return render_page('index.html')
 
 @app.route('/updateslog')
 @app.route('/updates-log')
 @app.route('/updateslog.html')
 def updates_log():
     """Serve the updates log page."""
-    return render_template('updateslog.html')
+    return render_page('updateslog.html')
+
+
+generate_log = log.getChild('generate')
+
+
+class SarvamAPIError(Exception):
+    """Non-retryable (or retries exhausted) failure from the Sarvam API."""
+
+    def __init__(self, message, status=502, detail=None):
+        super().__init__(message)
+        self.status = status
+        self.detail = detail
+
+    def to_dict(self):
+        payload = {'error': str(self)}
+        if self.detail is not None:
+            payload['detail'] = self.detail
+        return payload
+
+
+@ledger_call('generate')
+def generate_mermaid(user_prompt, mode, semantic=True):
+    """
+    Translate a natural language description into Mermaid code via SarvamM,
+    retrying transient failures. Returns (code, usage, cache_hit) where
+    cache_hit is None, {'type': 'exact'} or {'type': 'semantic', ...}.
+    Raises PromptBudgetError, SarvamAPIError or the final requests
+    timeout/connection error.
+    """
+    ledger_note(mode=mode)
+    cache_key = generate_cache_key(mode, user_prompt)
+    cached = GENERATE_CACHE.get(cache_key)
+    if cached is not None:
+        ledger_note(cache='exact')
+        return cached['code'], cached['usage'], {'type': 'exact'}
+    if semantic and SEMANTIC_CACHE_ENABLED and SEMANTIC_SERVE:
+        match = SEMANTIC_CACHE.lookup(mode, user_prompt, SEMANTIC_SERVE_THRESHOLD, same_keys=True)
+        SEMANTIC_CACHE.record(match is not None)
+        if match is not None:
+            similarity, matched_prompt, value = match
+            ledger_note(cache='semantic')
+            return value['code'], value['usage'], {'type': 'semantic', 'similarity': round(similarity, 3),
+                                                   'matched_prompt': matched_prompt}
+
+    route = model_route('generate', mode)
+    payload = sarvam_payload(route, [
+        {
+            'role': 'system',
+            'content': get_system_prompt(mode)
+        },
+        {
+            'role': 'user',
+            'content': f"Generate a {mode} diagram in Mermaid JS for: {user_prompt}"
+        }
+    ])
+    check_prompt_budget(route, payload['messages'])
+
+    # Retry logic for transient API failures
+    MAX_RETRIES = 3
+    bridge_code = None
+    result = {}
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            generate_log.debug("Sending request to Sarvam", extra={'attempt': attempt, 'mode': mode})
+            with SARVAM_GENERATE_LIMITER.slot() as outcome, track_upstream('sarvam', attempt) as track:
+                response = sarvam_post(payload, route)
+                outcome(response.status_code)
+                track(response.status_code)
+
+            if response.status_code != 200:
+                error_detail = response.text
+                generate_log.warning("Sarvam API error", extra={'attempt': attempt, 'status': response.status_code, 'detail': error_detail[:500]})
+                if sarvam_should_retry(response.status_code, attempt, MAX_RETRIES):
+                    time.sleep(sarvam_retry_delay(response.status_code, attempt))
+                    continue
+                raise SarvamAPIError(f'AI service returned status {response.status_code}', 502, error_detail)
+
+            result = json_loads(response.content)
+            content = result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
+            if not content and attempt < MAX_RETRIES:
+                generate_log.warning("Empty content from Sarvam, retrying", extra={'attempt': attempt})
+                time.sleep(2 ** attempt)
+                continue
+            bridge_code = clean_mermaid_code(content, mode)
+            break
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            generate_log.warning("Sarvam request failed", extra={'attempt': attempt, 'error': type(e).__name__})
+            if attempt < MAX_RETRIES:
+                time.sleep(2 ** attempt)
+                continue
+            raise
+
+    if not bridge_code:
+        raise SarvamAPIError('Failed to generate diagram after multiple attempts.', 502)
+
+    usage = result.get('usage', {})
+    record_token_usage('generate', usage)
+    GENERATE_CACHE.set(cache_key, {'code': bridge_code, 'usage': usage})
+    if SEMANTIC_CACHE_ENABLED:
+        SEMANTIC_CACHE.add(mode, user_prompt, {'code': bridge_code, 'usage': usage})
+    return bridge_code, usage, None
+
+
+# User prompts stay out of the default log stream: INFO records carry a hash and length, and the text
+# itself is only logged with LOG_PROMPTS=1 or at DEBUG level
+LOG_PROMPTS = os.getenv("LOG_PROMPTS", "0") == "1"
+
+
+def log_diagram_served(mode, prompt, cache_hit):
+    # The warm-up source is WARMUP_PROMPTS; these records only feed it when they carry the prompt text
+    WARMUP_PROMPTS.record(mode, prompt)
+    normalized = generate_cache_key(mode, prompt)[1]
+    extra = {'mode': mode, 'prompt_sha256': hashlib.sha256(normalized.encode()).hexdigest()[:16],
+             'prompt_length': len(prompt), 'cache': cache_hit['type'] if cache_hit else 'miss'}
+    if LOG_PROMPTS or generate_log.isEnabledFor(logging.DEBUG):
+        extra['prompt'] = prompt
+    generate_log.info("Diagram served", extra=extra)
+
+
+def _stream_with_draft(user_prompt, mode, draft):
+    """
+    NDJSON response for {"draft": true} requests with a near match: the cached
+    diagram for the similar prompt first, then the real generation.
+    """
+    similarity, matched_prompt, value = draft
+
+    def lines():
+        yield ndjson_line({'type': 'draft', 'code': value['code'], 'similarity': round(similarity, 3),
+                          'matched_prompt': matched_prompt})
+        try:
+            code, usage, cache_hit = generate_mermaid(user_prompt, mode, semantic=False)
+            log_diagram_served(mode, user_prompt, cache_hit)
+            yield ndjson_line({'type': 'final', 'success': True, 'code': code, 'usage': usage,
+                              'cached': cache_hit is not None, 'cache': cache_hit})
+        except (PromptBudgetError, SarvamAPIError) as e:
+            yield ndjson_line({'type': 'error', 'status': e.status, **e.to_dict()})
+        except requests.exceptions.RequestException:
+            yield ndjson_line({'type': 'error', 'status': 503, 'error': 'Could not reach the AI service.'})
+
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson')
 
 
 @app.route('/api/generate', methods=['POST'])
+@idempotent
 def generate_diagram():
     """
     Receives a natural language description from the user,
@@ -719,80 +3472,360 @@ def generate_diagram():
         if not user_prompt.strip():
             return jsonify({'error': 'Please provide a description.'}), 400
 
-        # Call Sarvam M API
-        headers = {
-            'Content-Type': 'application/json',
-            'api-subscription-key': SARVAM_API_KEY
-        }
-
-        payload = {
-            'model': 'sarvam-m',
-            'messages': [
-                {
-                    'role': 'system',
-                    'content': get_system_prompt(mode)
-                },
-                {
-                    'role': 'user',
-                    'content': f"Generate a {mode} diagram in Mermaid JS for: {user_prompt}"
-                }
-            ],
-            'temperature': 0.3,
-            'max_tokens': 2048
-        }
-
-        # Retry logic for transient API failures
-        MAX_RETRIES = 3
-        bridge_code = None
-        for attempt in range(1, MAX_RETRIES + 1):
-            try:
-                safe_print(f"[Generate] Attempt {attempt}/{MAX_RETRIES} for mode={mode}")
-                response = requests.post(SARVAM_API_URL, headers=headers, json=payload, timeout=60)
-
-                if response.status_code != 200:
-                    error_detail = response.text
-                    safe_print(f"Sarvam API Error [{response.status_code}]: {error_detail}")
-                    if response.status_code in (429, 500, 502, 503, 504) and attempt < MAX_RETRIES:
-                        time.sleep(2 ** attempt)
-                        continue
-                    return jsonify({
-                        'error': f'AI service returned status {response.status_code}',
-                        'detail': error_detail
-                    }), 502
-
-                result = response.json()
-                content = result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
-                if not content and attempt < MAX_RETRIES:
-                    safe_print(f"[Generate] Empty content on attempt {attempt}, retrying...")
-                    time.sleep(2 ** attempt)
-                    continue
-                bridge_code = clean_mermaid_code(content, mode)
-                break
-            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
-                safe_print(f"[Generate] {type(e).__name__} on attempt {attempt}")
-                if attempt < MAX_RETRIES:
-                    time.sleep(2 ** attempt)
-                    continue
-                raise
+        if data.get('draft') and SEMANTIC_CACHE_ENABLED and GENERATE_CACHE.get(generate_cache_key(mode, user_prompt)) is None:
+            draft = SEMANTIC_CACHE.lookup(mode, user_prompt, SEMANTIC_DRAFT_THRESHOLD)
+            servable = (SEMANTIC_SERVE and draft is not None and draft[0] >= SEMANTIC_SERVE_THRESHOLD
+                        and semantic_key_tokens(draft[1]) == semantic_key_tokens(user_prompt))
+            if draft is not None and not servable:
+                return _stream_with_draft(user_prompt, mode, draft)
 
-        if not bridge_code:
-            return jsonify({'error': 'Failed to generate diagram after multiple attempts.'}), 502
+        bridge_code, usage, cache_hit = generate_mermaid(user_prompt, mode)
+        log_diagram_served(mode, user_prompt, cache_hit)
 
         return jsonify({
             'success': True,
             'code': bridge_code,
-            'usage': result.get('usage', {})
+            'usage': usage,
+            'cached': cache_hit is not None,
+            'cache': cache_hit
         })
 
+    except (PromptBudgetError, SarvamAPIError) as e:
+        return jsonify(e.to_dict()), e.status
     except requests.exceptions.Timeout:
         return jsonify({'error': 'The AI service timed out. Please try again.'}), 504
     except requests.exceptions.ConnectionError:
         return jsonify({'error': 'Could not connect to the AI service.'}), 503
     except Exception as e:
-        print(f"Server error: {str(e)}")
+        generate_log.error("Generate failed", exc_info=True)
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
+
+BATCH_MAX_ITEMS = int(os.getenv("GENERATE_BATCH_MAX_ITEMS", "100"))
+BATCH_MAX_WORKERS = int(os.getenv("GENERATE_BATCH_MAX_WORKERS", "8"))
+
+
+def _generate_batch_item(index, item):
+    """Run one batch item, always returning a result dict instead of raising."""
+    if not isinstance(item, dict):
+        return {'index': index, 'success': False, 'error': 'Item must be an object with prompt and mode.', 'status': 400}
+    prompt = item.get('prompt', '')
+    mode = item.get('mode', 'flowchart')
+    if not isinstance(prompt, str) or not prompt.strip():
+        return {'index': index, 'success': False, 'error': 'Please provide a description.', 'status': 400}
+    try:
+        code, usage, cache_hit = generate_mermaid(prompt, mode)
+        log_diagram_served(mode, prompt, cache_hit)
+        return {'index': index, 'success': True, 'mode': mode, 'code': code, 'usage': usage,
+                'cached': cache_hit is not None, 'cache': cache_hit}
+    except (PromptBudgetError, SarvamAPIError) as e:
+        return {'index': index, 'success': False, 'status': e.status, **e.to_dict()}
+    except requests.exceptions.Timeout:
+        return {'index': index, 'success': False, 'status': 504, 'error': 'The AI service timed out.'}
+    except requests.exceptions.ConnectionError:
+        return {'index': index, 'success': False, 'status': 503, 'error': 'Could not connect to the AI service.'}
+    except Exception as e:
+        return {'index': index, 'success': False, 'status': 500, 'error': f'Server error: {str(e)}'}
+
+
+@app.route('/api/generate/batch', methods=['POST'])
+def generate_diagram_batch():
+    """
+    Generates many diagrams in one request. Body: {"items": [{"prompt", "mode"}, ...], "stream": true}.
+    Items run with bounded parallelism through SARVAM_GENERATE_LIMITER and GENERATE_CACHE.
+    Streams one NDJSON line per item as it finishes (then a summary line), or
+    returns a single JSON body ordered by index when "stream" is false.
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Please provide a non-empty "items" list.'}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'Too many items; the limit is {BATCH_MAX_ITEMS} per batch.'}), 400
+    # Each item is one request's worth of quota; _enforce_quota has charged the first
+    rejected = charge_quota_requests(len(items) - 1)
+    if rejected is not None:
+        return rejected
+
+    def run():
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(BATCH_MAX_WORKERS, len(items)))
+        try:
+            futures = [submit_in_context(executor, _generate_batch_item, i, item) for i, item in enumerate(items)]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+        finally:
+            # On a client disconnect the generator is closed mid-batch: drop the items not yet
+            # started instead of blocking the worker until every queued generation has run
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    if not data.get('stream', True):
+        results = sorted(run(), key=lambda r: r['index'])
+        succeeded = sum(1 for r in results if r['success'])
+        return jsonify({
+            'success': succeeded == len(results),
+            'total': len(results),
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'results': results
+        })
+
+    def stream():
+        succeeded = 0
+        for result in run():
+            succeeded += result['success']
+            yield ndjson_line(result)
+        yield ndjson_line({'done': True, 'total': len(items), 'succeeded': succeeded, 'failed': len(items) - succeeded})
+
+    return Response(stream_with_context(stream()), mimetype='application/x-ndjson')
+
+
+# ── Cache warm-up ────────────────────────────────────────────────────────────
+# After a deploy or cold start GENERATE_CACHE is empty. Every served diagram is
+# counted in WARMUP_PROMPTS, a bounded tally of (mode, prompt) keyed by prompt
+# hash that is saved to WARMUP_PROMPTS_PATH (on by default, "" turns it off)
+# whatever LOG_PROMPTS says. The warmer replays the WARMUP_TOP_N most frequent
+# pairs from that file, then from "Diagram served" records in the JSON-line
+# logs at WARMUP_LOG_PATHS (plain or .gz; only records logged with
+# LOG_PROMPTS=1 or at DEBUG level carry the prompt text), then the curated
+# WARMUP_GALLERY, through generate_mermaid. It runs on a background thread at
+# WARMUP_RATE generations/second and pauses whenever live generate traffic
+# holds more than WARMUP_MAX_LOAD of the admission limit or is queueing.
+# Enable at startup with WARMUP_ON_START=1, or run tools/warm_cache.py against
+# a running app.
+
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "0") == "1"
+WARMUP_LOG_PATHS = [p.strip() for p in os.getenv("WARMUP_LOG_PATHS", "").split(",") if p.strip()]
+WARMUP_PROMPTS_PATH = os.getenv("WARMUP_PROMPTS_PATH", os.path.join(APP_DIR, "warmup_prompts.json"))
+WARMUP_PROMPTS_MAX = int(os.getenv("WARMUP_PROMPTS_MAX", "1000"))
+WARMUP_PROMPTS_SAVE_INTERVAL = float(os.getenv("WARMUP_PROMPTS_SAVE_INTERVAL", "60"))
+WARMUP_TOP_N = int(os.getenv("WARMUP_TOP_N", "50"))
+WARMUP_GALLERY_ENABLED = os.getenv("WARMUP_GALLERY", "1") != "0"
+WARMUP_RATE = float(os.getenv("WARMUP_RATE", "0.5"))
+WARMUP_MAX_LOAD = float(os.getenv("WARMUP_MAX_LOAD", "0.5"))
+
+WARMUP_GALLERY = {
+    'flowchart': ["user login process", "online order checkout", "CI/CD pipeline with build, test and deploy"],
+    'block': ["three-tier web application", "computer hardware components"],
+    'architecture': ["web app with load balancer, API servers and database", "serverless image processing pipeline"],
+    'sequence': ["user logs in with OAuth", "ATM cash withdrawal", "REST API request through a gateway"],
+    'timeline': ["history of the internet", "software product release history"],
+    'gantt': ["website development project plan", "mobile app launch schedule"],
+    'pie': ["monthly household budget", "website traffic sources"],
+    'xy': ["monthly sales for a year", "website visitors per day of the week"],
+    'er': ["e-commerce store with customers, orders and products", "library management system"],
+    'state': ["order lifecycle", "traffic light"],
+    'class': ["library management system", "banking system with accounts and transactions"],
+    'git': ["feature branch workflow with a release", "hotfix merged into main and develop"],
+    'quadrant': ["feature prioritisation by effort and impact", "Eisenhower matrix of tasks"],
+    'treemap': ["machine learning topics", "project planning concepts"],
+}
+
+warmup_log = log.getChild('warmup')
+
+METRICS.counter('arka_cache_warmup_total', 'Cache warm-up items by result (warmed/skipped/failed).')
+
+
+class PromptTally:
+    """
+    Bounded counts of served (mode, prompt) pairs keyed by a hash of the cache
+    key, saved as JSON at most every save_interval seconds and at exit. When
+    full, the least-served pair makes room. Each process saves its own tally,
+    so with several workers the file holds the last one to save.
+    """
+
+    def __init__(self, path, maxsize=1000, save_interval=60):
+        self.path = path
+        self.maxsize = maxsize
+        self.save_interval = save_interval
+        self._entries = {}              # prompt hash -> [mode, prompt, count]
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        if path:
+            self._entries = self._read(path)
+            atexit.register(self.save)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entries = json_loads(f.read())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            warmup_log.warning("Could not read warm-up prompts", exc_info=True, extra={'path': path})
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return {
+            key: list(entry) for key, entry in entries.items()
+            if isinstance(entry, list) and len(entry) == 3 and entry[0] in MERMAID_SYSTEM_PROMPTS
+            and isinstance(entry[1], str) and isinstance(entry[2], int)
+        }
+
+    def record(self, mode, prompt):
+        if not self.path or not prompt.strip():
+            return
+        key = hashlib.sha256('\0'.join(generate_cache_key(mode, prompt)).encode()).hexdigest()[:16]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.maxsize:
+                    del self._entries[min(self._entries, key=lambda k: self._entries[k][2])]
+                entry = self._entries[key] = [mode, prompt, 0]
+            entry[2] += 1
+            self._dirty = True
+            due = time.monotonic() - self._saved_at >= self.save_interval
+        if due:
+            self.save()
+
+    def top(self, n):
+        """The n most served (mode, prompt) pairs, most served first."""
+        with self._lock:
+            ranked = sorted(self._entries.values(), key=lambda entry: entry[2], reverse=True)[:n]
+        return [(mode, prompt) for mode, prompt, _ in ranked]
+
+    def save(self):
+        with self._lock:
+            if not self.path or not self._dirty:
+                return
+            payload = json.dumps(self._entries)
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(tmp, self.path)
+        except OSError:
+            warmup_log.warning("Could not save warm-up prompts", exc_info=True, extra={'path': self.path})
+
+
+WARMUP_PROMPTS = PromptTally(WARMUP_PROMPTS_PATH, WARMUP_PROMPTS_MAX, WARMUP_PROMPTS_SAVE_INTERVAL)
+
+
+def _open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, 'r', encoding='utf-8', errors='replace')
+
+
+def top_logged_prompts(paths, top_n):
+    """Most frequent (mode, prompt) pairs from "Diagram served" log records, most frequent first."""
+    counts = {}
+    originals = {}
+    for path in paths:
+        try:
+            with _open_log(path) as f:
+                for line in f:
+                    if '"Diagram served"' not in line:
+                        continue
+                    try:
+                        record = json_loads(line)
+                    except ValueError:
+                        continue
+                    mode, prompt = record.get('mode'), record.get('prompt')
+                    if mode not in MERMAID_SYSTEM_PROMPTS or not isinstance(prompt, str) or not prompt.strip():
+                        continue
+                    key = generate_cache_key(mode, prompt)
+                    counts[key] = counts.get(key, 0) + 1
+                    originals.setdefault(key, (mode, prompt))
+        except OSError:
+            warmup_log.warning("Could not read warm-up log", exc_info=True, extra={'path': path})
+    ranked = sorted(counts, key=counts.get, reverse=True)[:top_n]
+    return [originals[key] for key in ranked]
+
+
+def warmup_plan(paths=None, top_n=None, gallery=None, tally=None):
+    """Ordered, de-duplicated (mode, prompt) list: tallied favourites, then logged ones, then the gallery."""
+    paths = WARMUP_LOG_PATHS if paths is None else paths
+    top_n = WARMUP_TOP_N if top_n is None else top_n
+    gallery = WARMUP_GALLERY_ENABLED if gallery is None else gallery
+    tally = WARMUP_PROMPTS if tally is None else tally
+    plan = tally.top(top_n) if top_n > 0 else []
+    if paths and top_n > 0:
+        plan += top_logged_prompts(paths, top_n)
+    if gallery:
+        plan += [(mode, prompt) for mode, prompts in WARMUP_GALLERY.items() for prompt in prompts]
+    seen = set()
+    unique = []
+    for mode, prompt in plan:
+        key = generate_cache_key(mode, prompt)
+        if key not in seen:
+            seen.add(key)
+            unique.append((mode, prompt))
+    return unique
+
+
+def live_generate_busy():
+    """True while live generate traffic uses more than WARMUP_MAX_LOAD of its admission limit or is queueing."""
+    snapshot = ADMISSION['generate'].snapshot()
+    return snapshot['queued'] > 0 or snapshot['in_flight'] > snapshot['limit'] * WARMUP_MAX_LOAD
+
+
+class CacheWarmer:
+    """Background thread filling GENERATE_CACHE from a warm-up plan at a bounded rate."""
+
+    def __init__(self, rate=WARMUP_RATE):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.stats = {'planned': 0, 'warmed': 0, 'skipped': 0, 'failed': 0}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, plan):
+        self.stats['planned'] = len(plan)
+        self._thread = threading.Thread(target=self._run, args=(plan,), name='cache-warmer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _count(self, result):
+        self.stats[result] += 1
+        METRICS.inc('arka_cache_warmup_total', result=result)
+
+    def _run(self, plan):
+        warmup_log.info("Cache warm-up started", extra={'items': len(plan)})
+        next_at = time.monotonic()
+        for mode, prompt in plan:
+            if GENERATE_CACHE.get(generate_cache_key(mode, prompt)) is not None:
+                self._count('skipped')
+                continue
+            while not self._stop.is_set() and (time.monotonic() < next_at or live_generate_busy()):
+                self._stop.wait(max(0.1, min(1.0, next_at - time.monotonic())))
+            if self._stop.is_set():
+                break
+            next_at = time.monotonic() + self.interval
+            try:
+                generate_mermaid(prompt, mode, semantic=False)
+                self._count('warmed')
+            except Exception as e:
+                self._count('failed')
+                warmup_log.warning("Warm-up generation failed", extra={'mode': mode, 'error': type(e).__name__})
+        warmup_log.info("Cache warm-up finished", extra=dict(self.stats))
+
+
+CACHE_WARMER = None
+_warmer_lock = threading.Lock()
+
+
+def start_cache_warmup(plan=None):
+    """Start the background warmer once per process; returns it."""
+    global CACHE_WARMER
+    with _warmer_lock:
+        if CACHE_WARMER is None:
+            CACHE_WARMER = CacheWarmer()
+            CACHE_WARMER.start(warmup_plan() if plan is None else plan)
+        return CACHE_WARMER
+
+
+if WARMUP_ON_START:
+    start_cache_warmup()
+
+
 @app.route('/api/refine', methods=['POST'])
+@idempotent
+@ledger_call('refine')
 def refine_diagram():
     """
     Takes existing Bridge Language code and a refinement instruction,
@@ -807,33 +3840,37 @@ def refine_diagram():
         if not instruction.strip():
             return jsonify({'error': 'Please provide a refinement instruction.'}), 400
 
-        headers = {
-            'Content-Type': 'application/json',
-            'api-subscription-key': SARVAM_API_KEY
-        }
+        route = model_route('refine', mode)
+        ledger_note(mode=mode)
 
-        payload = {
-            'model': 'sarvam-m',
-            'messages': [
+        def refine_messages(code):
+            return [
                 {
                     'role': 'system',
                     'content': get_system_prompt(mode)
                 },
                 {
                     'role': 'user',
-                    'content': f"Here is my current {mode} diagram code:\n{current_code}\n\nPlease modify it with this instruction: {instruction}\n\nOutput ONLY the complete updated Mermaid JS code."
+                    'content': f"Here is my current {mode} diagram code:\n{code}\n\nPlease modify it with this instruction: {instruction}\n\nOutput ONLY the complete updated Mermaid JS code."
                 }
-            ],
-            'temperature': 0.3,
-            'max_tokens': 2048
-        }
+            ]
 
-        response = requests.post(SARVAM_API_URL, headers=headers, json=payload, timeout=60)
+        messages = refine_messages(current_code)
+        if messages_tokens(messages) > route['max_input_tokens']:
+            messages = refine_messages(strip_mermaid_noise(current_code))
+            METRICS.inc('arka_prompt_trimmed_total', route='refine', strategy='strip_mermaid_comments')
+        check_prompt_budget(route, messages)
+        payload = sarvam_payload(route, messages)
+
+        with track_upstream('sarvam') as track:
+            response = sarvam_post(payload, route)
+            track(response.status_code)
 
         if response.status_code != 200:
             return jsonify({'error': f'AI service returned status {response.status_code}'}), 502
 
-        result = response.json()
+        result = json_loads(response.content)
+        record_token_usage('refine', result.get('usage'))
         bridge_code = result['choices'][0]['message']['content'].strip()
         bridge_code = clean_mermaid_code(bridge_code, mode)
 
@@ -843,13 +3880,17 @@ def refine_diagram():
             'usage': result.get('usage', {})
         })
 
+    except PromptBudgetError as e:
+        return jsonify(e.to_dict()), e.status
     except Exception as e:
-        print(f"Refine error: {str(e)}")
+        generate_log.error("Refine failed", exc_info=True)
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
 
 # ── AI Legal Assistant Configuration ─────────────────────────────────────────
 
+law_log = log.getChild('lawbot')
+
 LAW_SYSTEM_PROMPT = """You are an AI legal assistant specializing in Indian law. Your goal is to help users with legal issues, such as harassment, unjust fees, consumer rights, etc.
 
 IMPORTANT INTERACTION RULES:
@@ -897,7 +3938,7 @@ ADDITIONAL GUIDELINES:
 @app.route('/law_bot.html')
 def law_bot():
     """Serve the Law Bot frontend page."""
-    return render_template('law_bot.html')
+    return render_page('law_bot.html')
 
 @app.route('/yt-notes')
 @app.route('/yt-notes.html')
@@ -905,25 +3946,25 @@ def law_bot():
 @app.route('/yt_notes.html')
 def yt_notes():
     """Serve the YT Notes frontend page."""
-    return render_template('yt_notes.html')
+    return render_page('yt_notes.html')
 
 @app.route('/login')
 @app.route('/login.html')
 def login():
     """Serve the Login page."""
-    return render_template('login.html')
+    return render_page('login.html')
 
 @app.route('/signup')
 @app.route('/signup.html')
 def signup():
     """Serve the Signup page."""
-    return render_template('signup.html')
+    return render_page('signup.html')
 
 @app.route('/about')
 @app.route('/about.html')
 def about():
     """Serve the About Landing page."""
-    return render_template('about.html')
+    return render_page('about.html')
 
 @app.route('/admin-email')
 def admin_email():
@@ -935,67 +3976,116 @@ def admin_reviews():
     """Serve the Admin Reviews page."""
     return render_template('admin_reviews.html')
 
+# ── Bulk email via Resend ────────────────────────────────────────────────────
+
+# Recipient normalization, the rate limiter and batch sending (with bisection of
+# recipient-specific rejections) live in api/_email.py, shared with the Vercel
+# send-emails function.
+
+
+def send_via_resend(emails, subject, html_body, api_key):
+    """Send through api/_email.py with upstream tracking and the request's context in each batch thread."""
+    return _email.send_via_resend(emails, subject, html_body, api_key, tracker=track_upstream, submit=submit_in_context)
+
+
+# ── Recipient list normalization ────────────────────────────────────────────
+
+CSV_EMAIL_COLUMNS = ('email', 'e-mail', 'email address', 'mail')
+
+
+def iter_csv_emails(stream):
+    """
+    Lazily yield candidate addresses from an uploaded CSV. Uses the column named
+    like 'email' when the header has one, otherwise every cell containing '@'.
+    """
+    reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline=''))
+    email_col = None
+    for row_no, row in enumerate(reader):
+        if row_no == 0:
+            header = [cell.strip().lower() for cell in row]
+            email_col = next((header.index(name) for name in CSV_EMAIL_COLUMNS if name in header), None)
+            if email_col is not None:
+                continue
+        if email_col is not None:
+            if email_col < len(row):
+                yield row[email_col]
+        else:
+            yield from (cell for cell in row if '@' in cell)
+
+
+def bulk_email_admin_key():
+    """
+    The admin key of a bulk-send request, read before any recipients are: the
+    X-Admin-Key header when present (multipart clients should send it, so an
+    unauthorized upload is refused without parsing the form), else the
+    "admin_key" form or JSON field.
+    """
+    key = request.headers.get('X-Admin-Key')
+    if key is not None:
+        return key
+    if request.mimetype == 'multipart/form-data':
+        return request.form.get('admin_key', '')
+    fields = request.get_json(silent=True)
+    return fields.get('admin_key', '') if isinstance(fields, dict) else ''
+
+
+def read_bulk_email_request():
+    """
+    Read a bulk-send request: either JSON ({"emails": [...], ...}) or multipart
+    form fields plus an optional CSV upload in "file", streamed row by row.
+    Returns (fields, emails, report); raises ValueError for a malformed body.
+    """
+    if request.mimetype == 'multipart/form-data':
+        fields = request.form.to_dict()
+        raw = RECIPIENT_SEPARATORS.split(fields.pop('emails', ''))
+        upload = request.files.get('file')
+        if upload:
+            raw = itertools.chain(raw, iter_csv_emails(upload.stream))
+    else:
+        fields = request.get_json()
+        if not isinstance(fields, dict):
+            raise ValueError('Expected a JSON object.')
+        raw = fields.pop('emails', [])
+        if not isinstance(raw, (list, str)):
+            raise ValueError('"emails" must be a list or a string.')
+    emails, report = normalize_recipients(raw)
+    return fields, emails, report
+
+
 @app.route('/api/send-emails', methods=['POST'])
+@idempotent
 def send_emails():
     """Send emails to users via Resend API."""
     try:
-        data = request.get_json()
-        emails = data.get('emails', [])
-        subject = data.get('subject', '')
-        html_body = data.get('html', '')
-        admin_key = data.get('admin_key', '')
-
-        RESEND_API_KEY = os.environ.get('RESEND_API_KEY', '').strip('"\'  ')
-        ADMIN_SECRET = os.environ.get('ADMIN_SECRET', 'arka-dhruv-2026')
-
-        if admin_key != ADMIN_SECRET:
+        if not _is_admin(bulk_email_admin_key()):
             return jsonify({'error': 'Unauthorized. Invalid admin key.'}), 403
 
+        RESEND_API_KEY = os.environ.get('RESEND_API_KEY', '').strip('"\'  ')
         if not RESEND_API_KEY:
             return jsonify({'error': 'RESEND_API_KEY not configured.'}), 500
 
-        if not emails or not subject or not html_body:
+        try:
+            data, valid_emails, recipients = read_bulk_email_request()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        subject = data.get('subject', '')
+        html_body = data.get('html', '')
+
+        if not recipients['received'] or not subject or not html_body:
             return jsonify({'error': 'Missing emails, subject, or html body.'}), 400
 
-        valid_emails = [e.strip() for e in emails if e and '@' in e and '.' in e]
         if not valid_emails:
-            return jsonify({'error': 'No valid email addresses found.'}), 400
+            return jsonify({'error': 'No valid email addresses found.', 'recipients': recipients}), 400
 
-        import urllib.request
-        import json
-
-        sent = 0
-        all_errors = []
-
-        for email in valid_emails:
-            try:
-                data_payload = {
-                    "from": "Arka Team <onboarding@resend.dev>",
-                    "to": [email],
-                    "subject": subject,
-                    "html": html_body
-                }
-                req = urllib.request.Request("https://api.resend.com/emails", data=json.dumps(data_payload).encode('utf-8'))
-                req.add_header('Authorization', f'Bearer {RESEND_API_KEY}')
-                req.add_header('Content-Type', 'application/json')
-                req.add_header('User-Agent', 'Mozilla/5.0')
-                
-                with urllib.request.urlopen(req) as response:
-                    sent += 1
-            except Exception as e:
-                err_body = str(e)
-                if hasattr(e, 'read'):
-                    try:
-                        err_body = e.read().decode('utf-8')
-                    except Exception:
-                        pass
-                all_errors.append(f"{email}: {err_body}")
+        sent, all_errors = send_via_resend(valid_emails, subject, html_body, RESEND_API_KEY)
 
         return jsonify({
             'success': sent == len(valid_emails),
             'sent': sent,
             'failed': len(valid_emails) - sent,
             'total': len(valid_emails),
+            'duplicates_removed': recipients['duplicates_removed'],
+            'invalid': recipients['invalid'],
             'errors': all_errors[:10],
             'error': all_errors[0] if all_errors else None
         })
@@ -1003,7 +4093,364 @@ def send_emails():
     except Exception as e:
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
+
+# ── Durable bulk-email outbox ────────────────────────────────────────────────
+# Jobs and their recipients live in SQLite so a send survives request timeouts
+# and restarts. (job_id, email) is the primary key, so re-enqueueing the same
+# job never double-mails, and workers only ever pick up 'pending' recipients.
+# A claimed batch is leased to one worker (claimed_by, lease_expires); only
+# once the lease expires, because its worker or process died, can another
+# worker reclaim it, so workers in other processes sharing the database never
+# re-send a batch that is still in flight. A relative OUTBOX_DB_PATH is taken
+# relative to this file, not the working directory.
+
+outbox_log = log.getChild('outbox')
+
+OUTBOX_DB_PATH = os.path.join(APP_DIR, os.getenv("OUTBOX_DB_PATH", "outbox.db"))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "5"))    # seconds; doubles per attempt
+OUTBOX_BACKOFF_MAX = 600
+# Longer than the worst-case send of one claimed batch (30s per Resend call, bisected on a bad address)
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "600"))
+_OUTBOX_PROCESS_ID = uuid.uuid4().hex[:12]
+
+_outbox_wakeup = threading.Event()
+_outbox_started = False
+_outbox_resume_checked = False
+_outbox_start_lock = threading.Lock()
+
+
+def _outbox_connect():
+    conn = sqlite3.connect(OUTBOX_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def init_outbox():
+    with closing(_outbox_connect()) as conn:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS email_jobs (
+                id TEXT PRIMARY KEY,
+                subject TEXT NOT NULL,
+                html TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS email_outbox (
+                job_id TEXT NOT NULL,
+                email TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at REAL NOT NULL,
+                claimed_by TEXT,
+                lease_expires REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (job_id, email)
+            );
+            CREATE INDEX IF NOT EXISTS email_outbox_ready ON email_outbox (status, next_attempt_at);
+        """)
+        columns = {r['name'] for r in conn.execute('PRAGMA table_info(email_outbox)')}
+        if 'claimed_by' not in columns:
+            # Databases created before leases; their 'sending' rows have an expired (zero) lease and are reclaimed
+            conn.execute('ALTER TABLE email_outbox ADD COLUMN claimed_by TEXT')
+            conn.execute('ALTER TABLE email_outbox ADD COLUMN lease_expires REAL NOT NULL DEFAULT 0')
+
+
+def enqueue_email_job(emails, subject, html_body, job_id=None):
+    """Persist a job and its recipients; returns (job_id, newly_queued)."""
+    job_id = job_id or uuid.uuid4().hex
+    now = time.time()
+    with closing(_outbox_connect()) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(
+            'INSERT OR IGNORE INTO email_jobs (id, subject, html, created_at) VALUES (?, ?, ?, ?)',
+            (job_id, subject, html_body, now)
+        )
+        before = conn.total_changes
+        conn.executemany(
+            'INSERT OR IGNORE INTO email_outbox (job_id, email, updated_at) VALUES (?, ?, ?)',
+            [(job_id, email, now) for email in emails]
+        )
+        queued = conn.total_changes - before
+        conn.execute('COMMIT')
+    _outbox_wakeup.set()
+    return job_id, queued
+
+
+# Due recipients, plus batches whose worker died mid-send (at-least-once for that batch only)
+_OUTBOX_CLAIMABLE = ("((status = 'pending' AND next_attempt_at <= :now) "
+                     "OR (status = 'sending' AND lease_expires <= :now))")
+
+
+def _claim_outbox_batch(conn, owner):
+    """Atomically lease up to one Resend batch of claimable recipients of a single job to owner."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        now = time.time()
+        row = conn.execute(
+            f"SELECT job_id FROM email_outbox WHERE {_OUTBOX_CLAIMABLE} ORDER BY next_attempt_at LIMIT 1", {'now': now}
+        ).fetchone()
+        if row is None:
+            conn.execute('COMMIT')
+            return None, []
+        job_id = row['job_id']
+        emails = [r['email'] for r in conn.execute(
+            f"SELECT email FROM email_outbox WHERE job_id = :job AND {_OUTBOX_CLAIMABLE} ORDER BY email LIMIT :limit",
+            {'job': job_id, 'now': now, 'limit': RESEND_BATCH_SIZE}
+        )]
+        conn.executemany(
+            "UPDATE email_outbox SET status = 'sending', claimed_by = ?, lease_expires = ?, updated_at = ? "
+            "WHERE job_id = ? AND email = ?",
+            [(owner, now + OUTBOX_LEASE_SECONDS, now, job_id, email) for email in emails]
+        )
+        conn.execute('COMMIT')
+        return job_id, emails
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def _record_outbox_results(conn, job_id, emails, errors, owner):
+    failed = {}
+    for err in errors:
+        email, _, detail = err.partition(': ')
+        failed[email] = detail
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    for email in emails:
+        if email not in failed:
+            conn.execute(
+                "UPDATE email_outbox SET status = 'sent', attempts = attempts + 1, last_error = NULL, updated_at = ?, "
+                "claimed_by = NULL WHERE job_id = ? AND email = ? AND claimed_by = ?", (now, job_id, email, owner)
+            )
+            continue
+        row = conn.execute(
+            'SELECT attempts FROM email_outbox WHERE job_id = ? AND email = ? AND claimed_by = ?', (job_id, email, owner)
+        ).fetchone()
+        if row is None:
+            continue    # lease expired and another worker took the recipient over
+        attempts = row['attempts'] + 1
+        permanent = failed[email].startswith('HTTP 4') and not failed[email].startswith('HTTP 429')
+        if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+            status, next_at = 'failed', now
+        else:
+            status = 'pending'
+            next_at = now + min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+        conn.execute(
+            'UPDATE email_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ?, '
+            'claimed_by = NULL WHERE job_id = ? AND email = ?', (status, attempts, next_at, failed[email][:300], now, job_id, email)
+        )
+    conn.execute('COMMIT')
+
+
+def _outbox_worker():
+    conn = _outbox_connect()
+    session = requests.Session()
+    owner = f"{_OUTBOX_PROCESS_ID}-{threading.current_thread().name}"
+    while True:
+        try:
+            job_id, emails = _claim_outbox_batch(conn, owner)
+            if not emails:
+                _outbox_wakeup.wait(timeout=2)
+                _outbox_wakeup.clear()
+                continue
+            job = conn.execute('SELECT subject, html FROM email_jobs WHERE id = ?', (job_id,)).fetchone()
+            api_key = os.environ.get('RESEND_API_KEY', '').strip('"\'  ')
+            if not api_key:
+                errors = [f"{email}: RESEND_API_KEY not configured." for email in emails]
+            else:
+                # Retries are handled per recipient by the outbox, so each claim makes a single attempt
+                idempotency_key = f"{job_id}-{hashlib.sha256(','.join(emails).encode()).hexdigest()[:32]}"
+                _, errors = send_resend_batch(
+                    session, emails, job['subject'], job['html'], api_key,
+                    max_attempts=1, idempotency_key=idempotency_key, tracker=track_upstream
+                )
+            _record_outbox_results(conn, job_id, emails, errors, owner)
+            outbox_log.info("Outbox batch processed", extra={'job_id': job_id, 'sent': len(emails) - len(errors), 'batch': len(emails)})
+        except Exception as e:
+            outbox_log.error("Outbox worker error", exc_info=True)
+            time.sleep(1)
+
+
+def start_outbox_workers():
+    """Create the schema and start the drain threads (idempotent); interrupted batches are reclaimed when their lease expires."""
+    global _outbox_started
+    with _outbox_start_lock:
+        if _outbox_started:
+            return
+        init_outbox()
+        for i in range(OUTBOX_WORKERS):
+            threading.Thread(target=_outbox_worker, name=f"outbox-worker-{i}", daemon=True).start()
+        _outbox_started = True
+
+
+@app.before_request
+def _resume_outbox():
+    # Resume interrupted jobs on the first request after a restart, without creating the database for apps
+    # that never queue mail. Checked once per process; enqueueing starts the workers itself after that.
+    global _outbox_resume_checked
+    if _outbox_resume_checked:
+        return
+    _outbox_resume_checked = True
+    if os.path.exists(OUTBOX_DB_PATH):
+        start_outbox_workers()
+
+
+def get_email_job_progress(job_id):
+    with closing(_outbox_connect()) as conn:
+        job = conn.execute('SELECT id, subject, created_at FROM email_jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None:
+            return None
+        counts = {r['status']: r['n'] for r in conn.execute(
+            'SELECT status, COUNT(*) AS n FROM email_outbox WHERE job_id = ? GROUP BY status', (job_id,)
+        )}
+        failures = [dict(r) for r in conn.execute(
+            "SELECT email, attempts, last_error FROM email_outbox WHERE job_id = ? AND status = 'failed' "
+            "ORDER BY email LIMIT 100", (job_id,)
+        )]
+    total = sum(counts.values())
+    return {
+        'job_id': job['id'],
+        'subject': job['subject'],
+        'created_at': job['created_at'],
+        'total': total,
+        'sent': counts.get('sent', 0),
+        'failed': counts.get('failed', 0),
+        'pending': counts.get('pending', 0) + counts.get('sending', 0),
+        'done': counts.get('pending', 0) + counts.get('sending', 0) == 0,
+        'failures': failures
+    }
+
+
+def _is_admin(key):
+    return key == os.environ.get('ADMIN_SECRET', 'arka-dhruv-2026')
+
+
+@app.route('/api/send-emails/jobs', methods=['POST'])
+def enqueue_emails():
+    """
+    Queue a bulk send and return immediately with a job ID.
+    Sending a client-chosen "job_id" again is safe: recipients already in the job are ignored.
+    """
+    try:
+        if not _is_admin(bulk_email_admin_key()):
+            return jsonify({'error': 'Unauthorized. Invalid admin key.'}), 403
+
+        try:
+            data, valid_emails, recipients = read_bulk_email_request()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        subject = data.get('subject', '')
+        html_body = data.get('html', '')
+
+        if not recipients['received'] or not subject or not html_body:
+            return jsonify({'error': 'Missing emails, subject, or html body.'}), 400
+
+        if not valid_emails:
+            return jsonify({'error': 'No valid email addresses found.', 'recipients': recipients}), 400
+
+        start_outbox_workers()
+        job_id, queued = enqueue_email_job(valid_emails, subject, html_body, data.get('job_id'))
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'queued': queued,
+            'duplicates_removed': recipients['duplicates_removed'],
+            'invalid': recipients['invalid'],
+            'progress_url': f'/api/send-emails/jobs/{job_id}'
+        }), 202
+
+    except Exception as e:
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+
+@app.route('/api/send-emails/jobs/<job_id>', methods=['GET'])
+def email_job_progress(job_id):
+    """Report sent/failed/pending counts for a queued bulk send."""
+    # Header only: a query-string secret ends up in access logs, proxies and browser history
+    if not _is_admin(request.headers.get('X-Admin-Key', '')):
+        return jsonify({'error': 'Unauthorized. Invalid admin key.'}), 403
+    start_outbox_workers()
+    progress = get_email_job_progress(job_id)
+    if progress is None:
+        return jsonify({'error': 'Unknown job ID.'}), 404
+    return jsonify(progress)
+
+
+def extract_law_json(text):
+    """
+    Robust JSON extraction for law-chat replies: strips BOM and markdown fences,
+    tries a direct parse, then the first balanced {...} object, and finally
+    falls back to wrapping the text as a plain questioning message.
+    """
+    # Step 1: Remove BOM and invisible characters
+    text = text.lstrip('\ufeff\u200b\u200c\u200d')
+
+    # Step 2: Strip ALL markdown code fences (```json ... ``` or ``` ... ```)
+    text = re.sub(r'```(?:json|JSON)?\s*\n?', '', text).strip()
+
+    # Step 3: Try direct JSON parse
+    parsed = None
+    try:
+        parsed = json_loads(text)
+        law_log.debug("Direct JSON parse succeeded")
+    except json.JSONDecodeError:
+        law_log.debug("Direct JSON parse failed, trying extraction")
+
+    # Step 4: If direct parse failed, extract the first complete JSON object
+    if parsed is None:
+        # Find the first '{' and match it to its closing '}'
+        first_brace = text.find('{')
+        if first_brace != -1:
+            depth = 0
+            in_string = False
+            escape_next = False
+            end_pos = -1
+            for i in range(first_brace, len(text)):
+                c = text[i]
+                if escape_next:
+                    escape_next = False
+                    continue
+                if c == '\\' and in_string:
+                    escape_next = True
+                    continue
+                if c == '"' and not escape_next:
+                    in_string = not in_string
+                    continue
+                if not in_string:
+                    if c == '{':
+                        depth += 1
+                    elif c == '}':
+                        depth -= 1
+                        if depth == 0:
+                            end_pos = i
+                            break
+            if end_pos != -1:
+                json_str = text[first_brace:end_pos + 1]
+                try:
+                    parsed = json_loads(json_str)
+                    law_log.debug("Extracted embedded JSON", extra={'start': first_brace, 'end': end_pos})
+                except json.JSONDecodeError:
+                    law_log.debug("Extracted JSON also failed to parse")
+
+    # Step 5: Final fallback — wrap as plain message
+    if parsed is None:
+        law_log.warning("All JSON parsing failed, using plain-message fallback")
+        parsed = {
+            "phase": "questioning",
+            "message": text,
+            "question": "",
+            "options": []
+        }
+    return parsed
+
+
 @app.route('/api/law-chat', methods=['POST'])
+@idempotent
+@ledger_call('law_chat')
 def law_chat():
     """
     Receives user query, sends it to SarvamM with the law system prompt,
@@ -1018,11 +4465,6 @@ def law_chat():
         if not user_prompt.strip():
             return jsonify({'error': 'Please provide a message.'}), 400
 
-        headers = {
-            'Content-Type': 'application/json',
-            'api-subscription-key': SARVAM_API_KEY
-        }
-        
         # Build messages with history
         messages = [
             {'role': 'system', 'content': LAW_SYSTEM_PROMPT}
@@ -1045,12 +4487,8 @@ def law_chat():
         if last_role != 'user' or messages[-1]['content'].strip() != user_prompt.strip():
              messages.append({'role': 'user', 'content': user_prompt})
 
-        payload = {
-            'model': 'sarvam-m',
-            'messages': messages,
-            'temperature': 0.3,
-            'max_tokens': 2048
-        }
+        route = model_route('law_chat')
+        payload = sarvam_payload(route, fit_chat_history(route, messages))
 
         # ── Retry logic for transient Sarvam API failures ─────────────────
         MAX_RETRIES = 3
@@ -1059,17 +4497,17 @@ def law_chat():
 
         for attempt in range(1, MAX_RETRIES + 1):
             try:
-                safe_print(f"[LawBot] Attempt {attempt}/{MAX_RETRIES} - Sending request to Sarvam API...")
-                response = requests.post(SARVAM_API_URL, headers=headers, json=payload, timeout=90)
-                safe_print(f"[LawBot] Sarvam API responded with status: {response.status_code}")
+                law_log.debug("Sending request to Sarvam", extra={'attempt': attempt})
+                with track_upstream('sarvam', attempt) as track:
+                    response = sarvam_post(payload, route)
+                    track(response.status_code)
 
                 if response.status_code != 200:
                     error_detail = response.text
-                    safe_print(f"[LawBot] API Error [{response.status_code}]: {error_detail}")
-                    # 429 (rate limit) and 5xx (server errors) are retryable
-                    if response.status_code in (429, 500, 502, 503, 504) and attempt < MAX_RETRIES:
-                        wait_time = 2 ** attempt  # 2s, 4s, 8s
-                        safe_print(f"[LawBot] Retryable status {response.status_code}, waiting {wait_time}s...")
+                    law_log.warning("Sarvam API error", extra={'attempt': attempt, 'status': response.status_code, 'detail': error_detail[:500]})
+                    # 429 (rate limit) and 5xx (server errors) are retryable; 401/429 fail over to another pooled key at once
+                    if sarvam_should_retry(response.status_code, attempt, MAX_RETRIES):
+                        wait_time = sarvam_retry_delay(response.status_code, attempt)  # 2s, 4s, 8s
                         time.sleep(wait_time)
                         continue
                     return jsonify({
@@ -1078,12 +4516,11 @@ def law_chat():
                     }), 502
 
                 # Check for empty response body
-                response_text = response.text.strip()
-                if not response_text:
-                    safe_print(f"[LawBot] WARNING: Empty response body on attempt {attempt}")
+                response_body = response.content
+                if not response_body.strip():
+                    law_log.warning("Empty response body from Sarvam", extra={'attempt': attempt})
                     if attempt < MAX_RETRIES:
                         wait_time = 2 ** attempt
-                        safe_print(f"[LawBot] Retrying in {wait_time}s...")
                         time.sleep(wait_time)
                         continue
                     return jsonify({
@@ -1092,13 +4529,12 @@ def law_chat():
 
                 # Parse the API response
                 try:
-                    result = json.loads(response_text)
+                    result = json_loads(response_body)
                 except json.JSONDecodeError as je:
-                    safe_print(f"[LawBot] WARNING: Failed to parse API response as JSON on attempt {attempt}: {je}")
-                    safe_print(f"[LawBot] Raw response (first 500 chars): {response_text[:500]}")
+                    law_log.warning("Sarvam response is not JSON", extra={'attempt': attempt, 'error': str(je)})
+                    law_log.debug("Raw Sarvam response", extra={'attempt': attempt, 'body': response_body[:500].decode('utf-8', 'replace')})
                     if attempt < MAX_RETRIES:
                         wait_time = 2 ** attempt
-                        safe_print(f"[LawBot] Retrying in {wait_time}s...")
                         time.sleep(wait_time)
                         continue
                     return jsonify({
@@ -1108,23 +4544,21 @@ def law_chat():
                 # Extract content from choices
                 choices = result.get('choices', [])
                 if not choices or not choices[0].get('message', {}).get('content'):
-                    safe_print(f"[LawBot] WARNING: No valid content in choices on attempt {attempt}")
-                    safe_print(f"[LawBot] Result keys: {list(result.keys())}")
+                    law_log.warning("No content in Sarvam choices", extra={'attempt': attempt, 'keys': list(result.keys())})
                     if attempt < MAX_RETRIES:
                         wait_time = 2 ** attempt
-                        safe_print(f"[LawBot] Retrying in {wait_time}s...")
                         time.sleep(wait_time)
                         continue
                     return jsonify({
                         'error': 'AI service returned a response with no content. Please try again.'
                     }), 502
 
+                record_token_usage('law_chat', result.get('usage'))
                 law_response = choices[0]['message']['content'].strip()
                 if not law_response:
-                    safe_print(f"[LawBot] WARNING: Empty content string on attempt {attempt}")
+                    law_log.warning("Empty content string from Sarvam", extra={'attempt': attempt})
                     if attempt < MAX_RETRIES:
                         wait_time = 2 ** attempt
-                        safe_print(f"[LawBot] Retrying in {wait_time}s...")
                         time.sleep(wait_time)
                         continue
                     return jsonify({
@@ -1132,35 +4566,32 @@ def law_chat():
                     }), 502
 
                 # Successfully got a response — break out of retry loop
-                safe_print(f"[LawBot] Got valid response on attempt {attempt} (length: {len(law_response)})")
+                law_log.info("Got Sarvam response", extra={'attempt': attempt, 'length': len(law_response)})
                 break
 
             except requests.exceptions.Timeout:
                 last_error = 'timeout'
-                safe_print(f"[LawBot] Timeout on attempt {attempt}")
+                law_log.warning("Sarvam request timed out", extra={'attempt': attempt})
                 if attempt < MAX_RETRIES:
                     wait_time = 2 ** attempt
-                    safe_print(f"[LawBot] Retrying in {wait_time}s...")
                     time.sleep(wait_time)
                     continue
                 return jsonify({'error': 'The AI service timed out after multiple retries. Please try again.'}), 504
 
             except requests.exceptions.ConnectionError as e:
                 last_error = str(e)
-                safe_print(f"[LawBot] Connection error on attempt {attempt}: {e}")
+                law_log.warning("Sarvam connection error", extra={'attempt': attempt, 'error': str(e)})
                 if attempt < MAX_RETRIES:
                     wait_time = 2 ** attempt
-                    safe_print(f"[LawBot] Retrying in {wait_time}s...")
                     time.sleep(wait_time)
                     continue
                 return jsonify({'error': 'Could not connect to the AI service after multiple retries.'}), 503
 
             except requests.exceptions.SSLError as e:
                 last_error = str(e)
-                safe_print(f"[LawBot] SSL error on attempt {attempt}: {e}")
+                law_log.warning("Sarvam SSL error", extra={'attempt': attempt, 'error': str(e)})
                 if attempt < MAX_RETRIES:
                     wait_time = 2 ** attempt
-                    safe_print(f"[LawBot] Retrying in {wait_time}s...")
                     time.sleep(wait_time)
                     continue
                 return jsonify({'error': 'SSL connection error after multiple retries.'}), 503
@@ -1169,79 +4600,27 @@ def law_chat():
         if not law_response:
             return jsonify({'error': 'Failed to get a response from the AI service. Please try again.'}), 502
 
-        # ── Robust JSON extraction ───────────────────────────────────────
+        parsed = extract_law_json(law_response)
 
-        # Step 1: Remove BOM and invisible characters
-        law_response = law_response.lstrip('\ufeff\u200b\u200c\u200d')
-
-        # Step 2: Strip ALL markdown code fences (```json ... ``` or ``` ... ```)
-        law_response = re.sub(r'```(?:json|JSON)?\s*\n?', '', law_response).strip()
-
-        # Step 3: Try direct JSON parse
-        parsed = None
-        try:
-            parsed = json.loads(law_response)
-            safe_print(f"[LawBot] Direct JSON parse succeeded")
-        except json.JSONDecodeError:
-            safe_print(f"[LawBot] Direct parse failed, trying extraction...")
-
-        # Step 4: If direct parse failed, extract the first complete JSON object
-        if parsed is None:
-            # Find the first '{' and match it to its closing '}'
-            first_brace = law_response.find('{')
-            if first_brace != -1:
-                depth = 0
-                in_string = False
-                escape_next = False
-                end_pos = -1
-                for i in range(first_brace, len(law_response)):
-                    c = law_response[i]
-                    if escape_next:
-                        escape_next = False
-                        continue
-                    if c == '\\' and in_string:
-                        escape_next = True
-                        continue
-                    if c == '"' and not escape_next:
-                        in_string = not in_string
-                        continue
-                    if not in_string:
-                        if c == '{':
-                            depth += 1
-                        elif c == '}':
-                            depth -= 1
-                            if depth == 0:
-                                end_pos = i
-                                break
-                if end_pos != -1:
-                    json_str = law_response[first_brace:end_pos + 1]
-                    try:
-                        parsed = json.loads(json_str)
-                        safe_print(f"[LawBot] Extracted JSON from position {first_brace}-{end_pos}")
-                    except json.JSONDecodeError:
-                        safe_print(f"[LawBot] Extracted JSON also failed to parse")
-
-        # Step 5: Final fallback — wrap as plain message
-        if parsed is None:
-            safe_print(f"[LawBot] All JSON parsing failed, using fallback")
-            parsed = {
-                "phase": "questioning",
-                "message": law_response,
-                "question": "",
-                "options": []
-            }
-
-        safe_print(f"[LawBot] Successfully processed response (phase: {parsed.get('phase', 'unknown')})")
+        law_log.info("Processed law-chat response", extra={'phase': parsed.get('phase', 'unknown')})
         return jsonify({
             'success': True,
             'response': parsed
         })
 
+    except PromptBudgetError as e:
+        return jsonify(e.to_dict()), e.status
     except Exception as e:
-        safe_print(f"[LawBot] ERROR: {type(e).__name__}: {str(e)}")
+        law_log.error("Law chat failed", exc_info=True)
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
 
+# ── Map-reduce notes pipeline ───────────────────────────────────────────────
+
+notes_log = log.getChild('yt_notes')
+# The outline map-reduce and near-duplicate chunk detection live in
+# api/_notes.py so the Vercel yt-notes function runs the same code.
+
 def extract_video_id(url):
     match = re.search(r"(?:v=|\/)([0-9A-Za-z_-]{11}).*", url)
     return match.group(1) if match else None
@@ -1269,14 +4648,16 @@ def chunk_text(text, max_length=1400):
 
 def fetch_transcript_from_supadata(video_id: str):
     supadata_key = "sd_14a060fc8a6b311244d92b1661d00fe5"
-    url = f"https://api.supadata.ai/v1/transcript?url=https://www.youtube.com/watch?v={video_id}&text=true"
+    url = f"{SUPADATA_API_URL}/v1/transcript?url=https://www.youtube.com/watch?v={video_id}&text=true"
     headers = {"x-api-key": supadata_key}
     
-    response = requests.get(url, headers=headers, timeout=30)
+    with track_upstream('supadata') as track:
+        response = requests.get(url, headers=headers, timeout=30)
+        track(response.status_code)
     if response.status_code != 200:
         raise Exception(f"Supadata API Error {response.status_code}")
     
-    data = response.json()
+    data = json_loads(response.content)
     if "content" in data:
         return data["content"]
     elif "text" in data:
@@ -1284,49 +4665,66 @@ def fetch_transcript_from_supadata(video_id: str):
     else:
         return str(data)
 
-def get_sarvam_notes(chunk, chunk_idx, total_chunks, attempt=1, api_key=None):
-    if not api_key:
-        api_key = SARVAM_API_KEY
-    if not api_key:
+NOTES_MAX_CHUNK_SPLIT = int(os.getenv("YT_NOTES_MAX_CHUNK_SPLIT", "4"))
+
+
+def split_notes_chunk(chunk, config):
+    """A client-posted chunk as pieces that each fit the notes input budget; PromptBudgetError past NOTES_MAX_CHUNK_SPLIT."""
+    limit = config['max_input_tokens'] - NOTES_PROMPT_RESERVE
+    pieces = split_chunk_to_budget(chunk, limit, NOTES_MAX_CHUNK_SPLIT)
+    if pieces is None:
+        raise PromptBudgetError(config['route'], estimate_tokens(chunk), limit * NOTES_MAX_CHUNK_SPLIT)
+    if len(pieces) > 1:
+        METRICS.inc('arka_prompt_trimmed_total', route=config['route'], strategy='split_chunk')
+    return pieces
+
+
+@ledger_call('yt_notes')
+def get_sarvam_notes(chunk, chunk_idx, total_chunks, attempt=1, api_key=None, outline=False):
+    # api_key pins one key; by default each chunk leases its own key from SARVAM_KEYS, spreading the fan-out
+    if not api_key and not SARVAM_KEYS:
         return "[Error: SARVAM_API_KEY is not set on the server]"
 
-    headers = {
-        'Content-Type': 'application/json',
-        'api-subscription-key': api_key
-    }
-    
-    system_prompt = (
-        "You are an expert academic tutor creating educational notes from a transcript. "
-        f"You are processing piece {chunk_idx} of {total_chunks}. "
-        "CRITICAL INSTRUCTIONS:\n"
-        "1. Write the notes in English by default. Use a professional, academic tone suitable for studying and memorization.\n"
-        "2. DO NOT mention the words 'video', 'speaker', or 'lecture'. It must read like a standalone textbook section.\n"
-        "3. Structure logically with clear nested headings (<h2>, <h3>), bullet points, and emphasized keywords (<strong>).\n"
-        "4. Your output MUST be pure HTML code containing ONLY content tags (<h2>, <h3>, <p>, <ul>, <li>, <strong>, <em>, <br>).\n"
-        "5. Do NOT output <html>, <head>, or <body> tags. Do NOT use inline CSS styles.\n"
-        "6. DO NOT wrap your response in markdown code blocks like ```html. Output raw HTML text only."
-    )
-    
-    payload = {
-        'model': 'sarvam-m',
-        'messages': [
-            {'role': 'system', 'content': system_prompt},
-            {'role': 'user', 'content': f"Generate detailed notes for this transcript segment: {chunk}"}
-        ],
-        'temperature': 0.3,
-        'max_tokens': 2048
-    }
+    if outline:
+        # Map stage of the map-reduce pipeline: a compact JSON outline costs far fewer output tokens than styled HTML
+        system_prompt = get_notes_outline_prompt(chunk_idx, total_chunks)
+        user_content = f"Generate a compact JSON outline of notes for this transcript segment: {chunk}"
+    else:
+        system_prompt = (
+            "You are an expert academic tutor creating educational notes from a transcript. "
+            f"You are processing piece {chunk_idx} of {total_chunks}. "
+            "CRITICAL INSTRUCTIONS:\n"
+            "1. Write the notes in English by default. Use a professional, academic tone suitable for studying and memorization.\n"
+            "2. DO NOT mention the words 'video', 'speaker', or 'lecture'. It must read like a standalone textbook section.\n"
+            "3. Structure logically with clear nested headings (<h2>, <h3>), bullet points, and emphasized keywords (<strong>).\n"
+            "4. Your output MUST be pure HTML code containing ONLY content tags (<h2>, <h3>, <p>, <ul>, <li>, <strong>, <em>, <br>).\n"
+            "5. Do NOT output <html>, <head>, or <body> tags. Do NOT use inline CSS styles.\n"
+            "6. DO NOT wrap your response in markdown code blocks like ```html. Output raw HTML text only."
+        )
+        user_content = f"Generate detailed notes for this transcript segment: {chunk}"
+
+    route = model_route('yt_notes', 'outline' if outline else None)
+    ledger_note(mode='outline' if outline else 'html')
+    payload = sarvam_payload(route, [
+        {'role': 'system', 'content': system_prompt},
+        {'role': 'user', 'content': user_content}
+    ])
+    check_prompt_budget(route, payload['messages'])
 
     try:
-        response = requests.post(SARVAM_API_URL, headers=headers, json=payload, timeout=60)
+        with SARVAM_NOTES_LIMITER.slot() as outcome, track_upstream('sarvam', attempt) as track:
+            response = sarvam_post(payload, route, api_key=api_key)
+            outcome(response.status_code)
+            track(response.status_code)
         if response.status_code == 200:
-            result = response.json()
+            result = json_loads(response.content)
+            record_token_usage('yt_notes', result.get('usage'))
             res = result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
             res = res.replace("```html", "").replace("```", "").strip()
             return res
-        elif attempt < 3 and response.status_code in (429, 500, 502, 503, 504):
-            time.sleep(2 ** attempt)
-            return get_sarvam_notes(chunk, chunk_idx, total_chunks, attempt + 1, api_key)
+        elif sarvam_should_retry(response.status_code, attempt, 3):
+            time.sleep(sarvam_retry_delay(response.status_code, attempt))
+            return get_sarvam_notes(chunk, chunk_idx, total_chunks, attempt + 1, api_key, outline)
         else:
             detail = ""
             try:
@@ -1340,10 +4738,11 @@ def get_sarvam_notes(chunk, chunk_idx, total_chunks, attempt=1, api_key=None):
     except Exception as e:
         if attempt < 3:
             time.sleep(2 ** attempt)
-            return get_sarvam_notes(chunk, chunk_idx, total_chunks, attempt + 1, api_key)
+            return get_sarvam_notes(chunk, chunk_idx, total_chunks, attempt + 1, api_key, outline)
         return f"[Error connecting to AI: {str(e)}]"
 
 @app.route('/api/yt-notes', methods=['POST'])
+@idempotent
 def generate_yt_notes():
     try:
         data = request.get_json()
@@ -1353,16 +4752,41 @@ def generate_yt_notes():
             chunk = data.get('chunk', '')
             chunk_idx = data.get('chunk_idx', 1)
             total_chunks = data.get('total_chunks', 1)
-            if not SARVAM_API_KEY:
+            if not SARVAM_KEYS:
                 return jsonify({'error': 'Server is missing SARVAM_API_KEY. Set it in environment.'}), 500
             
-            result = get_sarvam_notes(chunk, chunk_idx, total_chunks, 1, SARVAM_API_KEY)
+            outline_mode = data.get('format') == 'outline'
+            # Client-chosen chunk sizes: split anything over the input budget instead of sending it whole
+            pieces = split_notes_chunk(chunk, model_route('yt_notes', 'outline' if outline_mode else None))
+            results = [get_sarvam_notes(piece, chunk_idx, total_chunks, 1, None, outline_mode) for piece in pieces]
+            result = '\n'.join(results)
             # If the result suggests failure, throw error.
             if "invalid_api_key_error" in result or "SARVAM_API_KEY" in result:
                 return jsonify({'error': 'Sarvam authentication failed.', 'html': result}), 502
-                
+            if any(is_chunk_error(r) for r in results):
+                # Report the failure so the client can flag the page, rather than returning an empty outline
+                return jsonify({'error': f'Could not generate notes for chunk {chunk_idx}.', 'details': results}), 502
+
+            if outline_mode:
+                outline = reduce_outlines([outline_from_chunk_result(r) for r in results])
+                return jsonify({'success': True, 'outline': outline, 'html': result})
             return jsonify({'success': True, 'html': result})
 
+        if action == 'reduce':
+            # Reduce stage for clients that drove the map stage chunk-by-chunk
+            raw_outlines = data.get('outlines', [])
+            if not isinstance(raw_outlines, list):
+                return jsonify({'error': '"outlines" must be a list.'}), 400
+            try:
+                # Chunks whose map stage failed come back as null; skip them
+                outlines = [validate_client_outline(o) for o in raw_outlines if o is not None]
+            except ValueError as e:
+                return jsonify({'error': f'Invalid outline: {e}.'}), 400
+            notes = render_outline_html(reduce_outlines(outlines))
+            if not notes.strip():
+                return jsonify({'error': 'Failed to generate notes.'}), 502
+            return jsonify({'success': True, 'notes': notes})
+
         url = data.get('url', '')
         if not url.strip():
             return jsonify({'error': 'Please provide a YouTube URL.'}), 400
@@ -1372,25 +4796,36 @@ def generate_yt_notes():
             return jsonify({'error': 'Invalid YouTube URL or Video ID not found.'}), 400
 
         try:
-            full_transcript = fetch_transcript_from_supadata(video_id)
+            with span('supadata.fetch_transcript', video_id=video_id):
+                full_transcript = fetch_transcript_from_supadata(video_id)
             if not full_transcript or len(str(full_transcript)) < 10:
                 return jsonify({'error': 'Transcript was retrieved but contained no text.'}), 400
         except Exception as e:
             return jsonify({'error': f'Could not extract transcript: {str(e)}'}), 400
 
-        chunks = chunk_text(full_transcript, 500)
-        
+        with span('yt_notes.chunking', transcript_chars=len(full_transcript)) as chunking:
+            chunks, dedup_report = dedupe_chunks(chunk_text(full_transcript, 500))
+            if chunking is not None:
+                chunking.attributes.update(chunks=len(chunks), duplicates=dedup_report['upstream_calls_avoided'])
+        notes_log.info("Chunked transcript", extra={'video_id': video_id, 'chunks': dedup_report['total_chunks'], 'upstream_calls_avoided': dedup_report['upstream_calls_avoided']})
+
         if action == 'extract':
-            return jsonify({'success': True, 'chunks': chunks, 'total_chunks': len(chunks)})
+            return jsonify({'success': True, 'chunks': chunks, 'total_chunks': len(chunks), 'dedup': dedup_report})
             
-        if not SARVAM_API_KEY:
+        if not SARVAM_KEYS:
             return jsonify({'error': 'Server is missing SARVAM_API_KEY. Set it in environment or .env.'}), 500
 
-        api_key = SARVAM_API_KEY
         total_chunks = len(chunks)
-        max_workers = min(10, total_chunks) if chunks else 1
+        # Real parallelism is governed by SARVAM_NOTES_LIMITER; the pool only needs to be big enough to reach its ceiling
+        max_workers = min(SARVAM_NOTES_LIMITER.max_limit, total_chunks) if chunks else 1
+
+        def map_chunk(chunk, chunk_idx, submitted):
+            # queue_wait_ms: time spent waiting for a pool thread; limiter waits show up as their own span
+            with span('yt_notes.chunk', chunk=chunk_idx, queue_wait_ms=round((time.perf_counter() - submitted) * 1000, 1)):
+                return get_sarvam_notes(chunk, chunk_idx, total_chunks, 1, None, True)
+
         with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_chunk = {executor.submit(get_sarvam_notes, chunk, i+1, total_chunks, 1, api_key): i for i, chunk in enumerate(chunks)}
+            future_to_chunk = {submit_in_context(executor, map_chunk, chunk, i+1, time.perf_counter()): i for i, chunk in enumerate(chunks)}
             results = [None] * total_chunks
             for future in concurrent.futures.as_completed(future_to_chunk):
                 i = future_to_chunk[future]
@@ -1399,22 +4834,33 @@ def generate_yt_notes():
                 except Exception as e:
                     results[i] = f"[Error processing chunk {i+1}]"
                     
-        body_notes = "\n\n".join([r for r in results if r])
-        final_notes = "\n\n".join([r for r in results if r])
+        # Reduce: merge the per-chunk outlines into one deduplicated document
+        with span('yt_notes.reduce', outlines=len(results)):
+            final_notes = render_outline_html(reduce_outlines([outline_from_chunk_result(r) for r in results]))
 
         # If every chunk failed with an auth/config error, return as API error (so UI shows toast)
+        if any(results) and all(isinstance(r, str) and ("invalid_api_key_error" in r or "SARVAM_API_KEY" in r) for r in results if r):
+            return jsonify({'error': 'Sarvam authentication failed. Check SARVAM_API_KEY.', 'details': results}), 502
         if not final_notes.strip():
             return jsonify({'error': 'Failed to generate notes.', 'details': results}), 502
-        if all(isinstance(r, str) and ("invalid_api_key_error" in r or "SARVAM_API_KEY" in r) for r in results if r):
-            return jsonify({'error': 'Sarvam authentication failed. Check SARVAM_API_KEY.', 'details': results}), 502
 
+        failed_chunks = [i + 1 for i, r in enumerate(results) if is_chunk_error(r)]
+        if failed_chunks:
+            notes_log.warning("Chunks missing from notes", extra={'failed_chunks': failed_chunks, 'chunks': total_chunks})
+        concurrency = SARVAM_NOTES_LIMITER.snapshot()
+        notes_log.info("Notes generated", extra={'chunks': total_chunks, 'concurrency_limit': concurrency['limit']})
         return jsonify({
             'success': True,
-            'notes': final_notes
+            'notes': final_notes,
+            'failed_chunks': failed_chunks,
+            'concurrency': concurrency,
+            'dedup': dedup_report
         })
 
+    except PromptBudgetError as e:
+        return jsonify(e.to_dict()), e.status
     except Exception as e:
-        safe_print(f"[YTNotes] Server error: {str(e)}")
+        notes_log.error("YT notes failed", exc_info=True)
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
 
@@ -63,6 +63,87 @@ async function safeJsonParse(response) {
     }
 }
 
+// Reads a generate response. With {draft: true} the server may answer with
+// NDJSON instead: a draft diagram from a similar cached prompt (passed to
+// onDraft) followed by the final one. Resolves to the final JSON body.
+async function readGenerateResponse(response, onDraft) {
+    const contentType = response.headers.get('Content-Type') || '';
+    if (!contentType.includes('application/x-ndjson') || !response.body) {
+        return safeJsonParse(response);
+    }
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let final = null;
+    for (;;) {
+        const { value, done } = await reader.read();
+        buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+        let newline;
+        while ((newline = buffer.indexOf('\n')) >= 0) {
+            const line = buffer.slice(0, newline).trim();
+            buffer = buffer.slice(newline + 1);
+            if (!line) continue;
+            const message = JSON.parse(line);
+            if (message.type === 'draft') {
+                await onDraft(message);
+            } else if (message.type === 'error') {
+                throw new Error(message.error || 'Generation failed');
+            } else {
+                final = message;
+            }
+        }
+        if (done) break;
+    }
+    if (!final) throw new Error('Generation stream ended early');
+    return final;
+}
+
+// ── Idempotency keys ────────────────────────────────────────────────────
+// An identical request body sent again within a few seconds (double-click,
+// Enter + click) reuses the same Idempotency-Key, so the server answers it
+// from the request already made instead of calling the AI twice.
+const IDEMPOTENCY_REUSE_MS = 10000;
+const recentIdempotencyKeys = new Map();
+
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
+}
+
+function idempotencyKeyFor(body) {
+    const now = Date.now();
+    for (const [b, entry] of recentIdempotencyKeys) {
+        if (now - entry.at > IDEMPOTENCY_REUSE_MS) recentIdempotencyKeys.delete(b);
+    }
+    const existing = recentIdempotencyKeys.get(body);
+    if (existing) return existing.key;
+    const key = newIdempotencyKey();
+    recentIdempotencyKeys.set(body, { key, at: now });
+    return key;
+}
+
+// A duplicate of a request the server is still running gets 409 + Retry-After;
+// wait and ask again until the stored response can be replayed.
+async function fetchIdempotent(url, options, maxPolls = 90) {
+    for (let poll = 0; ; poll++) {
+        const response = await fetch(url, options);
+        if (response.status !== 409 || poll >= maxPolls) return response;
+        const waitSeconds = parseFloat(response.headers.get('Retry-After')) || 2;
+        await new Promise(r => setTimeout(r, waitSeconds * 1000));
+    }
+}
+
+// Firebase ID token for server-side per-user quotas (falls back to per-IP without it)
+async function authHeader() {
+    const user = firebase.auth().currentUser;
+    if (!user) return {};
+    try {
+        return { 'Authorization': 'Bearer ' + await user.getIdToken() };
+    } catch (e) {
+        return {};
+    }
+}
+
 // ── Error Reporting & Screenshots ───────────────────────────────────────
 async function triggerErrorReport(errorMessage) {
     if (typeof html2canvas === 'undefined') return;
@@ -550,13 +631,18 @@ async function handleGenerate() {
     const generateEndpoint = getApiUrl('/api/generate');
 
     try {
-        const response = await fetch(generateEndpoint, {
+        const body = JSON.stringify({ prompt, mode: currentMode, draft: true });
+        const response = await fetchIdempotent(generateEndpoint, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ prompt, mode: currentMode })
+            headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKeyFor(body), ...(await authHeader()) },
+            body
         });
 
-        const data = await safeJsonParse(response);
+        const data = await readGenerateResponse(response, async (draft) => {
+            // Show the near match right away; the final diagram replaces it when it arrives
+            await renderFromCode(draft.code);
+            updateStatus('loading', 'Draft shown, refining...');
+        });
 
         if (!response.ok) {
             throw new Error(data.error || 'Generation failed');
@@ -625,10 +711,11 @@ async function handleRefine() {
     const backupCode = currentMermaidCode;
 
     try {
-        const response = await fetch(refineEndpoint, {
+        const body = JSON.stringify({ current_code: currentMermaidCode, instruction, mode: currentMode });
+        const response = await fetchIdempotent(refineEndpoint, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ current_code: currentMermaidCode, instruction, mode: currentMode })
+            headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKeyFor(body), ...(await authHeader()) },
+            body
         });
 
         const data = await safeJsonParse(response);
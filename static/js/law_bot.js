@@ -190,6 +190,15 @@ document.addEventListener('DOMContentLoaded', () => {
     // ── Fetch with retry (handles empty responses and JSON parse errors) ──
     async function fetchWithRetry(url, options, maxRetries = 2) {
         let lastError;
+        // One key for all attempts: a retry replays the server-side request instead of starting another
+        const idempotencyKey = (window.crypto && crypto.randomUUID)
+            ? crypto.randomUUID()
+            : Date.now().toString(36) + Math.random().toString(36).slice(2);
+        options = { ...options, headers: { ...(options.headers || {}), 'Idempotency-Key': idempotencyKey, 'X-Request-Timeout': '150' } };
+        if (currentUser) {
+            // Firebase ID token lets the server apply per-user rather than per-IP quotas
+            try { options.headers['Authorization'] = 'Bearer ' + await currentUser.getIdToken(); } catch (e) { /* per-IP quota */ }
+        }
         for (let attempt = 1; attempt <= maxRetries; attempt++) {
             try {
                 console.log(`[LawBot] API attempt ${attempt}/${maxRetries} → ${url}`);
@@ -199,7 +208,13 @@ document.addEventListener('DOMContentLoaded', () => {
                 const timeoutId = setTimeout(() => controller.abort(), 150000);
                 const fetchOptions = { ...options, signal: controller.signal };
 
-                const response = await fetch(url, fetchOptions);
+                let response = await fetch(url, fetchOptions);
+                // 409: the earlier attempt is still running server-side; poll until its response can be replayed
+                for (let poll = 0; response.status === 409 && poll < 75; poll++) {
+                    const waitSeconds = parseFloat(response.headers.get('Retry-After')) || 2;
+                    await new Promise(r => setTimeout(r, waitSeconds * 1000));
+                    response = await fetch(url, fetchOptions);
+                }
                 clearTimeout(timeoutId);
 
                 console.log(`[LawBot] Response status: ${response.status}`);
@@ -0,0 +1,94 @@
+"""Shared fixtures: app.py with a fake Sarvam upstream, and loaders for the Vercel functions in api/."""
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_DIR = tempfile.mkdtemp(prefix='arka-tests-')
+
+os.environ.update({
+    'SARVAM_API_KEY': 'test-key',
+    'QUOTA_ENABLED': '0',
+    'LOG_LEVEL': 'ERROR',
+    'OUTBOX_DB_PATH': os.path.join(STATE_DIR, 'outbox.db'),
+    'WARMUP_PROMPTS_PATH': os.path.join(STATE_DIR, 'warmup_prompts.json'),
+})
+os.environ.pop('USAGE_DB_PATH', None)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'api'))
+
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200):
+        self.status_code = status_code
+        self.content = json.dumps(payload).encode()
+        self.text = self.content.decode()
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class FakeSarvam:
+    """Stands in for requests.post; answers each chat call with the next queued reply (the last one repeats)."""
+
+    def __init__(self):
+        self.replies = ['']
+        self.calls = []
+
+    def reply_with(self, *contents):
+        self.replies = list(contents)
+
+    def __call__(self, url, headers=None, data=None, timeout=None, json=None, **kwargs):
+        self.calls.append(data if data is not None else json)
+        content = self.replies.pop(0) if len(self.replies) > 1 else self.replies[0]
+        if isinstance(content, FakeResponse):
+            return content
+        return FakeResponse({'choices': [{'message': {'content': content}}], 'usage': {'total_tokens': 10}})
+
+
+@pytest.fixture
+def app_module():
+    import app
+    return app
+
+
+@pytest.fixture
+def sarvam(app_module, monkeypatch):
+    fake = FakeSarvam()
+    monkeypatch.setattr(app_module.requests, 'post', fake)
+    return fake
+
+
+@pytest.fixture
+def client(app_module, sarvam):
+    return app_module.app.test_client()
+
+
+def load_function(name):
+    """Import api/<name>.py (the file names contain dashes, so not importable by name)."""
+    spec = importlib.util.spec_from_file_location('api_' + name.replace('-', '_'), os.path.join(ROOT, 'api', name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def call_function(module, body, headers=None):
+    """Drive a Vercel handler's do_POST with a JSON body; returns (status, headers, parsed body)."""
+    raw = json.dumps(body).encode()
+    handler = module.handler.__new__(module.handler)
+    handler.headers = {'Content-Length': str(len(raw)), **(headers or {})}
+    handler.rfile = io.BytesIO(raw)
+    handler.wfile = io.BytesIO()
+    status, sent = [], {}
+    handler.send_response = lambda code, *args: status.append(code)
+    handler.send_header = lambda key, value: sent.__setitem__(key, value)
+    handler.end_headers = lambda: None
+    handler.do_POST()
+    out = handler.wfile.getvalue()
+    return status[0], sent, json.loads(out) if out and sent.get('Content-Encoding') is None else out
@@ -0,0 +1,29 @@
+import threading
+
+
+def test_closing_the_batch_stream_cancels_queued_items(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, 'BATCH_MAX_WORKERS', 1)
+    started, release = [], threading.Event()
+
+    def slow_item(index, item):
+        started.append(index)
+        if index:
+            release.wait(5)
+        return {'index': index, 'success': True}
+
+    monkeypatch.setattr(app_module, '_generate_batch_item', slow_item)
+    response = client.post('/api/generate/batch', json={'items': [{'prompt': f'p{i}'} for i in range(10)]},
+                           buffered=False)
+    first = next(iter(response.response))
+    response.close()        # what the server does when the client goes away
+    release.set()
+    assert b'"index"' in first
+    # Item 0 was sent and item 1 at most had started; the rest were cancelled, not run
+    assert started[0] == 0 and len(started) <= 2
+
+
+def test_non_streamed_batch_returns_every_item(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, '_generate_batch_item', lambda index, item: {'index': index, 'success': True})
+    body = client.post('/api/generate/batch', json={'items': [{'prompt': 'a'}, {'prompt': 'b'}], 'stream': False}).get_json()
+    assert [r['index'] for r in body['results']] == [0, 1]
+    assert body['succeeded'] == 2
@@ -0,0 +1,67 @@
+"""Prompt-token budgeting: the shared estimator/splitter and the 413 every entry point sends."""
+import json
+
+import pytest
+
+from _budget import estimate_tokens, split_chunk_to_budget
+from conftest import call_function, load_function
+
+OUTLINE_REPLY = json.dumps({'sections': [{'heading': 'Topic', 'points': ['A point']}], 'terms': []})
+
+
+def test_split_chunk_to_budget():
+    text = ' '.join(f'word{i}' for i in range(1000))
+    assert split_chunk_to_budget('short text', 100, 2) == ['short text']
+    pieces = split_chunk_to_budget(text, 1000, 4)
+    assert len(pieces) > 1 and all(estimate_tokens(p) <= 1000 for p in pieces)
+    assert ' '.join(pieces) == text
+    assert split_chunk_to_budget(text, 200, 4) is None
+
+
+@pytest.mark.parametrize('name', ['generate', 'refine', 'law-chat'])
+def test_vercel_functions_reject_oversized_input(name, sarvam, monkeypatch):
+    module = load_function(name)
+    monkeypatch.setattr(module.requests, 'post', sarvam)
+    huge = 'word ' * 40000
+    body = {'generate': {'prompt': huge, 'mode': 'flowchart'},
+            'refine': {'current_code': 'graph TD\n' + 'A-->B\n' * 20000, 'instruction': 'add C'},
+            'law-chat': {'prompt': huge, 'history': []}}[name]
+    status, _, payload = call_function(module, body)
+    assert status == 413
+    assert payload['max_input_tokens'] == module.MAX_INPUT_TOKENS
+    assert payload['estimated_tokens'] > payload['max_input_tokens']
+    assert not sarvam.calls
+
+
+def test_flask_generate_rejects_oversized_input(client, sarvam):
+    response = client.post('/api/generate', json={'prompt': 'word ' * 40000, 'mode': 'flowchart'})
+    assert response.status_code == 413
+    assert set(response.get_json()) == {'error', 'estimated_tokens', 'max_input_tokens'}
+    assert not sarvam.calls
+
+
+@pytest.fixture(params=['flask', 'vercel'])
+def chunk_call(request, client, sarvam, monkeypatch):
+    sarvam.reply_with(OUTLINE_REPLY)
+    if request.param == 'flask':
+        def call(chunk):
+            response = client.post('/api/yt-notes', json={'action': 'chunk', 'format': 'outline', 'chunk': chunk})
+            return response.status_code, response.get_json()
+        return call
+    module = load_function('yt-notes')
+    monkeypatch.setattr(module.requests, 'post', sarvam)
+    return lambda chunk: call_function(module, {'action': 'chunk', 'format': 'outline', 'chunk': chunk})[::2]
+
+
+def test_yt_notes_chunk_is_split_to_budget(chunk_call, sarvam):
+    status, body = chunk_call(' '.join(f'word{i}' for i in range(2000)))
+    assert status == 200
+    assert len(sarvam.calls) > 1
+    assert body['outline']['sections'][0]['points'] == ['A point']
+
+
+def test_yt_notes_chunk_over_split_limit_is_413(chunk_call, sarvam):
+    status, body = chunk_call('word ' * 200000)
+    assert status == 413
+    assert body['estimated_tokens'] > body['max_input_tokens']
+    assert not sarvam.calls
@@ -0,0 +1,29 @@
+"""Accept-Encoding negotiation for the Vercel functions (api/_http.py)."""
+import gzip
+import json
+
+from _http import COMPRESS_MIN_SIZE, compress
+from conftest import call_function, load_function
+
+
+def test_small_bodies_are_left_alone():
+    body = b'{"ok":true}'
+    assert compress(body, 'gzip, br') == (body, None)
+
+
+def test_gzip_negotiation_and_refusal():
+    body = b'x' * (COMPRESS_MIN_SIZE * 4)
+    packed, encoding = compress(body, 'gzip;q=1, identity')
+    assert encoding in ('gzip', 'br') and len(packed) < len(body)
+    assert compress(body, 'gzip;q=0, br;q=0') == (body, None)
+    assert compress(body, '') == (body, None)
+
+
+def test_function_responses_are_compressed(sarvam, monkeypatch):
+    module = load_function('law-chat')
+    monkeypatch.setattr(module.requests, 'post', sarvam)
+    sarvam.reply_with(json.dumps({'phase': 'final', 'message': 'advice ' * 500, 'cards': {}}))
+    status, headers, body = call_function(module, {'prompt': 'hello', 'history': []}, {'Accept-Encoding': 'gzip'})
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip' and headers['Vary'] == 'Accept-Encoding'
+    assert json.loads(gzip.decompress(body))['success'] is True
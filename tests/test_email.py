@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+import _email
+from conftest import FakeResponse, call_function, load_function
+
+
+class FakeResend:
+    """Records each batch POST; rejects any batch containing an address in ``bad``."""
+
+    def __init__(self, bad=()):
+        self.bad = set(bad)
+        self.batches = []
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        recipients = [m['to'][0] for m in json.loads(data)]
+        self.batches.append((recipients, headers.get('Idempotency-Key')))
+        rejected = self.bad.intersection(recipients)
+        if rejected:
+            return FakeResponse({'message': f'Invalid `to` field: {sorted(rejected)[0]}'}, 422)
+        return FakeResponse({'data': [{'id': r} for r in recipients]})
+
+
+@pytest.fixture(autouse=True)
+def no_rate_limit(monkeypatch):
+    monkeypatch.setattr(_email.RESEND_RATE_LIMITER, 'acquire', lambda: None)
+
+
+def test_normalize_recipients_dedupes_and_reports():
+    emails, report = _email.normalize_recipients(['A@x.com', 'Bee <b@x.com>', ' a@x.com ', 'bad@'])
+    assert emails == ['a@x.com', 'b@x.com']
+    assert report['duplicates_removed'] == 1
+    assert report['invalid_samples'] == ['bad@']
+
+
+def test_recipient_error_bisects_with_idempotency_suffixes():
+    session = FakeResend(bad={'c@x.com'})
+    batch = ['a@x.com', 'b@x.com', 'c@x.com', 'd@x.com']
+    sent, errors = _email.send_resend_batch(session, batch, 'S', '<p>hi</p>', 'key', idempotency_key='job-1')
+    assert sent == 3
+    assert len(errors) == 1 and errors[0].startswith('c@x.com: HTTP 422')
+    keys = [key for _, key in session.batches]
+    assert keys == ['job-1', 'job-1-a', 'job-1-b', 'job-1-b-a', 'job-1-b-b']
+
+
+def test_vercel_handler_uses_shared_sender(monkeypatch):
+    module = load_function('send-emails')
+    monkeypatch.setenv('RESEND_API_KEY', 'key')
+    monkeypatch.setenv('ADMIN_SECRET', 'secret')
+    session = FakeResend(bad={'b@x.com'})
+    monkeypatch.setattr(_email.requests, 'Session', lambda: _Session(session))
+    status, _, body = call_function(module, {
+        'emails': ['a@x.com', 'b@x.com', 'A@x.com'], 'subject': 'S', 'html': '<p>hi</p>', 'admin_key': 'secret',
+    })
+    assert status == 200
+    assert (body['sent'], body['failed'], body['duplicates_removed']) == (1, 1, 1)
+
+
+class _Session:
+    def __init__(self, fake):
+        self.post = fake.post
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture
+def admin(monkeypatch):
+    monkeypatch.setenv('ADMIN_SECRET', 'secret')
+    monkeypatch.setenv('RESEND_API_KEY', 'key')
+
+
+@pytest.mark.parametrize('path', ['/api/send-emails', '/api/send-emails/jobs'])
+def test_admin_key_is_checked_before_recipients_are_read(client, app_module, admin, monkeypatch, path):
+    def fail():
+        raise AssertionError('recipients parsed before the admin key was checked')
+    monkeypatch.setattr(app_module, 'read_bulk_email_request', fail)
+    response = client.post(path, json={'emails': ['a@x.com'], 'subject': 'S', 'html': 'h', 'admin_key': 'wrong'})
+    assert response.status_code == 403
+    response = client.post(path, data={'emails': 'a@x.com', 'subject': 'S', 'html': 'h'},
+                           headers={'X-Admin-Key': 'wrong'})
+    assert response.status_code == 403
+
+
+@pytest.mark.parametrize('path', ['/api/send-emails', '/api/send-emails/jobs'])
+def test_emails_of_the_wrong_type_are_a_bad_request(client, admin, path):
+    response = client.post(path, json={'emails': 5, 'subject': 'S', 'html': 'h', 'admin_key': 'secret'})
+    assert response.status_code == 400
+    assert 'list or a string' in response.get_json()['error']
+
+
+def test_vercel_handler_rejects_emails_of_the_wrong_type(admin):
+    status, _, body = call_function(load_function('send-emails'), {
+        'emails': {'a@x.com': 1}, 'subject': 'S', 'html': 'h', 'admin_key': 'secret',
+    })
+    assert status == 400
@@ -0,0 +1,105 @@
+import threading
+
+import pytest
+from flask import Response, jsonify
+
+
+@pytest.fixture
+def store(app_module, monkeypatch):
+    fresh = app_module.IdempotencyStore()
+    monkeypatch.setattr(app_module, 'IDEMPOTENCY_STORE', fresh)
+    return fresh
+
+
+def call(app_module, view, key='k1', body=b'{"prompt": "a"}'):
+    """Run an @idempotent view in its own request context and return (status, headers, body)."""
+    with app_module.app.test_request_context('/api/generate', method='POST', data=body,
+                                             content_type='application/json', headers={'Idempotency-Key': key}):
+        response = app_module.app.make_response(app_module.idempotent(view)())
+        return response.status_code, response.headers, response.get_data()
+
+
+def test_finished_response_is_replayed(app_module, store):
+    calls = []
+
+    def view():
+        calls.append(1)
+        return jsonify({'n': len(calls)})
+
+    first = call(app_module, view)
+    second = call(app_module, view)
+    assert len(calls) == 1
+    assert second[0] == 200 and second[2] == first[2]
+    assert second[1]['Idempotent-Replayed'] == 'true'
+    assert call(app_module, view, body=b'{"prompt": "b"}')[0] == 422
+
+
+def test_duplicate_attaches_to_the_request_in_flight(app_module, store, monkeypatch):
+    monkeypatch.setattr(app_module, 'IDEMPOTENCY_WAIT', 5)
+    started, release = threading.Event(), threading.Event()
+    results = {}
+
+    def slow_view():
+        started.set()
+        release.wait(5)
+        return jsonify({'done': True})
+
+    owner = threading.Thread(target=lambda: results.setdefault('owner', call(app_module, slow_view)))
+    owner.start()
+    started.wait(5)
+    duplicate = threading.Thread(target=lambda: results.setdefault('duplicate', call(app_module, slow_view)))
+    duplicate.start()
+    release.set()
+    owner.join(5)
+    duplicate.join(5)
+    assert results['duplicate'][0] == 200
+    assert results['duplicate'][2] == results['owner'][2]
+    assert results['duplicate'][1]['Idempotent-Replayed'] == 'true'
+
+
+def test_duplicate_gets_409_when_the_wait_runs_out(app_module, store, monkeypatch):
+    monkeypatch.setattr(app_module, 'IDEMPOTENCY_WAIT', 0.05)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_view():
+        started.set()
+        release.wait(5)
+        return jsonify({'done': True})
+
+    owner = threading.Thread(target=call, args=(app_module, slow_view))
+    owner.start()
+    started.wait(5)
+    try:
+        status, headers, _ = call(app_module, slow_view)
+    finally:
+        release.set()
+        owner.join(5)
+    assert status == 409
+    assert headers['Retry-After'] == str(app_module.IDEMPOTENCY_RETRY_AFTER)
+
+
+def test_streamed_response_is_stored_once_complete(app_module, store):
+    calls = []
+
+    def stream_view():
+        calls.append(1)
+        return Response(iter([b'{"type": "draft"}\n', b'{"type": "final"}\n']), mimetype='application/x-ndjson')
+
+    first = call(app_module, stream_view)
+    second = call(app_module, stream_view)
+    assert len(calls) == 1
+    assert second[2] == first[2] == b'{"type": "draft"}\n{"type": "final"}\n'
+    assert second[1]['Content-Type'] == 'application/x-ndjson'
+
+
+def test_stream_cut_short_is_not_stored(app_module, store):
+    def stream_view():
+        return Response(iter([b'one\n', b'two\n']), mimetype='application/x-ndjson')
+
+    with app_module.app.test_request_context('/api/generate', method='POST', data=b'{}',
+                                             content_type='application/json', headers={'Idempotency-Key': 'k2'}):
+        response = app_module.idempotent(stream_view)()
+        chunks = iter(response.response)
+        next(chunks)
+        response.close()
+    assert len(store) == 0
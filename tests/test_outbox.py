@@ -0,0 +1,14 @@
+import os
+
+
+def test_outbox_path_is_absolute(app_module):
+    assert os.path.isabs(app_module.OUTBOX_DB_PATH)
+
+
+def test_resume_check_runs_once_per_process(app_module, client, monkeypatch):
+    checks = []
+    monkeypatch.setattr(app_module, '_outbox_resume_checked', False)
+    monkeypatch.setattr(app_module.os.path, 'exists', lambda path: checks.append(path) or False)
+    client.get('/no-such-page')
+    client.get('/no-such-page')
+    assert checks == [app_module.OUTBOX_DB_PATH]
@@ -0,0 +1,40 @@
+import pytest
+
+
+@pytest.fixture
+def quotas(app_module, monkeypatch):
+    fresh = app_module.QuotaManager(app_module.MemoryQuotaBackend(), 3600, {'ip': (5, 10 ** 6)})
+    monkeypatch.setattr(app_module, 'QUOTAS', fresh)
+    monkeypatch.setattr(app_module, 'QUOTA_ENABLED', True)
+    return fresh
+
+
+def batch(client, count):
+    return client.post('/api/generate/batch', json={
+        'items': [{'prompt': f'diagram {i}'} for i in range(count)], 'stream': False,
+    })
+
+
+def test_batch_is_charged_per_item(client, quotas, sarvam):
+    sarvam.reply_with('graph TD\n  A --> B')
+    response = batch(client, 3)
+    assert response.status_code == 200
+    assert response.headers['X-RateLimit-Remaining-Requests'] == '2'
+    assert quotas.usage('ip:127.0.0.1', 'ip')['used']['requests'] == 3
+
+
+def test_batch_over_the_request_budget_is_rejected_and_refunded(client, quotas, sarvam):
+    response = batch(client, 6)
+    assert response.status_code == 429
+    assert 'Retry-After' in response.headers
+    assert quotas.usage('ip:127.0.0.1', 'ip')['used']['requests'] == 0
+    assert not sarvam.calls
+
+
+def test_sqlite_backend_sweeps_old_windows_once_per_window(app_module, tmp_path):
+    backend = app_module.SQLiteQuotaBackend(str(tmp_path / 'quota.db'))
+    backend.add('ip:a', 1, requests=1)
+    backend.add('ip:a', 5, requests=1)
+    backend.add('ip:b', 5, requests=1)
+    assert backend.read('ip:a', 2) == (0, 0, 0, 0)
+    assert backend.read('ip:a', 5) == (1, 0, 0, 0)
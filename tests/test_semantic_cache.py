@@ -0,0 +1,42 @@
+import pytest
+
+
+@pytest.fixture
+def cache(app_module):
+    return app_module.SemanticCache('test', maxsize_per_mode=64, ttl=60)
+
+
+def test_expired_best_match_falls_through_to_the_next_candidate(app_module, cache, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(app_module.time, 'monotonic', lambda: clock[0])
+    cache.add('flowchart', 'user login process with password reset', 'old')
+    clock[0] += 30
+    cache.add('flowchart', 'user login process with password recovery', 'new')
+    clock[0] += 45      # the first entry has expired, the second has not
+
+    similarity, matched, value = cache.lookup('flowchart', 'user login process with password reset', 0.5)
+    assert value == 'new'
+    assert matched == 'user login process with password recovery'
+    assert len(cache) == 1
+
+
+def test_same_keys_mismatch_tries_the_next_candidate(cache):
+    cache.add('gantt', '6 month project plan for website', 'six')
+    cache.add('gantt', '3 month project plan for a website', 'three')
+    hit = cache.lookup('gantt', '3 month project plan for website', 0.5, same_keys=True)
+    assert hit is not None and hit[2] == 'three'
+
+
+def test_stored_vectors_follow_the_current_idf(app_module):
+    index = app_module._SemanticModeIndex()
+    features = app_module.semantic_features
+    index.add(0, 1e12, 'inventory tracking', None, features('inventory tracking'))
+    for i in range(1, 40):
+        index.add(i, 1e12, f'inventory report {i}', None, features(f'inventory report {i}'))
+    stale = {h: w for h, w in index.entries[0][4].items()}
+    index.reweigh()
+    assert index.entries[0][4] == index.weigh(features('inventory tracking'))
+    # "inventory" is in every entry now, so its n-grams weigh less than when the first entry was added
+    shared = next(h for h in stale if index.df[h] == 40)
+    assert index.entries[0][4][shared] < stale[shared]
+    assert index.changes == 0
@@ -0,0 +1,27 @@
+def test_served_prompts_are_tallied_without_prompt_logging(app_module, client, sarvam, monkeypatch, tmp_path):
+    tally = app_module.PromptTally(str(tmp_path / 'warmup.json'), save_interval=0)
+    monkeypatch.setattr(app_module, 'WARMUP_PROMPTS', tally)
+    monkeypatch.setattr(app_module, 'LOG_PROMPTS', False)
+    sarvam.reply_with('graph TD\n  A --> B')
+    for prompt in ('user login flow', 'User  login flow', 'checkout process'):
+        assert client.post('/api/generate', json={'prompt': prompt, 'mode': 'flowchart'}).status_code == 200
+
+    reloaded = app_module.PromptTally(tally.path)
+    assert reloaded.top(5) == [('flowchart', 'user login flow'), ('flowchart', 'checkout process')]
+    plan = app_module.warmup_plan([], 5, gallery=False, tally=reloaded)
+    assert plan == reloaded.top(5)
+
+
+def test_tally_evicts_the_least_served_prompt(app_module, tmp_path):
+    tally = app_module.PromptTally(str(tmp_path / 'warmup.json'), maxsize=2)
+    for prompt in ('a', 'a', 'b', 'c'):
+        tally.record('flowchart', prompt)
+    assert tally.top(5) == [('flowchart', 'a'), ('flowchart', 'c')]
+
+
+def test_unreadable_tally_file_is_ignored(app_module, tmp_path):
+    path = tmp_path / 'warmup.json'
+    path.write_text('{"x": ["flowchart", "ok", 1], "y": "junk", "z": ["nope", "bad", 1]')
+    assert app_module.PromptTally(str(path)).top(5) == []
+    path.write_text('{"x": ["flowchart", "ok", 1], "y": "junk", "z": ["nope", "bad", 1]}')
+    assert app_module.PromptTally(str(path)).top(5) == [('flowchart', 'ok')]
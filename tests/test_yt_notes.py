@@ -0,0 +1,82 @@
+"""Map (action=chunk) -> reduce (action=reduce) round trips for both YT-notes entry points."""
+import json
+import time
+
+import pytest
+
+from conftest import FakeResponse, call_function, load_function
+
+OUTLINE_REPLY = json.dumps({
+    'sections': [{'heading': 'Newton\'s Laws', 'points': ['Force equals **mass** times acceleration']}],
+    'terms': [{'term': 'Inertia', 'definition': 'Resistance to change in motion'}],
+})
+HTML_REPLY = '<h2>Newton\'s Laws</h2><ul><li>Every action has a reaction</li><li><img src=x onerror=alert(1)>Momentum is conserved</li></ul>'
+
+
+def flask_call(client, body):
+    response = client.post('/api/yt-notes', json=body)
+    return response.status_code, response.get_json()
+
+
+@pytest.fixture(params=['flask', 'vercel'])
+def notes_api(request, client, sarvam, monkeypatch):
+    """(call(body) -> (status, json), fake upstream) for app.py and for api/yt-notes.py."""
+    if request.param == 'flask':
+        return (lambda body: flask_call(client, body)), sarvam
+    module = load_function('yt-notes')
+    monkeypatch.setattr(module.requests, 'post', sarvam)
+    return (lambda body: call_function(module, body)[::2]), sarvam
+
+
+def map_chunk(call, idx, total=2):
+    return call({'action': 'chunk', 'format': 'outline', 'chunk': f'transcript piece {idx}', 'chunk_idx': idx, 'total_chunks': total})
+
+
+def test_chunk_reduce_round_trip_keeps_non_json_replies(notes_api):
+    call, sarvam = notes_api
+    sarvam.reply_with(OUTLINE_REPLY, HTML_REPLY)
+    outlines = []
+    for idx in (1, 2):
+        status, body = map_chunk(call, idx)
+        assert status == 200
+        outlines.append(body['outline'])
+    # The map step only ever hands back the structured form
+    assert all('html' not in sec for o in outlines for sec in o['sections'])
+
+    status, body = call({'action': 'reduce', 'outlines': outlines})
+    assert status == 200
+    notes = body['notes']
+    assert 'Every action has a reaction' in notes and 'Momentum is conserved' in notes
+    assert '<strong>mass</strong>' in notes and 'Inertia' in notes
+    assert '<img' not in notes and 'onerror' not in notes
+    assert notes.count("<h2>Newton's Laws</h2>") == 1
+
+
+def test_reduce_accepts_legacy_html_sections_as_text(notes_api):
+    call, _ = notes_api
+    outline = {'sections': [{'html': '<h2>Topic</h2><p>Kept <b>point</b></p><script>alert(1)</script>'}]}
+    status, body = call({'action': 'reduce', 'outlines': [outline]})
+    assert status == 200
+    assert body['notes'] == '<h2>Topic</h2>\n<ul><li>Kept <strong>point</strong></li></ul>'
+
+
+def test_chunk_failure_is_reported(notes_api, monkeypatch):
+    call, sarvam = notes_api
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)    # skip the retry backoff
+    sarvam.reply_with(FakeResponse({'error': 'overloaded'}, status_code=500))
+    status, body = map_chunk(call, 1)
+    assert status == 502
+    assert 'chunk 1' in body['error'] and body['details']
+
+
+@pytest.mark.parametrize('outline', [
+    {'sections': [{'points': ['a']}]},
+    {'sections': ['oops']},
+    {'sections': [{'heading': 'H', 'points': ['a']}], 'terms': [{'term': 1}]},
+    {'sections': [{'html': 5}]},
+])
+def test_reduce_rejects_malformed_outlines(notes_api, outline):
+    call, _ = notes_api
+    status, body = call({'action': 'reduce', 'outlines': [outline]})
+    assert status == 400
+    assert body['error'].startswith('Invalid outline')
@@ -0,0 +1,131 @@
+"""
+Benchmark of the JSON codec backends on representative payloads.
+
+Compares the standard library with orjson (when installed) for encoding
+response bodies, decoding upstream bodies (from bytes, and the old
+response.text + json.loads path) and building a Flask JSON response through
+the default provider versus app.CodecJSONProvider.
+
+    python tools/bench_json.py
+    python tools/bench_json.py --filter notes --min-time 0.5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LOG_LEVEL', 'CRITICAL')
+
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+
+import app  # noqa: E402
+from mock_upstream import LAW_FINAL, MERMAID_SAMPLES, NOTES_HTML, synthetic_transcript  # noqa: E402
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def sarvam_completion(content):
+    """Upstream chat completion body wrapping `content`, as bytes."""
+    return json.dumps({
+        'id': 'chatcmpl-bench', 'object': 'chat.completion', 'model': 'sarvam-m',
+        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+        'usage': {'prompt_tokens': 812, 'completion_tokens': 640, 'total_tokens': 1452},
+    }).encode()
+
+
+def notes_response(target_bytes):
+    """yt-notes style response: one big HTML string plus an outline."""
+    html = NOTES_HTML * (target_bytes // len(NOTES_HTML) + 1)
+    sections = [{'title': f"Section {i}", 'html': NOTES_HTML, 'terms': ['energy', 'work']} for i in range(20)]
+    return {'success': True, 'html': html[:target_bytes], 'outline': {'sections': sections, 'terms': []}}
+
+
+def payloads():
+    """name -> JSON-serialisable object, smallest to largest."""
+    return {
+        'error': {'error': 'Please provide a description.'},
+        'generate': {'success': True, 'code': MERMAID_SAMPLES['flowchart'], 'usage': {'total_tokens': 1452},
+                     'cached': False, 'cache': None},
+        'sarvam_request': app.sarvam_payload(app.model_route('generate', 'flowchart'), [
+            {'role': 'system', 'content': app.get_system_prompt('flowchart')},
+            {'role': 'user', 'content': 'Create a flowchart for user login with MFA and password reset'}]),
+        'law_final': {'success': True, 'response': LAW_FINAL, 'usage': {'total_tokens': 2400}},
+        'notes_50k': notes_response(50_000),
+        'notes_300k': notes_response(300_000),
+        'notes_1m': notes_response(1_000_000),
+    }
+
+
+def upstream_bodies():
+    """name -> raw upstream response bytes."""
+    return {
+        'completion_mermaid': sarvam_completion(MERMAID_SAMPLES['flowchart']),
+        'completion_law': sarvam_completion(json.dumps(LAW_FINAL)),
+        'completion_notes': sarvam_completion(NOTES_HTML * 60),
+        'transcript': json.dumps({'content': synthetic_transcript('bench', words=20000), 'lang': 'en'}).encode(),
+    }
+
+
+def timed(fn, min_time, repeat):
+    """Best seconds per call over `repeat` runs of at least `min_time` each."""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops = max(loops * 2, int(loops * min_time / max(elapsed, 1e-9)))
+    best = elapsed / loops
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        best = min(best, (time.perf_counter() - start) / loops)
+    return best
+
+
+def cases():
+    """(name, size in bytes, stdlib fn, orjson fn or None)."""
+    default_provider = DefaultJSONProvider(app.app)
+    codec_provider = app.CodecJSONProvider(app.app)
+    for name, obj in payloads().items():
+        size = len(json.dumps(obj).encode())
+        yield (f"dumps {name}", size, lambda obj=obj: json.dumps(obj).encode(),
+               (lambda obj=obj: orjson.dumps(obj)) if orjson else None)
+        yield (f"flask response {name}", size, lambda obj=obj: default_provider.response(obj),
+               lambda obj=obj: codec_provider.response(obj))
+    for name, body in upstream_bodies().items():
+        yield (f"loads {name}", len(body), lambda body=body: json.loads(body.decode('utf-8')),
+               (lambda body=body: orjson.loads(body)) if orjson else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark JSON encode/decode backends.')
+    parser.add_argument('--filter', default='', help='only run cases whose name contains this')
+    parser.add_argument('--min-time', type=float, default=0.1, help='seconds per timing run')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"app JSON backend: {app.JSON_BACKEND}; orjson {'installed' if orjson else 'not installed'}\n")
+    print(f"{'case':<40} {'bytes':>9} {'stdlib':>11} {'fast':>11} {'speedup':>8}")
+    with app.app.app_context():
+        for name, size, stdlib_fn, fast_fn in cases():
+            if args.filter not in name:
+                continue
+            slow = timed(stdlib_fn, args.min_time, args.repeat)
+            fast = timed(fast_fn, args.min_time, args.repeat) if fast_fn else None
+            fast_col = f"{fast * 1e6:>9.1f}us" if fast else f"{'-':>11}"
+            speedup = f"{slow / fast:>7.1f}x" if fast else f"{'-':>8}"
+            print(f"{name:<40} {size:>9} {slow * 1e6:>9.1f}us {fast_col} {speedup}")
+
+
+if __name__ == '__main__':
+    main()
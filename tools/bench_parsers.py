@@ -0,0 +1,257 @@
+"""
+Microbenchmarks for the per-request text processing in app.py: the Mermaid
+cleaners/fixers, law-chat JSON extraction, notes outline parsing and
+transcript chunking.
+
+Each benchmark runs a function over a corpus of LLM-style outputs (plain,
+fenced, prose-wrapped, fence-heavy, huge and malformed variants) and reports
+throughput (ops/sec, best of several repeats) and peak allocated memory per
+call (tracemalloc).
+
+    python tools/bench_parsers.py                         # run and print a table
+    python tools/bench_parsers.py --save bench.json       # record a baseline
+    python tools/bench_parsers.py --compare bench.json    # exit 1 on regressions
+
+--compare fails when a benchmark's speed drops, or its peak memory grows, by
+more than --threshold (default 25%) relative to the baseline. Speed is compared
+as a score normalised against a fixed reference workload timed alongside each
+benchmark, so a slower or busier machine does not trip the gate; still, record
+baselines on the same class of machine that runs it.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LOG_LEVEL', 'CRITICAL')    # the fallback paths log; keep the handler out of the numbers
+
+import app  # noqa: E402
+from mock_upstream import LAW_FINAL, LAW_QUESTION, MERMAID_SAMPLES, NOTES_OUTLINE, synthetic_transcript  # noqa: E402
+
+PROSE_BEFORE = "Sure! Here is the diagram you asked for. I kept the labels short so it renders cleanly:\n\n"
+PROSE_AFTER = "\n\nThis diagram shows the main steps. Let me know if you'd like me to add more detail or change the layout."
+
+# Lines appended to make the "huge" variants; each keeps the diagram valid for its mode
+HUGE_LINES = {
+    'flowchart': lambda i: f"  N{i}[Step {i}] --> N{i + 1}[Step {i + 1}]",
+    'block': lambda i: f"  B{i}[Block {i}] --> B{i + 1}[Block {i + 1}]",
+    'architecture': lambda i: f"  S{i}[Service {i}] --> DB",
+    'sequence': lambda i: f"    User->>Server: Request {i}\n    Server-->>User: Response {i}",
+    'timeline': lambda i: f"        {2000 + i % 50} : Event number {i}",
+    'gantt': lambda i: f"        Task {i} :t{i}, after t{i - 1}, {1 + i % 9}d" if i else "        Task 0 :t0, 2024-01-01, 3d",
+    'pie': lambda i: f'    "Slice {i}" : {1 + i % 17}',
+    'xy': lambda i: f"    line [{', '.join(str((i * k) % 97) for k in range(1, 4))}]",
+    'er': lambda i: f"    ENTITY{i} ||--o{{ ENTITY{i + 1} : relates",
+    'state': lambda i: f"    S{i} --> S{i + 1} : event{i}",
+    'class': lambda i: f"    Class{i} <|-- Class{i + 1}",
+    'git': lambda i: "    commit" if i % 3 else f"    branch feature{i}\n    checkout feature{i}\n    commit\n    checkout main\n    merge feature{i}",
+    'quadrant': lambda i: f"    Item {i}: [{(i % 10) / 10:.1f}, {(i % 7) / 7:.2f}]",
+    'treemap': lambda i: f"      Topic {i}\n        Detail {i}",
+}
+
+# Malformed outputs the fixers exist for
+BROKEN = {
+    'gantt': "gantt\n    title Plan\n    dateFormat YYYY-MM-DD\n    Requirements : a1, 2024-01-01, 30d\n    section Build\n    Design : after a1, 20 days\n    Review: 2024-02-30, 5d",
+    'timeline': "timeline\n    title History\n    2020 - Beta released\n    2021: GA\n    section\n    2022 : v2 : v2.1",
+    'git': "gitGraph\n    commit id: \"init\"\n    checkout develop\n    commit\n    merge feature\n    branch main\n    commit",
+    'pie': "pie\n    title Sources\n    Search : 45%\n    'Direct' : 30\n    Social: 25.5%",
+    'treemap': "mindmap\nroot(Project)\n  Frontend\n\tReact\n  Backend (Flask)\n     API",
+    'xy': "xychart-beta\n    title Monthly Sales\n    x-axis Jan, Feb, Mar\n    y-axis Revenue 0 --> 100\n    bar 30, 60, 90",
+}
+
+
+def mermaid_variants(mode, sample):
+    huge = sample + '\n' + '\n'.join(HUGE_LINES[mode](i) for i in range(600))
+    return {
+        'plain': sample,
+        'fenced': f"```mermaid\n{sample}\n```",
+        'prose': f"{PROSE_BEFORE}```mermaid\n{sample}\n```{PROSE_AFTER}",
+        'fence-heavy': '\n'.join(f"```mermaid\n{line}\n```" for line in sample.split('\n')),
+        'escaped': sample.replace('\n', '\\n').replace('  ', '\\t'),
+        'huge': f"{PROSE_BEFORE}```mermaid\n{huge}\n```{PROSE_AFTER}",
+    }
+
+
+def law_variants():
+    final = json.dumps(LAW_FINAL, indent=2)
+    big = dict(LAW_FINAL, cards={k: (v if isinstance(v, dict) else (v + ' ') * 60) for k, v in LAW_FINAL['cards'].items()})
+    return {
+        'plain': json.dumps(LAW_QUESTION),
+        'fenced': f"```json\n{final}\n```",
+        'prose': f"Here is my analysis of your situation.\n\n{final}\n\nI hope this helps {{you}} take the next step.",
+        'bom': '\ufeff\u200b' + final,
+        'huge': f"```json\n{json.dumps(big, indent=2)}\n```",
+        # Unbalanced braces: the scanner walks the whole text, then falls back to a plain message
+        'malformed': "I think {the fee is unfair " + ("and {the institute} must refund it " * 200) + "based on the rules.",
+    }
+
+
+def outline_variants():
+    outline = json.dumps(NOTES_OUTLINE)
+    big = {'sections': NOTES_OUTLINE['sections'] * 40, 'terms': NOTES_OUTLINE['terms'] * 40}
+    return {
+        'plain': outline,
+        'fenced': f"```json\n{outline}\n```",
+        'prose': f"Here is the outline for this segment:\n{outline}\nLet me know if you need more.",
+        'huge': json.dumps(big, indent=2),
+        'malformed': "<h2>Notes</h2><p>The model ignored the JSON instruction {sections}</p>" * 20,
+    }
+
+
+def build_benchmarks():
+    """Return [(name, fn, [args, ...])]; every benchmark is one pass over its corpus."""
+    benches = []
+    corpus = {mode: mermaid_variants(mode, sample) for mode, sample in MERMAID_SAMPLES.items()}
+    for variant in ('plain', 'fenced', 'prose', 'fence-heavy', 'escaped', 'huge'):
+        benches.append((f"clean_mermaid_code[{variant}]", app.clean_mermaid_code,
+                        [(corpus[mode][variant], mode) for mode in corpus]))
+    benches.append(("fix_mermaid_syntax[all-modes]", app.fix_mermaid_syntax,
+                    [(sample, mode) for mode, sample in MERMAID_SAMPLES.items()]))
+    benches.append(("fix_mermaid_syntax[broken]", app.fix_mermaid_syntax,
+                    [(code, mode) for mode, code in BROKEN.items()]))
+
+    fixers = {'gantt': app._fix_gantt, 'timeline': app._fix_timeline, 'git': app._fix_gitgraph,
+              'pie': app._fix_pie, 'treemap': app._fix_mindmap, 'xy': app._fix_xychart}
+    for mode, fixer in fixers.items():
+        sample = MERMAID_SAMPLES[mode]
+        huge = sample + '\n' + '\n'.join(HUGE_LINES[mode](i) for i in range(600))
+        benches.append((f"{fixer.__name__}[small]", fixer, [(sample,), (BROKEN[mode],)]))
+        benches.append((f"{fixer.__name__}[huge]", fixer, [(huge,)]))
+
+    for variant, text in law_variants().items():
+        benches.append((f"extract_law_json[{variant}]", app.extract_law_json, [(text,)]))
+    for variant, text in outline_variants().items():
+        benches.append((f"parse_notes_outline[{variant}]", app.parse_notes_outline, [(text,)]))
+
+    for words in (300, 5000, 50000):
+        transcript = synthetic_transcript(f"bench{words}", words)
+        benches.append((f"chunk_text[{words}w]", app.chunk_text, [(transcript, 500)]))
+    return benches
+
+
+REFERENCE_TEXT = ("flowchart TD\n  A[Start] --> B{Check}\n  B -->|Yes| C[Done]\n" * 20)
+REFERENCE_JSON = json.dumps({'phase': 'questioning', 'message': 'reference ' * 20, 'options': ['a', 'b', 'c']})
+
+
+def reference_workload():
+    """Fixed string/regex/json mix of roughly the same shape as the code under test."""
+    lines = [line.strip() for line in REFERENCE_TEXT.split('\n') if line.strip()]
+    re.sub(r'\s+', ' ', ' '.join(lines))
+    json.loads(REFERENCE_JSON)
+
+
+def run_pass(fn, inputs):
+    for args in inputs:
+        fn(*args)
+
+
+def calibrate(fn, inputs, min_time):
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            run_pass(fn, inputs)
+        if time.perf_counter() - start >= min_time or loops >= 1 << 20:
+            return loops
+        loops *= 2
+
+
+def timed(fn, inputs, loops):
+    start = time.perf_counter()
+    for _ in range(loops):
+        run_pass(fn, inputs)
+    return time.perf_counter() - start
+
+
+def measure(fn, inputs, min_time=0.1, repeat=5):
+    """
+    Best-of-`repeat` ops/sec (loop count auto-scaled like timeit) and peak
+    bytes per op. Each repeat is paired with a run of reference_workload so the
+    gate can compare `score` (ops relative to the reference), which cancels out
+    CPU frequency drift and noisy neighbours between runs.
+    """
+    loops = calibrate(fn, inputs, min_time)
+    ref_loops = calibrate(reference_workload, [()], min_time)
+    best, scores = float('inf'), []
+    for _ in range(repeat):
+        elapsed = timed(fn, inputs, loops)
+        ref_elapsed = timed(reference_workload, [()], ref_loops)
+        best = min(best, elapsed)
+        scores.append((loops * len(inputs) / elapsed) / (ref_loops / ref_elapsed))
+    scores.sort()
+
+    peak = 0
+    tracemalloc.start()
+    for args in inputs:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        fn(*args)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    return {'ops_per_sec': loops * len(inputs) / best, 'score': scores[len(scores) // 2], 'peak_bytes': peak}
+
+
+def compare(results, baseline, threshold):
+    failures = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['score'] < base['score'] * (1 - threshold):
+            failures.append(f"{name}: {result['score'] / base['score'] - 1:+.0%} relative to the reference workload "
+                            f"({result['ops_per_sec']:,.0f} ops/s vs baseline {base['ops_per_sec']:,.0f})")
+        # Small absolute growth is noise (interned strings, regex cache); only flag real growth
+        if result['peak_bytes'] > base['peak_bytes'] * (1 + threshold) + 4096:
+            failures.append(f"{name}: peak {result['peak_bytes']:,} B vs baseline {base['peak_bytes']:,} B")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks for the Mermaid fixers and response parsers.')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name matches this regex')
+    parser.add_argument('--min-time', type=float, default=0.1, help='target seconds per timing repeat')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', metavar='FILE', help='write results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare against a baseline and exit 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown / memory growth (fraction)')
+    args = parser.parse_args()
+
+    pattern = re.compile(args.filter)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    print(f"{'benchmark':<38} {'inputs':>6} {'ops/sec':>12} {'peak/op':>10} {'vs base':>8}")
+    for name, fn, inputs in build_benchmarks():
+        if not pattern.search(name):
+            continue
+        result = results[name] = measure(fn, inputs, args.min_time, args.repeat)
+        base = baseline.get(name)
+        delta = f"{result['score'] / base['score'] - 1:+.0%}" if base else ''
+        print(f"{name:<38} {len(inputs):>6} {result['ops_per_sec']:>12,.0f} "
+              f"{result['peak_bytes'] / 1024:>8.1f}KB {delta:>8}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"\nBaseline written to {args.save}")
+
+    if args.compare:
+        failures = compare(results, baseline, args.threshold)
+        if failures:
+            print(f"\n{len(failures)} regression(s) beyond {args.threshold:.0%}:")
+            for failure in failures:
+                print(f"  {failure}")
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.threshold:.0%}.")
+
+
+if __name__ == '__main__':
+    main()
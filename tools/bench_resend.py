@@ -0,0 +1,123 @@
+"""
+Throughput check for bulk email: per-recipient sends vs Resend's batch endpoint.
+
+Starts a local stand-in for the Resend API (fixed latency per HTTP request,
+optional requests-per-second cap answered with 429), points app.py at it via
+RESEND_API_URL, and times both strategies for the same recipient list.
+
+    python tools/bench_resend.py --recipients 300 --latency 0.08
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ResendStandIn(BaseHTTPRequestHandler):
+    latency = 0.08
+    rate_limit = 0          # requests per second; 0 disables the cap
+    received = 0
+    _window = []
+    _lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _throttled(self):
+        if not self.rate_limit:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            ResendStandIn._window = [t for t in self._window if now - t < 1.0]
+            if len(self._window) >= self.rate_limit:
+                return True
+            self._window.append(now)
+            return False
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+        time.sleep(self.latency)
+        if self._throttled():
+            self._reply(429, {'name': 'rate_limit_exceeded'}, {'Retry-After': '1'})
+            return
+        if self.path == '/emails/batch':
+            with self._lock:
+                ResendStandIn.received += len(body)
+            self._reply(200, {'data': [{'id': f'msg-{i}'} for i in range(len(body))]})
+        elif self.path == '/emails':
+            with self._lock:
+                ResendStandIn.received += 1
+            self._reply(200, {'id': 'msg'})
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def _reply(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def send_one_by_one(base_url, emails):
+    """The previous strategy: one urlopen per recipient, serially."""
+    sent = 0
+    for email in emails:
+        payload = {'from': 'Arka Team <onboarding@resend.dev>', 'to': [email], 'subject': 's', 'html': '<p>x</p>'}
+        req = urllib.request.Request(f"{base_url}/emails", data=json.dumps(payload).encode('utf-8'))
+        req.add_header('Authorization', 'Bearer test')
+        req.add_header('Content-Type', 'application/json')
+        try:
+            with urllib.request.urlopen(req, timeout=30):
+                sent += 1
+        except urllib.error.HTTPError:
+            pass    # the old loop had no retry, so throttled sends were simply lost
+    return sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--recipients', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0.08, help='stand-in latency per HTTP request (s)')
+    parser.add_argument('--rate-limit', type=int, default=0, help='stand-in requests/sec cap (0 = none)')
+    args = parser.parse_args()
+
+    ResendStandIn.latency = args.latency
+    ResendStandIn.rate_limit = args.rate_limit
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ResendStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    os.environ['RESEND_API_URL'] = base_url
+    sys.path.insert(0, ROOT)
+    import app
+
+    emails = [f"user{i}@example.com" for i in range(args.recipients)]
+
+    start = time.perf_counter()
+    serial_sent = send_one_by_one(base_url, emails)
+    serial = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch_sent, errors = app.send_via_resend(emails, 's', '<p>x</p>', 'test')
+    batched = time.perf_counter() - start
+
+    server.shutdown()
+    print(f"recipients: {args.recipients}, stand-in latency: {args.latency * 1000:.0f} ms")
+    print(f"per-recipient: {serial_sent} sent in {serial:.2f}s ({serial_sent / serial:.0f} emails/s)")
+    print(f"batched:       {batch_sent} sent in {batched:.2f}s ({batch_sent / batched:.0f} emails/s), {len(errors)} errors")
+    print(f"speedup:       {serial / batched:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
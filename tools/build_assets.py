@@ -0,0 +1,153 @@
+"""
+Fingerprint static/ for deployments that serve files without running app.py.
+
+For every file under static/ this writes a content-hashed copy
+(js/app.js -> js/app.<hash>.js, same hash as app.py computes at startup) and,
+for text assets, max-level .gz/.br siblings of both names. app.py picks the
+siblings up instead of compressing in memory at startup. With
+--rewrite-templates the "/static/..." references in templates/*.html are
+rewritten in place to the hashed names. That is what the Vercel build runs
+(see vercel.json), since there the templates are served as plain files.
+
+    python tools/build_assets.py                       # hashed copies + siblings
+    python tools/build_assets.py --rewrite-templates   # Vercel build step
+    python tools/build_assets.py --clean               # remove generated files
+
+Every file a build writes is recorded in .asset-build.json at the repository
+root; --clean deletes exactly those, never hand-authored files that happen to
+look like generated ones.
+
+Standard library only (brotli is used when installed), so it runs in a bare
+build image.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATIC_DIR = os.path.join(ROOT, 'static')
+TEMPLATES_DIR = os.path.join(ROOT, 'templates')
+BUILD_RECORD = os.path.join(ROOT, '.asset-build.json')
+
+# Must match ASSET_HASH_LENGTH and the reference pattern in app.py
+HASH_LENGTH = 10
+HASHED_NAME = re.compile(r'^.+\.[0-9a-f]{%d}\.[^./]+$' % HASH_LENGTH)
+STATIC_REF = re.compile(r'''(?P<q>["'])/static/(?P<path>[^"'?#]+)(?:\?[^"'#]*)?(?P=q)''')
+COMPRESSIBLE_EXTENSIONS = {'.js', '.css', '.html', '.svg', '.json', '.txt'}
+MIN_SIZE = 1024
+
+
+def source_files(root):
+    for directory, _, files in os.walk(root):
+        for name in sorted(files):
+            if name.endswith(('.gz', '.br')) or HASHED_NAME.match(name):
+                continue
+            yield os.path.join(directory, name)
+
+
+def hashed_name(path, data):
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}"
+
+
+def write_siblings(path, data):
+    written = []
+    if os.path.splitext(path)[1] not in COMPRESSIBLE_EXTENSIONS or len(data) < MIN_SIZE:
+        return written
+    variants = [('.gz', gzip.compress(data, 9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+    for suffix, body in variants:
+        if len(body) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(body)
+            written.append(path + suffix)
+    return written
+
+
+def load_build_record():
+    try:
+        with open(BUILD_RECORD, encoding='utf-8') as f:
+            return set(json.load(f).get('generated', []))
+    except (OSError, ValueError):
+        return set()
+
+
+def build(root):
+    """Write hashed copies and compressed siblings; returns {relative path: hashed relative path}."""
+    manifest = {}
+    generated = load_build_record()     # keep earlier builds' files listed until they are cleaned
+    for path in source_files(root):
+        with open(path, 'rb') as f:
+            data = f.read()
+        target = hashed_name(path, data)
+        shutil.copyfile(path, target)
+        written = [target] + write_siblings(path, data) + write_siblings(target, data)
+        generated.update(os.path.relpath(p, ROOT).replace(os.sep, '/') for p in written)
+        rel = os.path.relpath(path, root).replace(os.sep, '/')
+        manifest[rel] = os.path.relpath(target, root).replace(os.sep, '/')
+    with open(BUILD_RECORD, 'w', encoding='utf-8') as f:
+        json.dump({'generated': sorted(generated)}, f, indent=1)
+    return manifest
+
+
+def rewrite_templates(directory, manifest):
+    changed = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.html'):
+            continue
+        path = os.path.join(directory, name)
+        with open(path, encoding='utf-8') as f:
+            source = f.read()
+        rewritten = STATIC_REF.sub(
+            lambda m: f"{m.group('q')}/static/{manifest[m.group('path')]}{m.group('q')}"
+            if m.group('path') in manifest else m.group(0), source)
+        if rewritten != source:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(rewritten)
+            changed.append(name)
+    return changed
+
+
+def clean():
+    """Delete the files recorded by previous builds; returns how many were removed."""
+    removed = 0
+    for rel in sorted(load_build_record()):
+        path = os.path.join(ROOT, rel)
+        if os.path.isfile(path):
+            os.remove(path)
+            removed += 1
+    if os.path.exists(BUILD_RECORD):
+        os.remove(BUILD_RECORD)
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fingerprint and precompress static assets.')
+    parser.add_argument('--rewrite-templates', action='store_true',
+                        help='rewrite /static/ references in templates/*.html in place')
+    parser.add_argument('--clean', action='store_true', help='remove the files written by previous builds')
+    args = parser.parse_args()
+
+    if args.clean:
+        print(f"removed {clean()} generated files")
+        return
+    manifest = build(STATIC_DIR)
+    for rel, hashed in sorted(manifest.items()):
+        print(f"{rel:<28} -> {hashed}")
+    if args.rewrite_templates:
+        changed = rewrite_templates(TEMPLATES_DIR, manifest)
+        print(f"\nrewrote {len(changed)} templates: {', '.join(changed)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Precision/recall of the semantic generate cache on a labelled set of prompt pairs.
+
+Each pair is (cached prompt, incoming prompt, mode, same) where `same` says
+whether serving the cached diagram for the incoming prompt would be correct.
+For every threshold the incoming prompt is looked up against an index holding
+all cached prompts of its mode (plus filler prompts so the IDF weights look
+like a warm cache), and a pair counts as predicted-same when the best match at
+or above the threshold is a cached prompt labelled as the same request. Lookups
+apply the same key-token check as serving (numbers, acronyms and names must
+match exactly); --no-key-check shows similarity alone.
+
+    python tools/eval_semantic_cache.py
+    python tools/eval_semantic_cache.py --thresholds 0.5,0.6,0.7,0.8,0.9
+    python tools/eval_semantic_cache.py --no-key-check
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import SEMANTIC_DRAFT_THRESHOLD, SEMANTIC_SERVE, SEMANTIC_SERVE_THRESHOLD, SemanticCache  # noqa: E402
+
+PAIRS = [
+    # Rewordings of the same request
+    ("flowchart for user login", "login flow for a user", "flowchart", True),
+    ("user registration process", "process of registering a new user", "flowchart", True),
+    ("order checkout process", "checkout process for an order", "flowchart", True),
+    ("CI/CD pipeline with build test deploy", "build, test and deploy CI CD pipeline", "flowchart", True),
+    ("password reset flow", "flow to reset a password", "flowchart", True),
+    ("hospital patient admission", "admission of a patient to hospital", "flowchart", True),
+    ("online shopping checkout", "checkout for online shopping", "flowchart", True),
+    ("ATM cash withdrawal", "withdrawal of cash from an ATM", "sequence", True),
+    ("user logs in via OAuth", "OAuth login by user", "sequence", True),
+    ("client server request response", "request and response between client and server", "sequence", True),
+    ("library management system classes", "class diagram for a library management system", "class", True),
+    ("e-commerce order entities", "entities for an ecommerce order", "er", True),
+    ("student course enrollment database", "database of students enrolled in courses", "er", True),
+    ("traffic light states", "states of a traffic light", "state", True),
+    ("vending machine states", "state diagram of a vending machine", "state", True),
+    ("website project plan", "project plan for a website", "gantt", True),
+    ("monthly budget breakdown", "breakdown of the monthly budget", "pie", True),
+    ("history of the internet", "internet history timeline", "timeline", True),
+    ("employee leave request", "request for leave by an employee", "flowchart", True),
+    ("coffee ordering process", "process to order coffee", "flowchart", True),
+    ("gantt chart for a 3 month project", "3 month project schedule", "gantt", True),
+    ("pie chart of 2023 sales by region", "2023 sales by region", "pie", True),
+    # Similar wording, different request
+    ("flowchart for user login", "user logout flow", "flowchart", False),
+    ("order checkout process", "order return process", "flowchart", False),
+    ("password reset flow", "password change policy", "flowchart", False),
+    ("hospital patient admission", "hospital patient discharge", "flowchart", False),
+    ("ATM cash withdrawal", "ATM cash deposit", "sequence", False),
+    ("user logs in via OAuth", "user logs in via SAML", "sequence", False),
+    ("library management system classes", "hotel management system classes", "class", False),
+    ("student course enrollment database", "employee payroll database", "er", False),
+    ("traffic light states", "elevator states", "state", False),
+    ("website project plan", "mobile app project plan", "gantt", False),
+    ("monthly budget breakdown", "yearly sales breakdown", "pie", False),
+    ("history of the internet", "history of the printing press", "timeline", False),
+    ("CI/CD pipeline with build test deploy", "data pipeline with extract transform load", "flowchart", False),
+    ("online shopping checkout", "online shopping wishlist", "flowchart", False),
+    ("coffee ordering process", "pizza ordering process", "flowchart", False),
+    ("vending machine states", "washing machine states", "state", False),
+    ("client server request response", "peer to peer file sharing", "sequence", False),
+    ("e-commerce order entities", "e-commerce review entities", "er", False),
+    # Same wording, different number or name: similarity alone scores these far above any threshold
+    ("gantt chart for a 3 month project", "gantt chart for a 6 month project", "gantt", False),
+    ("pie chart of 2023 sales by region", "pie chart of 2024 sales by region", "pie", False),
+    ("top 5 programming languages by usage", "top 10 programming languages by usage", "pie", False),
+    ("timeline of World War 1", "timeline of World War 2", "timeline", False),
+    ("login flow with Google accounts", "login flow with Microsoft accounts", "flowchart", False),
+    ("browser fetching a page over HTTP/1.1", "browser fetching a page over HTTP/2", "sequence", False),
+    ("AWS deployment pipeline", "GCP deployment pipeline", "flowchart", False),
+    ("three tier architecture request flow", "two tier architecture request flow", "flowchart", False),
+]
+
+FILLER = {
+    "flowchart": ["bug triage workflow", "employee onboarding", "loan approval process", "incident response"],
+    "sequence": ["payment gateway callback", "chat message delivery", "file upload to cloud storage"],
+    "class": ["banking system", "parking lot system", "social media posts and comments"],
+    "er": ["blog posts and authors", "airline bookings", "inventory and suppliers"],
+    "state": ["order lifecycle", "TCP connection", "document approval"],
+    "gantt": ["product launch", "thesis writing schedule"],
+    "pie": ["website traffic sources", "energy consumption by source"],
+    "timeline": ["evolution of smartphones", "space exploration milestones"],
+}
+
+
+def evaluate(threshold, key_check=True):
+    cache = SemanticCache('eval', maxsize_per_mode=1024, ttl=10 ** 9)
+    for mode, prompts in FILLER.items():
+        for prompt in prompts:
+            cache.add(mode, prompt, {'cached': prompt})
+    for cached, _, mode, _ in PAIRS:
+        cache.add(mode, cached, {'cached': cached})
+
+    # Several pairs share a cached prompt or rephrase the same request, so any labelled-same match is correct
+    equivalent = {(cached, incoming) for cached, incoming, _, same in PAIRS if same}
+    tp = fp = fn = tn = 0
+    for cached, incoming, mode, same in PAIRS:
+        match = cache.lookup(mode, incoming, threshold, same_keys=key_check)
+        predicted = match is not None and (match[1] == cached or (match[1], incoming) in equivalent)
+        # Serving any cached diagram for a different request is a false positive, even one from another pair
+        wrong_serve = match is not None and not predicted
+        if same and predicted:
+            tp += 1
+        elif same:
+            fn += 1
+            fp += wrong_serve
+        elif match is not None:
+            fp += 1
+        else:
+            tn += 1
+    precision = tp / (tp + fp) if tp + fp else 1.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return precision, recall, f1, tp, fp, fn, tn
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precision/recall of the semantic cache by threshold.')
+    parser.add_argument('--thresholds', default=','.join(f"{t / 100:.2f}" for t in range(40, 100, 5)))
+    parser.add_argument('--min-precision', type=float, default=1.0,
+                        help='precision the recommended serve threshold must reach')
+    parser.add_argument('--no-key-check', action='store_true', help='match on similarity alone')
+    args = parser.parse_args()
+
+    print(f"{len(PAIRS)} labelled pairs ({sum(p[3] for p in PAIRS)} same); "
+          f"configured serve={SEMANTIC_SERVE_THRESHOLD} ({'on' if SEMANTIC_SERVE else 'off, drafts only'}) "
+          f"draft={SEMANTIC_DRAFT_THRESHOLD}\n")
+    print(f"{'threshold':>9} {'precision':>10} {'recall':>7} {'f1':>6} {'tp':>4} {'fp':>4} {'fn':>4} {'tn':>4}")
+    recommended = None
+    for threshold in sorted(float(t) for t in args.thresholds.split(',')):
+        precision, recall, f1, tp, fp, fn, tn = evaluate(threshold, key_check=not args.no_key_check)
+        print(f"{threshold:>9.2f} {precision:>10.1%} {recall:>7.1%} {f1:>6.3f} {tp:>4} {fp:>4} {fn:>4} {tn:>4}")
+        if recommended is None and precision >= args.min_precision:
+            recommended = threshold
+    if recommended is not None:
+        print(f"\nlowest threshold with precision >= {args.min_precision:.0%}: {recommended:.2f}")
+    else:
+        print(f"\nno threshold reached precision {args.min_precision:.0%}")
+
+
+if __name__ == '__main__':
+    main()
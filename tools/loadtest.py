@@ -0,0 +1,198 @@
+"""
+Open-loop load generator for the Flask app.
+
+Requests are fired on a fixed schedule (Poisson arrivals at --rps) regardless of
+how fast earlier ones complete, and latency is measured from the *scheduled*
+send time, so queueing inside the app shows up in the percentiles instead of
+silently lowering the offered load (coordinated omission).
+
+Against an already running app:
+
+    python tools/loadtest.py --url http://127.0.0.1:5000 --rps 20 --duration 60
+
+Self-contained, with the mock upstream and the app started in-process:
+
+    python tools/loadtest.py --spawn --rps 20 --duration 30 --latency lognormal:1.0,0.4 --error-rate 0.02
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mock_upstream import add_mock_arguments, configure, start_mock_server  # noqa: E402
+
+SUBJECTS = ["user login", "order checkout", "CI pipeline", "hospital admission", "library checkout",
+            "payment refund", "video upload", "exam registration", "warehouse restock", "ride booking"]
+MODES = ["flowchart", "sequence", "class", "state", "er", "gantt", "pie", "timeline"]
+LAW_PROMPTS = ["My college is refusing to refund my fees after I withdrew.",
+               "My landlord is keeping my security deposit without reason.",
+               "An online shop delivered a broken phone and won't replace it."]
+
+
+def generate_payload(rng):
+    # A random suffix keeps most prompts unique so the generate cache doesn't hide upstream latency
+    return {'prompt': f"{rng.choice(SUBJECTS)} process #{rng.randrange(10 ** 6)}", 'mode': rng.choice(MODES)}
+
+
+def refine_payload(rng):
+    return {'current_code': "flowchart TD\n  A[Start] --> B[End]", 'mode': 'flowchart',
+            'instruction': f"add an error branch for case {rng.randrange(1000)}"}
+
+
+def law_payload(rng):
+    return {'prompt': rng.choice(LAW_PROMPTS), 'history': []}
+
+
+def notes_payload(rng):
+    return {'action': 'full', 'url': f"https://www.youtube.com/watch?v={rng.randrange(10 ** 10):011d}"}
+
+
+ENDPOINTS = {
+    'generate': ('/api/generate', generate_payload),
+    'refine': ('/api/refine', refine_payload),
+    'law-chat': ('/api/law-chat', law_payload),
+    'yt-notes': ('/api/yt-notes', notes_payload),
+}
+
+
+def parse_mix(spec):
+    """'generate=6,refine=2,law-chat=1,yt-notes=1' -> [(name, weight), ...]"""
+    mix = []
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint {name!r}; choose from {', '.join(ENDPOINTS)}")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+class Results:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}   # endpoint -> list of (latency, status)
+
+    def add(self, endpoint, latency, status):
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append((latency, status))
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def fire(session, base_url, endpoint, payload, scheduled, results, timeout):
+    path = ENDPOINTS[endpoint][0]
+    try:
+        # Tell the app when we give up so admission control can drop requests we no longer wait for
+        remaining = max(0.0, timeout - (time.perf_counter() - scheduled))
+        response = session.post(base_url + path, json=payload, timeout=remaining or 0.001,
+                                headers={'X-Request-Timeout': f"{remaining:.3f}"})
+        status = response.status_code
+    except requests.RequestException:
+        status = 'exc'
+    results.add(endpoint, time.perf_counter() - scheduled, status)
+
+
+def run_load(base_url, rps, duration, mix, workers=256, timeout=120, seed=None):
+    rng = random.Random(seed)
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    results = Results()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+
+    start = time.perf_counter()
+    next_at = start
+    sent = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while next_at - start < duration:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            endpoint = rng.choices(names, weights)[0]
+            payload = ENDPOINTS[endpoint][1](rng)
+            pool.submit(fire, session, base_url, endpoint, payload, next_at, results, timeout)
+            sent += 1
+            next_at += rng.expovariate(rps)
+    return results, sent, time.perf_counter() - start, duration
+
+
+def report(results, sent, elapsed, duration):
+    # Throughput is over the whole run including the drain of in-flight requests; offered rate only over the send window
+    print(f"\n{sent} requests sent in {duration:.1f}s ({sent / duration:.1f} req/s offered), all completed after {elapsed:.1f}s\n")
+    print(f"{'endpoint':<10} {'count':>6} {'rps':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'errors':>7}  statuses")
+    for endpoint in sorted(results.samples):
+        samples = results.samples[endpoint]
+        latencies = sorted(lat for lat, _ in samples)
+        statuses = {}
+        for _, status in samples:
+            statuses[status] = statuses.get(status, 0) + 1
+        errors = sum(n for status, n in statuses.items() if status == 'exc' or status >= 400)
+        print(f"{endpoint:<10} {len(samples):>6} {len(samples) / elapsed:>6.1f} "
+              f"{percentile(latencies, 50):>7.2f}s {percentile(latencies, 95):>7.2f}s "
+              f"{percentile(latencies, 99):>7.2f}s {latencies[-1]:>7.2f}s "
+              f"{errors / len(samples):>6.1%}  "
+              + ' '.join(f"{status}:{n}" for status, n in sorted(statuses.items(), key=lambda kv: str(kv[0]))))
+
+
+def spawn_stack(app_port):
+    """Start the mock upstream and the app (threaded werkzeug server) inside this process."""
+    _, mock_url = start_mock_server()
+    os.environ.update({
+        'SARVAM_API_URL': f"{mock_url}/v1/chat/completions",
+        'SUPADATA_API_URL': mock_url,
+        'RESEND_API_URL': mock_url,
+        'SARVAM_API_KEY': os.environ.get('SARVAM_API_KEY') or 'mock-key',
+        'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+    })
+    # app reads its configuration at import time, so import only after the environment points at the mock
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from werkzeug.serving import make_server
+    import app as app_module
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    server = make_server('127.0.0.1', app_port, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='app-server', daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Open-loop load test for the Arka API.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='base URL of a running app')
+    parser.add_argument('--spawn', action='store_true', help='start the mock upstream and the app in-process')
+    parser.add_argument('--app-port', type=int, default=0, help='port for the spawned app (0 = any)')
+    parser.add_argument('--rps', type=float, default=10.0, help='mean arrival rate (requests/second)')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to generate load for')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('generate=6,refine=2,law-chat=1,yt-notes=1'),
+                        help='weighted endpoint mix, e.g. generate=6,refine=2,law-chat=1,yt-notes=1')
+    parser.add_argument('--workers', type=int, default=256, help='max concurrent in-flight requests')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=None)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    base_url = args.url
+    if args.spawn:
+        configure(args.latency, args.error_rate, args.burst_every, args.burst_length)
+        base_url = spawn_stack(args.app_port)
+        print(f"Spawned mock upstream and app at {base_url}")
+
+    results, sent, elapsed, duration = run_load(base_url, args.rps, args.duration, args.mix,
+                                      workers=args.workers, timeout=args.timeout, seed=args.seed)
+    report(results, sent, elapsed, duration)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+"""
+Local stand-in for the upstream APIs the app calls, for load testing without
+network access or API quota:
+
+    Sarvam    POST /v1/chat/completions   (canned Mermaid / law-chat / notes output, optional SSE streaming)
+    Supadata  GET  /v1/transcript          (synthetic lecture transcript with repeated segments)
+    Resend    POST /emails, /emails/batch
+
+Latency, error rate and 429 bursts are configurable:
+
+    python tools/mock_upstream.py --port 8765 --latency lognormal:1.2,0.5 --error-rate 0.01 \
+        --burst-every 30 --burst-length 3
+
+then start the app against it:
+
+    SARVAM_API_URL=http://127.0.0.1:8765/v1/chat/completions SUPADATA_API_URL=http://127.0.0.1:8765 \
+    RESEND_API_URL=http://127.0.0.1:8765 SARVAM_API_KEY=mock RESEND_API_KEY=mock python app.py
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+MERMAID_SAMPLES = {
+    'flowchart': "flowchart TD\n  A[Start] --> B{Logged in?}\n  B -->|Yes| C[Dashboard]\n  B -->|No| D[Login Page]\n  D --> E[Validate Credentials]\n  E --> C",
+    'block': "graph LR\n  subgraph Client\n    A[Browser]\n  end\n  subgraph Backend\n    B[API Gateway]\n    C[Service]\n  end\n  A --> B\n  B --> C",
+    'architecture': "graph TD\n  subgraph Cloud\n    LB[Load Balancer]\n    S1[Server 1]\n    S2[Server 2]\n    DB[(Database)]\n  end\n  LB --> S1\n  LB --> S2\n  S1 --> DB\n  S2 --> DB",
+    'sequence': "sequenceDiagram\n    participant User\n    participant Server\n    User->>Server: Login Request\n    Server-->>User: Auth Token",
+    'timeline': "timeline\n    title Product History\n    section Launch\n        2020 : Beta released\n        2021 : General availability",
+    'gantt': "gantt\n    title Project Plan\n    dateFormat YYYY-MM-DD\n    section Planning\n        Requirements :done, a1, 2024-01-01, 30d\n        Design :active, a2, after a1, 20d",
+    'pie': 'pie title Traffic Sources\n    "Search" : 45\n    "Direct" : 30\n    "Social" : 25',
+    'xy': 'xychart-beta\n    title "Monthly Sales"\n    x-axis [Jan, Feb, Mar]\n    y-axis "Revenue" 0 --> 100\n    bar [30, 60, 90]',
+    'er': "erDiagram\n    CUSTOMER ||--o{ ORDER : places\n    ORDER ||--|{ LINE_ITEM : contains",
+    'state': "stateDiagram-v2\n    [*] --> Idle\n    Idle --> Running : start\n    Running --> Idle : stop",
+    'class': "classDiagram\n    class Animal {\n      +String name\n      +speak()\n    }\n    Animal <|-- Dog",
+    'git': 'gitGraph\n    commit\n    branch develop\n    checkout develop\n    commit\n    checkout main\n    merge develop',
+    'quadrant': 'quadrantChart\n    title Priorities\n    x-axis Low Effort --> High Effort\n    y-axis Low Impact --> High Impact\n    Task A: [0.3, 0.6]',
+    'treemap': "mindmap\n  root((Project))\n    Frontend\n      React\n    Backend\n      Flask",
+}
+
+LAW_QUESTION = {
+    "phase": "questioning",
+    "message": "I understand you are facing an issue with unfair charges.",
+    "question": "Which kind of institution charged you?",
+    "options": ["University", "Private company", "Government office", "Landlord"],
+}
+
+LAW_FINAL = {
+    "phase": "final",
+    "cards": {
+        "issue_summary": "The user was charged an unjustified fee by their institute.",
+        "legal_classification": "Consumer / Education regulatory matter.",
+        "applicable_laws": "Consumer Protection Act, 2019\nUGC (Refund of Fees) guidelines",
+        "risk_urgency": {"level": "MEDIUM", "description": "Refund claims are time-bound."},
+        "official_resources": "https://consumerhelpline.gov.in\nhttps://www.ugc.gov.in",
+        "action_plan": "1. Write to the institute.\n2. File a complaint on the consumer helpline.",
+        "required_documents": "Fee receipts, admission letter, correspondence.",
+        "preventive_advice": "Keep copies of every payment receipt.",
+    },
+}
+
+NOTES_HTML = (
+    "<h2>Core Concepts</h2><ul><li><strong>Energy</strong> is conserved in a closed system.</li>"
+    "<li>Work equals force times displacement.</li></ul><h3>Examples</h3><p>A falling ball converts "
+    "potential energy into kinetic energy.</p>"
+)
+
+NOTES_OUTLINE = {
+    "sections": [
+        {"heading": "Conservation of Energy", "points": ["**Energy** is conserved in a closed system.",
+                                                         "Potential energy converts into kinetic energy."]},
+        {"heading": "Work", "points": ["Work equals **force** times displacement."]},
+    ],
+    "terms": [{"term": "Kinetic energy", "definition": "Energy of motion."}],
+}
+
+TRANSCRIPT_INTRO = "hey everyone welcome back to the channel before we start please like and subscribe "
+TRANSCRIPT_WORDS = ("energy force mass acceleration momentum velocity work power system closed "
+                    "potential kinetic conservation friction gravity motion vector scalar law").split()
+
+
+class MockConfig:
+    latency = ('lognormal', 1.0, 0.4)    # seconds; see parse_latency
+    error_rate = 0.0
+    burst_every = 0.0                    # seconds between 429 bursts (0 = none)
+    burst_length = 0.0
+    stream_chunk_delay = 0.02
+    started = time.monotonic()
+
+
+def parse_latency(spec):
+    """'fixed:0.5', 'uniform:0.2,1.5', 'normal:1.0,0.2' or 'lognormal:<median>,<sigma>'."""
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(',') if v]
+    if kind not in ('fixed', 'uniform', 'normal', 'lognormal') or not values:
+        raise argparse.ArgumentTypeError(f"bad latency spec: {spec}")
+    return (kind, *values)
+
+
+def sample_latency():
+    kind, *args = MockConfig.latency
+    if kind == 'fixed':
+        return args[0]
+    if kind == 'uniform':
+        return random.uniform(args[0], args[1])
+    if kind == 'normal':
+        return max(0.0, random.gauss(args[0], args[1] if len(args) > 1 else args[0] / 5))
+    median, sigma = args[0], args[1] if len(args) > 1 else 0.4
+    return random.lognormvariate(0, sigma) * median
+
+
+def in_burst():
+    if not MockConfig.burst_every:
+        return False
+    return (time.monotonic() - MockConfig.started) % MockConfig.burst_every < MockConfig.burst_length
+
+
+def canned_completion(messages):
+    system = next((m.get('content', '') for m in messages if m.get('role') == 'system'), '')
+    user = next((m.get('content', '') for m in reversed(messages) if m.get('role') == 'user'), '')
+    if 'legal assistant' in system:
+        # Ask questions for a few turns, then give the final analysis
+        turns = sum(1 for m in messages if m.get('role') == 'user')
+        return json.dumps(LAW_FINAL if turns >= 4 else LAW_QUESTION)
+    if 'JSON outline' in user or '"sections"' in system:
+        return json.dumps(NOTES_OUTLINE)
+    if 'tutor' in system:
+        return NOTES_HTML
+    match = re.search(r'(?:Generate a|current) (\w+) diagram', user)
+    mode = match.group(1) if match else 'flowchart'
+    return MERMAID_SAMPLES.get(mode, MERMAID_SAMPLES['flowchart'])
+
+
+def synthetic_transcript(video_id, words=1500):
+    rng = random.Random(video_id)
+    parts = [TRANSCRIPT_INTRO * 3]
+    while sum(len(p.split()) for p in parts) < words:
+        parts.append(' '.join(rng.choice(TRANSCRIPT_WORDS) for _ in range(120)))
+        if rng.random() < 0.1:
+            parts.append(TRANSCRIPT_INTRO * 3)      # recap / sponsor loop
+    return ' '.join(parts)
+
+
+class MockUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    counts = {}
+    _lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def _reply(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _maybe_fail(self):
+        if in_burst():
+            self._reply(429, {'error': {'message': 'Rate limit exceeded', 'code': 'rate_limited'}}, {'Retry-After': '1'})
+            return True
+        if random.random() < MockConfig.error_rate:
+            self._reply(random.choice((500, 502, 503)), {'error': {'message': 'mock upstream failure'}})
+            return True
+        return False
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path != '/v1/transcript':
+            self._reply(404, {'error': 'not found'})
+            return
+        self._count('supadata')
+        time.sleep(sample_latency() / 2)
+        if self._maybe_fail():
+            return
+        url = parse_qs(parsed.query).get('url', [''])[0]
+        self._reply(200, {'content': synthetic_transcript(url[-11:]), 'lang': 'en'})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+        path = urlparse(self.path).path
+        if path == '/v1/chat/completions':
+            self._chat(body)
+        elif path in ('/emails', '/emails/batch'):
+            self._count('resend')
+            time.sleep(sample_latency() / 10)
+            if self._maybe_fail():
+                return
+            if path == '/emails':
+                self._reply(200, {'id': 'mock-email'})
+            else:
+                self._reply(200, {'data': [{'id': f'mock-email-{i}'} for i in range(len(body or []))]})
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def _chat(self, body):
+        self._count('sarvam')
+        messages = (body or {}).get('messages', [])
+        content = canned_completion(messages)
+        prompt_tokens = sum(len(m.get('content', '')) for m in messages) // 4
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content) // 4,
+                 'total_tokens': prompt_tokens + len(content) // 4}
+        if body.get('stream'):
+            self._stream(content, usage)
+            return
+        time.sleep(sample_latency())
+        if self._maybe_fail():
+            return
+        self._reply(200, {
+            'id': 'mock-completion',
+            'model': body.get('model', 'sarvam-m'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': usage,
+        })
+
+    def _stream(self, content, usage):
+        # Time-to-first-token is a fraction of the total latency; the rest is spread over the chunks
+        total = sample_latency()
+        time.sleep(total * 0.3)
+        if self._maybe_fail():
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        pieces = [content[i:i + 24] for i in range(0, len(content), 24)] or ['']
+        delay = total * 0.7 / len(pieces)
+        for piece in pieces:
+            self._write_chunk(f"data: {json.dumps({'choices': [{'index': 0, 'delta': {'content': piece}}]})}\n\n")
+            time.sleep(delay)
+        self._write_chunk(f"data: {json.dumps({'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}], 'usage': usage})}\n\n")
+        self._write_chunk('data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _write_chunk(self, text):
+        data = text.encode()
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+
+def start_mock_server(host='127.0.0.1', port=0):
+    """Start the mock in a daemon thread; returns (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), MockUpstreamHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-upstream', daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+def configure(latency=None, error_rate=None, burst_every=None, burst_length=None):
+    if latency is not None:
+        MockConfig.latency = parse_latency(latency) if isinstance(latency, str) else latency
+    if error_rate is not None:
+        MockConfig.error_rate = error_rate
+    if burst_every is not None:
+        MockConfig.burst_every = burst_every
+    if burst_length is not None:
+        MockConfig.burst_length = burst_length
+    MockConfig.started = time.monotonic()
+
+
+def add_mock_arguments(parser):
+    parser.add_argument('--latency', type=parse_latency, default=MockConfig.latency,
+                        help="upstream latency distribution, e.g. fixed:0.5, uniform:0.2,1.5, lognormal:1.0,0.4")
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls answered with a 5xx')
+    parser.add_argument('--burst-every', type=float, default=0.0, help='seconds between 429 bursts (0 = none)')
+    parser.add_argument('--burst-length', type=float, default=0.0, help='length of each 429 burst in seconds')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock Sarvam/Supadata/Resend upstream server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    configure(args.latency, args.error_rate, args.burst_every, args.burst_length)
+
+    server = ThreadingHTTPServer((args.host, args.port), MockUpstreamHandler)
+    server.daemon_threads = True
+    print(f"Mock upstream listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Report upstream usage from the usage ledger (see "Usage ledger" in app.py).
+
+Reads the SQLite file directly, so it works on a copy of the database or
+while the app is down. Old hours come from the rollups, recent ones from the
+raw rows; --rollup folds complete hours first, as the app does periodically.
+
+    python tools/usage_report.py                                  # last 24h by route and mode
+    python tools/usage_report.py --since 7d --group-by model,key
+    python tools/usage_report.py --since 2026-10-01 --group-by day --route generate
+    python tools/usage_report.py --since 30d --group-by identity --limit 20 --json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import USAGE_DB_PATH, USAGE_DIMENSIONS, UsageLedger, parse_usage_time  # noqa: E402
+
+COLUMNS = [('calls', 7), ('retries', 7), ('cache_hits', 10), ('errors', 6), ('prompt_tokens', 13),
+           ('completion_tokens', 17), ('total_tokens', 12), ('cost', 10), ('avg_latency_ms', 14),
+           ('max_latency_ms', 14)]
+
+
+def format_group(name, value):
+    if name in ('hour', 'day'):
+        return time.strftime('%Y-%m-%d %H:%M' if name == 'hour' else '%Y-%m-%d', time.gmtime(value))
+    return value if value != '' else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report upstream token usage, cost and latency.')
+    parser.add_argument('--db', default=USAGE_DB_PATH or None, help='usage ledger database (default: USAGE_DB_PATH)')
+    parser.add_argument('--since', default='24h', help="start: '24h', '7d', epoch seconds or an ISO date (UTC)")
+    parser.add_argument('--until', help='end, same formats (default: now)')
+    parser.add_argument('--group-by', default='route,mode',
+                        help=f"comma-separated: {', '.join(USAGE_DIMENSIONS)}, hour, day")
+    for name in USAGE_DIMENSIONS:
+        parser.add_argument(f'--{name}', help=f'only rows with this {name}')
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--rollup', action='store_true', help='fold complete hours into the rollups first')
+    parser.add_argument('--json', action='store_true', help='print rows as JSON')
+    args = parser.parse_args()
+
+    if not args.db:
+        sys.exit("pass --db or set USAGE_DB_PATH")
+    if not os.path.exists(args.db):
+        sys.exit(f"no usage ledger at {args.db}")
+    ledger = UsageLedger(args.db)
+    if args.rollup:
+        ledger.rollup()
+    now = time.time()
+    group_by = [f for f in args.group_by.split(',') if f]
+    try:
+        rows = ledger.query(parse_usage_time(args.since, now),
+                            parse_usage_time(args.until, now) if args.until else now,
+                            group_by, {name: getattr(args, name) for name in USAGE_DIMENSIONS}, args.limit)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    widths = [max([len(name)] + [len(str(format_group(name, row[name]))) for row in rows]) for name in group_by]
+    header = '  '.join(name.ljust(w) for name, w in zip(group_by, widths))
+    print(header + '  ' + ' '.join(name.rjust(w) for name, w in COLUMNS))
+    for row in rows:
+        print('  '.join(str(format_group(name, row[name])).ljust(w) for name, w in zip(group_by, widths)) + '  ' +
+              ' '.join(str(row[name]).rjust(w) for name, w in COLUMNS))
+    totals = {name: sum(row[name] for row in rows) for name, _ in COLUMNS if not name.endswith('latency_ms')}
+    print(f"\n{len(rows)} groups, {totals['calls']} calls, {totals['total_tokens']} tokens, "
+          f"cost {round(totals['cost'], 4)}")
+
+
+if __name__ == '__main__':
+    main()
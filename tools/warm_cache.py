@@ -0,0 +1,79 @@
+"""
+Warm the generate cache of a running app after a deploy.
+
+Builds the same plan as the in-process warmer (the most served prompts in the
+app's warm-up tally, WARMUP_PROMPTS_PATH, which is kept whatever LOG_PROMPTS
+says; then the most frequent prompts in "Diagram served" log records, which
+only carry the prompt text when the app runs with LOG_PROMPTS=1 or at DEBUG
+level; then the example gallery) and posts each item to /api/generate at
+--rate requests/second. A 429/503 answer pauses for its Retry-After, so the
+warm-up backs off whenever live traffic needs the capacity.
+
+    python tools/warm_cache.py --url https://arka.example.com --prompts /srv/arka/warmup_prompts.json
+    python tools/warm_cache.py --url https://arka.example.com --log app.log --log app.log.1.gz
+    python tools/warm_cache.py --dry-run --log app.log --top 20
+"""
+import argparse
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import WARMUP_PROMPTS_PATH, WARMUP_RATE, WARMUP_TOP_N, PromptTally, warmup_plan  # noqa: E402
+
+
+def post_with_backoff(session, url, payload, headers, timeout, max_waits=10):
+    for _ in range(max_waits):
+        response = session.post(url, json=payload, headers=headers, timeout=timeout)
+        if response.status_code not in (429, 503):
+            return response
+        time.sleep(float(response.headers.get('Retry-After') or 5))
+    return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Warm the generate cache of a running app.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='base URL of the app')
+    parser.add_argument('--prompts', default=WARMUP_PROMPTS_PATH,
+                        help='warm-up tally saved by the app (WARMUP_PROMPTS_PATH; "" to skip)')
+    parser.add_argument('--log', action='append', default=[],
+                        help='JSON-line log file to mine (repeatable, .gz ok; needs LOG_PROMPTS=1 records)')
+    parser.add_argument('--top', type=int, default=WARMUP_TOP_N, help='most frequent tallied/logged prompts to replay')
+    parser.add_argument('--no-gallery', action='store_true', help='skip the built-in example gallery')
+    parser.add_argument('--rate', type=float, default=WARMUP_RATE, help='generations per second')
+    parser.add_argument('--api-key', default=os.getenv('WARMUP_API_KEY', ''),
+                        help='X-API-Key to charge the warm-up to (see QUOTA_API_KEYS)')
+    parser.add_argument('--timeout', type=float, default=90.0)
+    parser.add_argument('--dry-run', action='store_true', help='print the plan without sending anything')
+    args = parser.parse_args()
+
+    plan = warmup_plan(args.log, args.top, gallery=not args.no_gallery, tally=PromptTally(args.prompts))
+    if args.dry_run:
+        for mode, prompt in plan:
+            print(f"{mode:<12} {prompt}")
+        print(f"\n{len(plan)} items")
+        return
+
+    session = requests.Session()
+    headers = {'X-API-Key': args.api_key} if args.api_key else {}
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    counts = {'warmed': 0, 'cached': 0, 'failed': 0}
+    for i, (mode, prompt) in enumerate(plan, 1):
+        started = time.monotonic()
+        try:
+            response = post_with_backoff(session, args.url.rstrip('/') + '/api/generate',
+                                         {'prompt': prompt, 'mode': mode}, headers, args.timeout)
+            ok = response.status_code == 200
+            result = ('cached' if response.json().get('cached') else 'warmed') if ok else 'failed'
+        except (requests.RequestException, ValueError):
+            result = 'failed'
+        counts[result] += 1
+        print(f"[{i}/{len(plan)}] {result:<7} {mode:<12} {prompt[:70]}")
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
+    print(f"\nwarmed {counts['warmed']}, already cached {counts['cached']}, failed {counts['failed']}")
+
+
+if __name__ == '__main__':
+    main()